@@ -0,0 +1,27 @@
+"""
+Migration script to add the admin order search indexes to an existing orders table.
+db.create_all() only creates indexes for new tables, so run this once on older databases.
+"""
+
+from app import create_app
+from extensions import db
+from models import Order
+
+
+def add_order_indexes():
+    """Create the composite indexes declared on Order if they don't exist"""
+    app = create_app()
+    with app.app_context():
+        try:
+            for index in Order.__table__.indexes:
+                index.create(db.engine, checkfirst=True)
+                print(f"✓ {index.name}")
+            print("\n✓ Migration completed successfully!")
+        except Exception as e:
+            print(f"✗ Error during migration: {e}")
+            raise
+
+
+if __name__ == '__main__':
+    print("Starting migration: Adding order search indexes...")
+    add_order_indexes()
@@ -1,6 +1,7 @@
 import os
 import re
-from flask import Flask, send_from_directory, jsonify
+import time
+from flask import Flask, send_from_directory, jsonify, g, request
 from flask_cors import CORS
 
 def create_app():
@@ -38,10 +39,39 @@ def create_app():
     db.init_app(app)
     migrate.init_app(app, db)
     
-    # Initialize and start order processing queue
+    # Initialize order processing queue (started once the tables exist)
     from order_queue import order_queue
     order_queue.init_app(app)
-    order_queue.start()
+
+    # Pub/sub hub behind the order status event streams
+    from event_hub import order_event_hub
+    order_event_hub.init_app(app)
+
+    # Write-behind buffer for product view events
+    from view_events import view_event_buffer
+    view_event_buffer.init_app(app)
+    view_event_buffer.start()
+
+    # Quantile sketches of order totals and request latency
+    from sketches import sketch_recorder
+    sketch_recorder.init_app(app)
+    sketch_recorder.start()
+
+    @app.before_request
+    def _start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _record_latency(response):
+        started = g.pop('request_started', None)
+        if started is not None and request.url_rule is not None:
+            sketch_recorder.record('latency', f"{request.method} {request.url_rule.rule}",
+                                   (time.perf_counter() - started) * 1000)
+        return response
+
+    # In-memory admin dashboard counters (seeded once the tables exist)
+    from live_stats import live_stats
+    live_stats.init_app(app)
 
     # Create tables if they don't exist (simple convenience for demo/prod)
     with app.app_context():
@@ -266,6 +296,61 @@ def create_app():
             print(f"Error seeding database: {e}")
             app.logger.exception('Failed to seed database')
 
+        try:
+            live_stats.seed()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Failed to seed admin stats')
+
+    # Rebuild scheduled transitions from the database and start the worker.
+    # Workers coordinate through DB leases; ORDER_QUEUE_WORKER=0 opts a process out.
+    if os.environ.get('ORDER_QUEUE_WORKER', '1') != '0':
+        order_queue.start()
+
+    # Periodic background jobs (leased per job, so one process runs each at a time)
+    from jobs import job_runner
+    import cooccurrence
+    import similarity
+    import popularity
+    import coview
+    import columnar
+    import customers
+    import sketches
+    job_runner.init_app(app)
+    job_runner.register(
+        'cooccurrence',
+        int(os.environ.get('COOCCURRENCE_REFRESH_SECONDS', cooccurrence.REFRESH_SECONDS)),
+        cooccurrence.refresh,
+    )
+    job_runner.register(
+        'similarity',
+        int(os.environ.get('SIMILARITY_REFRESH_SECONDS', similarity.REFRESH_SECONDS)),
+        similarity.refresh,
+    )
+    job_runner.register(
+        'popularity',
+        int(os.environ.get('POPULARITY_REFRESH_SECONDS', popularity.REFRESH_SECONDS)),
+        popularity.refresh,
+    )
+    job_runner.register(
+        'coview',
+        int(os.environ.get('COVIEW_REFRESH_SECONDS', coview.REFRESH_SECONDS)),
+        coview.refresh,
+    )
+    job_runner.register(
+        columnar.JOB_NAME,
+        int(os.environ.get('COLUMNAR_REFRESH_SECONDS', columnar.REFRESH_SECONDS)),
+        columnar.refresh,
+    )
+    job_runner.register(
+        'customer_analytics',
+        int(os.environ.get('CUSTOMER_ANALYTICS_REFRESH_SECONDS', customers.REFRESH_SECONDS)),
+        customers.refresh,
+    )
+    job_runner.register('sketch_compaction', sketches.COMPACT_SECONDS, sketches.compact)
+    if os.environ.get('BACKGROUND_JOBS', '1') != '0':
+        job_runner.start()
+
     # Register blueprints
     from routes.auth import auth_bp
     from routes.products import products_bp
@@ -0,0 +1,203 @@
+"""
+Browsing History Store
+Recently viewed products per user/session, bounded in both directions:
+at most `max_keys` histories (least recently used evicted first) of at most
+`per_key` products each.
+
+MemoryHistoryStore keeps each history in a fixed-size ring buffer of interned
+product ids and integer timestamps. SqliteHistoryStore keeps the same data in
+a shared SQLite file so every worker process sees the same history; it is used
+when BROWSING_HISTORY_DB is set.
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+MAX_KEYS = int(os.environ.get('BROWSING_HISTORY_MAX_KEYS', 50000))
+PER_KEY = 50
+
+
+class _Ring:
+    """Fixed-size ring buffer of (product_id, timestamp), oldest first"""
+    __slots__ = ('ids', 'times', 'start', 'size')
+
+    def __init__(self, capacity):
+        self.ids = [None] * capacity
+        self.times = array('q', bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def _slot(self, i):
+        return (self.start + i) % len(self.ids)
+
+    def push(self, product_id, timestamp):
+        """Append a view, moving an existing entry for the product to the newest position"""
+        capacity = len(self.ids)
+        for i in range(self.size):
+            if self.ids[self._slot(i)] is product_id:
+                for j in range(i, self.size - 1):
+                    a, b = self._slot(j), self._slot(j + 1)
+                    self.ids[a], self.times[a] = self.ids[b], self.times[b]
+                self.size -= 1
+                break
+        if self.size == capacity:
+            self.start = (self.start + 1) % capacity
+            self.size -= 1
+        slot = self._slot(self.size)
+        self.ids[slot] = product_id
+        self.times[slot] = timestamp
+        self.size += 1
+
+    def newest(self, limit):
+        """Most recent first"""
+        out = []
+        for i in range(self.size - 1, max(self.size - limit, 0) - 1, -1):
+            slot = self._slot(i)
+            out.append((self.ids[slot], self.times[slot]))
+        return out
+
+
+class MemoryHistoryStore:
+    """
+    In-process store with global LRU eviction over keys.
+    """
+
+    def __init__(self, max_keys=MAX_KEYS, per_key=PER_KEY):
+        self.max_keys = max_keys
+        self.per_key = per_key
+        self._rings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, key, product_id, timestamp=None):
+        product_id = sys.intern(str(product_id))
+        timestamp = int(timestamp if timestamp is not None else time.time())
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                ring = self._rings[key] = _Ring(self.per_key)
+                while len(self._rings) > self.max_keys:
+                    self._rings.popitem(last=False)
+            else:
+                self._rings.move_to_end(key)
+            ring.push(product_id, timestamp)
+
+    def recent(self, key, limit=PER_KEY):
+        """[(product_id, unix timestamp)] most recent first"""
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                return []
+            self._rings.move_to_end(key)
+            return ring.newest(limit)
+
+    def __len__(self):
+        return len(self._rings)
+
+
+class SqliteHistoryStore:
+    """
+    Store shared by all processes on the host through one SQLite file (WAL mode).
+    """
+
+    EVICT_EVERY = 1000  # writes between global LRU checks
+
+    def __init__(self, path, max_keys=MAX_KEYS, per_key=PER_KEY):
+        self.path = path
+        self.max_keys = max_keys
+        self.per_key = per_key
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS browsing_history (
+                key TEXT NOT NULL,
+                product_id TEXT NOT NULL,
+                viewed_at INTEGER NOT NULL,
+                PRIMARY KEY (key, product_id)
+            );
+            CREATE INDEX IF NOT EXISTS ix_browsing_history_key_viewed_at ON browsing_history (key, viewed_at);
+            CREATE TABLE IF NOT EXISTS browsing_keys (
+                key TEXT PRIMARY KEY,
+                last_seen INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_browsing_keys_last_seen ON browsing_keys (last_seen);
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def record(self, key, product_id, timestamp=None):
+        timestamp = int(timestamp if timestamp is not None else time.time())
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT INTO browsing_history (key, product_id, viewed_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (key, product_id) DO UPDATE SET viewed_at = MAX(viewed_at, excluded.viewed_at)',
+                (key, str(product_id), timestamp),
+            )
+            conn.execute(
+                'DELETE FROM browsing_history WHERE key = ? AND product_id NOT IN '
+                '(SELECT product_id FROM browsing_history WHERE key = ? ORDER BY viewed_at DESC LIMIT ?)',
+                (key, key, self.per_key),
+            )
+            conn.execute(
+                'INSERT INTO browsing_keys (key, last_seen) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET last_seen = excluded.last_seen',
+                (key, timestamp),
+            )
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self._evict()
+
+    def _evict(self):
+        """Drop the least recently seen histories beyond max_keys"""
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            (count,) = conn.execute('SELECT COUNT(*) FROM browsing_keys').fetchone()
+            excess = count - self.max_keys
+            if excess > 0:
+                conn.execute(
+                    'CREATE TEMP TABLE IF NOT EXISTS evicted_keys (key TEXT PRIMARY KEY)'
+                )
+                conn.execute('DELETE FROM evicted_keys')
+                conn.execute(
+                    'INSERT INTO evicted_keys SELECT key FROM browsing_keys ORDER BY last_seen LIMIT ?',
+                    (excess,),
+                )
+                conn.execute('DELETE FROM browsing_history WHERE key IN (SELECT key FROM evicted_keys)')
+                conn.execute('DELETE FROM browsing_keys WHERE key IN (SELECT key FROM evicted_keys)')
+
+    def recent(self, key, limit=PER_KEY):
+        """[(product_id, unix timestamp)] most recent first"""
+        rows = self._conn().execute(
+            'SELECT product_id, viewed_at FROM browsing_history WHERE key = ? ORDER BY viewed_at DESC LIMIT ?',
+            (key, limit),
+        ).fetchall()
+        return [(product_id, viewed_at) for product_id, viewed_at in rows]
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM browsing_keys').fetchone()[0]
+
+
+def create_store():
+    path = os.environ.get('BROWSING_HISTORY_DB')
+    if path:
+        return SqliteHistoryStore(path)
+    return MemoryHistoryStore()
+
+
+# Global instance
+history_store = create_store()
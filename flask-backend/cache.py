@@ -0,0 +1,167 @@
+"""
+Small in-process caches shared by the route modules.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded mapping with least-recently-used eviction.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class TTLCache:
+    """
+    LRU cache whose entries expire `ttl` seconds after being set. Entries can be
+    tagged (e.g. with the product ids they contain) and dropped by tag.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tags = {}  # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        _, _, tags = self._data.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                self._remove(key)
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, tags=()):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            tags = frozenset(tags)
+            self._data[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.max_size:
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry[1] if entry[0] > time.monotonic() else default
+
+    def invalidate_tag(self, tag):
+        """Drop every entry tagged with `tag`"""
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+
+class SnapshotCache:
+    """
+    Stale-while-revalidate cache of computed payloads. A snapshot is fresh for
+    `max_age` seconds; after that callers keep getting the stale snapshot while a
+    single background thread recomputes it. Only the very first call for a key
+    waits for the computation.
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._snapshots = {}  # key -> (computed_at, value)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._first = {}  # key -> lock serialising the initial computation
+
+    def get(self, key, compute):
+        """Return (value, age in seconds). `compute` must be safe to call from another thread."""
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            with self._lock:
+                first = self._first.setdefault(key, threading.Lock())
+            with first:
+                snapshot = self._snapshots.get(key)
+                if snapshot is None:
+                    snapshot = self._snapshots[key] = (time.time(), compute())
+        elif time.time() - snapshot[0] > self.max_age:
+            with self._lock:
+                start = key not in self._refreshing
+                self._refreshing.add(key)
+            if start:
+                threading.Thread(target=self._refresh, args=(key, compute), daemon=True).start()
+        return snapshot[1], time.time() - snapshot[0]
+
+    def _refresh(self, key, compute):
+        try:
+            self._snapshots[key] = (time.time(), compute())
+        except Exception as e:
+            print(f"[Cache] Refreshing snapshot {key!r} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(key, None)
@@ -0,0 +1,347 @@
+"""
+Columnar Order Store
+Order line items copied out of the OLTP tables into columnar NumPy arrays
+for ad-hoc admin analytics (POST /admin/analytics/query), so long-range
+breakdowns never scan the tables checkout writes to.
+
+Each refresh appends the orders placed since the last one as a new segment
+directory of .npy files (one per column), and patches the status column of
+already exported orders in place from the order_events log. Segments are
+opened memory-mapped, queries are evaluated segment by segment with
+vectorised operations and the partial aggregates merged. Small segments are
+compacted into one once there are more than MAX_SEGMENTS.
+
+Files are local to the host (ANALYTICS_COLUMNS_DIR), so the refresh job is
+leased per host.
+
+Rebuild with:  python columnar.py --full
+"""
+
+import json
+import os
+import shutil
+import socket
+from datetime import datetime, timedelta
+import numpy as np
+from extensions import db
+
+DATA_DIR = os.environ.get('ANALYTICS_COLUMNS_DIR', os.path.join('instance', 'columns'))
+JOB_NAME = f"columnar:{socket.gethostname()}"
+REFRESH_SECONDS = 300
+SETTLE_SECONDS = 5
+MAX_SEGMENTS = 32
+BATCH_SIZE = 5000
+
+COLUMNS = {
+    'ts': np.int64,         # order created_at, unix seconds
+    'order': np.int64,      # dense order number
+    'order_id': 'S64',
+    'product': np.int32,    # codes into the dictionaries
+    'category': np.int32,
+    'status': np.int16,
+    'quantity': np.int32,
+    'amount': np.float64,   # price * quantity
+}
+GROUP_BYS = ('product', 'category', 'status', 'day', 'week', 'month', 'year')
+METRICS = ('revenue', 'units', 'orders')
+
+
+class ColumnStore:
+    """
+    Segmented column files under `path` plus manifest.json (segments, cursors,
+    dictionaries mapping codes back to product ids/names, categories and statuses).
+    """
+
+    def __init__(self, path=DATA_DIR):
+        self.path = path
+
+    # -- manifest ---------------------------------------------------------
+
+    def _manifest_path(self):
+        return os.path.join(self.path, 'manifest.json')
+
+    def load_manifest(self):
+        try:
+            with open(self._manifest_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {
+                'segments': [], 'next_segment': 0, 'next_order': 0,
+                'cursor': None, 'event_id': 0,
+                'products': [], 'categories': [], 'statuses': [],
+            }
+
+    def save_manifest(self, manifest):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._manifest_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self._manifest_path())
+
+    # -- segments ---------------------------------------------------------
+
+    def _segment_dir(self, name):
+        return os.path.join(self.path, name)
+
+    def open_segment(self, name, mode='r'):
+        """{column: memory-mapped array} for a segment"""
+        return {
+            col: np.load(os.path.join(self._segment_dir(name), f'{col}.npy'), mmap_mode=mode)
+            for col in COLUMNS
+        }
+
+    def write_segment(self, manifest, arrays):
+        name = f"seg-{manifest['next_segment']:06d}"
+        manifest['next_segment'] += 1
+        directory = self._segment_dir(name)
+        os.makedirs(directory, exist_ok=True)
+        for col, dtype in COLUMNS.items():
+            np.save(os.path.join(directory, f'{col}.npy'), np.asarray(arrays[col], dtype=dtype))
+        manifest['segments'].append({'name': name, 'rows': int(len(arrays['ts']))})
+
+    def compact(self, manifest):
+        """Merge all segments into one (columns are read memory-mapped, written once)"""
+        old = list(manifest['segments'])
+        segments = [self.open_segment(seg['name']) for seg in old]
+        merged = {col: np.concatenate([seg[col] for seg in segments]) for col in COLUMNS}
+        manifest['segments'] = []
+        self.write_segment(manifest, merged)
+        return [seg['name'] for seg in old]
+
+    def remove_segments(self, names):
+        for name in names:
+            shutil.rmtree(self._segment_dir(name), ignore_errors=True)
+
+    def reset(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def _code(dictionary, index, value):
+    """Code of `value` in a dictionary list (appending it if new)"""
+    code = index.get(value)
+    if code is None:
+        code = index[value] = len(dictionary)
+        dictionary.append(value)
+    return code
+
+
+def refresh(state, full=False, store=None):
+    """Append orders placed since the last run and apply status changes from order_events.
+    `state` is the job's JobState row (see jobs.run_job; progress lives in the local manifest).
+    Returns the number of orders appended.
+    """
+    from models import Order, OrderEvent
+    store = store or ColumnStore()
+    if full:
+        store.reset()
+    manifest = store.load_manifest()
+    upper = datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)
+    last_event_id = db.session.query(db.func.max(OrderEvent.id)).scalar() or 0
+
+    product_index = {pid: i for i, (pid, _) in enumerate(manifest['products'])}
+    categories = manifest['categories']
+    category_index = {c: i for i, c in enumerate(categories)}
+    statuses = manifest['statuses']
+    status_index = {s: i for i, s in enumerate(statuses)}
+
+    # 1. new orders -> one new segment
+    query = (
+        db.select(Order.id, Order.created_at, Order.status, Order.items)
+        .where(Order.created_at <= upper)
+        .order_by(Order.created_at, Order.id)
+        .execution_options(yield_per=BATCH_SIZE)
+    )
+    if manifest['cursor']:
+        created_at, order_id = datetime.fromisoformat(manifest['cursor'][0]), manifest['cursor'][1]
+        query = query.where(db.or_(
+            Order.created_at > created_at,
+            db.and_(Order.created_at == created_at, Order.id > order_id),
+        ))
+
+    columns = {col: [] for col in COLUMNS}
+    appended = 0
+    for order_id, created_at, status, items in db.session.execute(query):
+        order_number = manifest['next_order']
+        manifest['next_order'] += 1
+        appended += 1
+        ts = int((created_at - datetime(1970, 1, 1)).total_seconds())
+        status_code = _code(statuses, status_index, status)
+        for item in items or []:
+            product_id = str(item.get('productId') or '')
+            name = item.get('productName') or item.get('name') or 'Unknown'
+            code = product_index.get(product_id)
+            if code is None:
+                code = product_index[product_id] = len(manifest['products'])
+                manifest['products'].append([product_id, name])
+            quantity = int(item.get('quantity', 0) or 0)
+            columns['ts'].append(ts)
+            columns['order'].append(order_number)
+            columns['order_id'].append(order_id.encode())
+            columns['product'].append(code)
+            columns['category'].append(_code(categories, category_index, item.get('category') or 'Other'))
+            columns['status'].append(status_code)
+            columns['quantity'].append(quantity)
+            columns['amount'].append(float(item.get('price', 0) or 0) * quantity)
+        manifest['cursor'] = [created_at.isoformat(), order_id]
+    if columns['ts']:
+        store.write_segment(manifest, columns)
+
+    # 2. status changes of exported orders, patched into the memory-mapped status columns
+    latest = {}
+    for order_id, to_status in db.session.execute(
+        db.select(OrderEvent.order_id, OrderEvent.to_status)
+        .where(OrderEvent.id > manifest['event_id'], OrderEvent.id <= last_event_id)
+        .order_by(OrderEvent.id)
+    ):
+        latest[order_id.encode()] = to_status
+    if latest:
+        by_status = {}
+        for order_id, status in latest.items():
+            by_status.setdefault(_code(statuses, status_index, status), []).append(order_id)
+        for seg in manifest['segments']:
+            segment = store.open_segment(seg['name'], mode='r+')
+            for code, order_ids in by_status.items():
+                mask = np.isin(segment['order_id'], np.array(order_ids, dtype='S64'))
+                if mask.any():
+                    segment['status'][mask] = code
+            segment['status'].flush()
+    manifest['event_id'] = last_event_id
+
+    removed = []
+    if len(manifest['segments']) > MAX_SEGMENTS:
+        removed = store.compact(manifest)
+    store.save_manifest(manifest)
+    store.remove_segments(removed)
+    db.session.commit()
+    print(f"[Columnar] Appended {appended} order(s), applied {len(latest)} status change(s)")
+    return appended
+
+
+# -- queries ------------------------------------------------------------------
+
+def _group_keys(segment, rows, group_by):
+    if group_by in ('product', 'category', 'status'):
+        return np.asarray(segment[group_by][rows], dtype=np.int64)
+    seconds = np.asarray(segment['ts'][rows]).astype('datetime64[s]')
+    unit = {'day': 'D', 'week': 'W', 'month': 'M', 'year': 'Y'}[group_by]
+    if unit == 'W':
+        # numpy weeks start on Thursday (the epoch); shift so buckets start on Monday
+        days = seconds.astype('datetime64[D]').astype(np.int64)
+        return (days + 3) // 7
+    return seconds.astype(f'datetime64[{unit}]').astype(np.int64)
+
+
+def _label(key, group_by, manifest):
+    if group_by == 'product':
+        product_id, name = manifest['products'][key]
+        return {'productId': product_id, 'name': name}
+    if group_by in ('category', 'status'):
+        return manifest[{'category': 'categories', 'status': 'statuses'}[group_by]][key]
+    if group_by == 'week':
+        return str(np.datetime64(int(key) * 7 - 3, 'D'))
+    unit = {'day': 'D', 'month': 'M', 'year': 'Y'}[group_by]
+    return str(np.datetime64(int(key), unit))
+
+
+def _codes(names, dictionary):
+    index = {name: i for i, name in enumerate(dictionary)}
+    return np.array([index[n] for n in names if n in index], dtype=np.int64)
+
+
+def run_query(spec, store=None):
+    """Evaluate a query spec:
+    {groupBy: product|category|status|day|week|month|year (optional),
+     filters: {from, to (ISO dates, `to` exclusive), status: [...], category: [...], productId: [...]},
+     orderBy: revenue|units|orders (top-k; time groupings default to chronological order), limit: n}
+    Raises ValueError on a malformed spec.
+    """
+    store = store or ColumnStore()
+    manifest = store.load_manifest()
+    group_by = spec.get('groupBy')
+    if group_by is not None and group_by not in GROUP_BYS:
+        raise ValueError(f"groupBy must be one of {', '.join(GROUP_BYS)}")
+    order_by = spec.get('orderBy', 'revenue')
+    if order_by not in METRICS:
+        raise ValueError(f"orderBy must be one of {', '.join(METRICS)}")
+    limit = min(int(spec.get('limit', 100)), 10000)
+    filters = spec.get('filters') or {}
+
+    def _ts(value):
+        when = datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=None)
+        return int((when - datetime(1970, 1, 1)).total_seconds())
+
+    ts_from = _ts(filters['from']) if filters.get('from') else None
+    ts_to = _ts(filters['to']) if filters.get('to') else None
+    code_filters = {}
+    if filters.get('status'):
+        code_filters['status'] = _codes(filters['status'], manifest['statuses'])
+    if filters.get('category'):
+        code_filters['category'] = _codes(filters['category'], manifest['categories'])
+    if filters.get('productId'):
+        code_filters['product'] = _codes([str(p) for p in filters['productId']],
+                                         [pid for pid, _ in manifest['products']])
+
+    totals = {}  # key -> [revenue, units, orders]
+    scanned = 0
+    for seg in manifest['segments']:
+        segment = store.open_segment(seg['name'])
+        # orders are appended in created_at order, so a time range is a slice
+        ts = segment['ts']
+        start = int(np.searchsorted(ts, ts_from, 'left')) if ts_from is not None else 0
+        stop = int(np.searchsorted(ts, ts_to, 'left')) if ts_to is not None else len(ts)
+        if stop <= start:
+            continue
+        rows = np.arange(start, stop)
+        for col, codes in code_filters.items():
+            rows = rows[np.isin(segment[col][rows], codes)]
+        scanned += stop - start
+        if not len(rows):
+            continue
+
+        keys = _group_keys(segment, rows, group_by) if group_by else np.zeros(len(rows), dtype=np.int64)
+        unique, inverse = np.unique(keys, return_inverse=True)
+        revenue = np.bincount(inverse, weights=segment['amount'][rows], minlength=len(unique))
+        units = np.bincount(inverse, weights=segment['quantity'][rows], minlength=len(unique))
+        # an order's line items all live in one segment, so distinct counts merge by addition
+        pairs = np.unique(np.stack([inverse, np.asarray(segment['order'][rows])]), axis=1)
+        orders = np.bincount(pairs[0], minlength=len(unique))
+        for key, r, u, o in zip(unique.tolist(), revenue, units, orders):
+            total = totals.setdefault(key, [0.0, 0, 0])
+            total[0] += float(r)
+            total[1] += int(u)
+            total[2] += int(o)
+
+    if group_by in ('day', 'week', 'month', 'year') and 'orderBy' not in spec:
+        ranked = sorted(totals.items())  # time series: chronological
+    else:
+        metric_index = METRICS.index(order_by)
+        ranked = sorted(totals.items(), key=lambda kv: -kv[1][metric_index])
+    return {
+        'groupBy': group_by,
+        'rows': [
+            {
+                **({'key': _label(key, group_by, manifest)} if group_by else {}),
+                'revenue': round(revenue, 2), 'units': units, 'orders': orders,
+            }
+            for key, (revenue, units, orders) in ranked[:limit]
+        ],
+        'scannedRows': scanned,
+        'segments': len(manifest['segments']),
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    os.environ.setdefault('ORDER_QUEUE_WORKER', '0')
+    os.environ.setdefault('BACKGROUND_JOBS', '0')
+    from app import create_app
+    from jobs import run_job
+
+    parser = argparse.ArgumentParser(description='Refresh the columnar order store')
+    parser.add_argument('--full', action='store_true', help='rebuild from all orders')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if run_job(JOB_NAME, refresh, full=args.full) is None:
+            print("Another process on this host is refreshing the columnar store; try again later.")
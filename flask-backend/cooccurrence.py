@@ -0,0 +1,287 @@
+"""
+Frequently Bought Together
+Builds an item-item co-occurrence matrix from order line items and stores
+the top-k neighbours of every product in product_neighbors, so
+GET /frequently-bought-together is a single indexed lookup.
+
+Pair counts (C = B^T B for the order x product incidence matrix B) and
+per-product order counts are kept in product_pair_counts and
+product_order_counts; each refresh only folds in orders placed since the
+last run and re-ranks the products they touched. Counted orders that were
+cancelled or refunded since the last run (per order_events) are subtracted
+again, and added back if they are reinstated. Neighbours are scored by
+lift (or PMI), shrunk towards zero for pairs seen in only a few orders.
+
+Run a full rebuild with:  python cooccurrence.py --full
+"""
+
+from datetime import datetime, timedelta
+import numpy as np
+from extensions import db
+from rollups import status_changes
+
+KIND = 'bought_together'
+TOP_K = 10
+SHRINKAGE = 5  # score *= count / (count + SHRINKAGE)
+EXCLUDED_STATUSES = ('cancelled', 'refunded')
+SETTLE_SECONDS = 5  # leave just-committed orders for the next run
+CHUNK_SIZE = 500
+REFRESH_SECONDS = 600
+
+
+def basket_pairs(baskets, n):
+    """Count co-occurring pairs in `baskets` (arrays of distinct product codes < n).
+    Baskets of equal size are stacked into one matrix so the pairs of each
+    size class are generated with a single vectorised indexing step.
+    Returns (a, b, counts) with a < b.
+    """
+    by_size = {}
+    for basket in baskets:
+        if len(basket) >= 2:
+            by_size.setdefault(len(basket), []).append(basket)
+
+    keys = []
+    for size, group in by_size.items():
+        matrix = np.sort(np.vstack(group), axis=1)
+        i, j = np.triu_indices(size, 1)
+        keys.append((matrix[:, i] * n + matrix[:, j]).ravel())
+    if not keys:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    unique, counts = np.unique(np.concatenate(keys), return_counts=True)
+    return unique // n, unique % n, counts
+
+
+def pair_scores(pair_counts, counts_p, counts_q, total_baskets, method='lift'):
+    """Lift (or PMI) of each pair, shrunk for low support"""
+    pair_counts = pair_counts.astype(np.float64)
+    lift = pair_counts * total_baskets / (counts_p.astype(np.float64) * counts_q)
+    score = np.log(lift) if method == 'pmi' else lift
+    return score * pair_counts / (pair_counts + SHRINKAGE)
+
+
+def top_k(owner, neighbor, score, k=TOP_K):
+    """Top-k neighbours per owner. Returns {owner: [(neighbor, score), ...]} best first"""
+    owners, owner_codes = np.unique(owner, return_inverse=True)
+    order = np.lexsort((-score, owner_codes))
+    owner_codes, neighbor, score = owner_codes[order], neighbor[order], score[order]
+    starts = np.flatnonzero(np.r_[True, owner_codes[1:] != owner_codes[:-1]])
+    ends = np.r_[starts[1:], len(owner_codes)]
+    return {
+        owners[owner_codes[s]]: list(zip(neighbor[s:min(e, s + k)], score[s:min(e, s + k)]))
+        for s, e in zip(starts, ends)
+    }
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _counted(status):
+    """Whether an order in `status` belongs in the counts (None: the order didn't exist yet)"""
+    return status is not None and status not in EXCLUDED_STATUSES
+
+
+def _basket(items):
+    return sorted({str(item.get('productId')) for item in items or [] if item.get('productId')})
+
+
+def _load_baskets(cursor, upper, later_changes):
+    """Distinct product ids of each order placed after `cursor` (created_at, id) up to `upper`
+    that counts with its status as of the event snapshot (`later_changes` are events after it)
+    """
+    from models import Order
+    query = (
+        db.select(Order.id, Order.created_at, Order.items, Order.status)
+        .where(Order.created_at <= upper)
+        .order_by(Order.created_at, Order.id)
+        .execution_options(yield_per=1000)
+    )
+    if cursor:
+        created_at, order_id = datetime.fromisoformat(cursor[0]), cursor[1]
+        query = query.where(db.or_(
+            Order.created_at > created_at,
+            db.and_(Order.created_at == created_at, Order.id > order_id),
+        ))
+
+    baskets, last = [], None
+    for order_id, created_at, items, status in db.session.execute(query):
+        if order_id in later_changes:
+            status = later_changes[order_id][0]
+        basket = _basket(items)
+        if basket and _counted(status):
+            baskets.append(basket)
+        last = (created_at.isoformat(), order_id)
+    return baskets, last
+
+
+def _recounted_baskets(changes, cursor):
+    """Baskets of already-counted orders (up to `cursor`) whose status moved out of
+    (removed) or back into (restored) the counted statuses. Returns (restored, removed)
+    """
+    from models import Order
+    flips = {order_id: _counted(after) for order_id, (before, after) in changes.items()
+             if _counted(before) != _counted(after)}
+    restored, removed = [], []
+    bound = (datetime.fromisoformat(cursor[0]), cursor[1])
+    for chunk in _chunks(flips):
+        for order_id, created_at, items in db.session.execute(
+            db.select(Order.id, Order.created_at, Order.items).where(Order.id.in_(chunk))
+        ):
+            basket = _basket(items)
+            if basket and created_at is not None and (created_at, order_id) <= bound:
+                (restored if flips[order_id] else removed).append(basket)
+    return restored, removed
+
+
+def _apply_counts(model, key_columns, deltas):
+    """Add {key tuple: delta} to `model`'s count column (the job lease makes this the only writer)"""
+    table = model.__table__
+    existing = {}
+    for chunk in _chunks(sorted({key[0] for key in deltas})):
+        rows = db.session.execute(db.select(table).where(table.c[key_columns[0]].in_(chunk))).mappings()
+        for row in rows:
+            key = tuple(row[col] for col in key_columns)
+            if key in deltas:
+                existing[key] = row['count']
+
+    updates, inserts = [], []
+    for key, delta in deltas.items():
+        params = dict(zip(key_columns, key))
+        if key in existing:
+            updates.append({**{f'k_{col}': v for col, v in params.items()}, 'new_count': existing[key] + delta})
+        else:
+            inserts.append({**params, 'count': delta})
+
+    if updates:
+        where = [table.c[col] == db.bindparam(f'k_{col}') for col in key_columns]
+        db.session.execute(table.update().where(*where).values(count=db.bindparam('new_count')), updates)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+
+def refresh(state, full=False, method='lift'):
+    """Fold new orders into the co-occurrence counts and re-rank affected products.
+    `state` is the job's JobState row (see jobs.run_job). Returns the number of orders processed.
+    """
+    from models import ProductPairCount, ProductOrderCount, ProductNeighbor, OrderEvent
+    data = dict(state.data or {})
+    if data.get('cursor') and 'eventId' not in data:
+        full = True  # counts from before status changes were tracked
+    if full:
+        db.session.execute(db.delete(ProductPairCount))
+        db.session.execute(db.delete(ProductOrderCount))
+        db.session.execute(db.delete(ProductNeighbor).where(ProductNeighbor.kind == KIND))
+        data = {}
+
+    # statuses are read as of one order_events id, so each order is counted (or retracted) exactly once
+    event_id = db.session.query(db.func.max(OrderEvent.id)).scalar() or 0
+    restored, removed = [], []
+    if data.get('cursor'):
+        restored, removed = _recounted_baskets(status_changes(data['eventId'], event_id), data['cursor'])
+    baskets, last = _load_baskets(
+        data.get('cursor'), datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS), status_changes(event_id)
+    )
+    added = baskets + restored
+    if not added and not removed:
+        data.update({'cursor': list(last) if last else data.get('cursor'), 'eventId': event_id})
+        state.data = data
+        db.session.commit()
+        return 0
+
+    # encode product ids as dense codes for the vectorised counting
+    vocabulary = np.array(sorted({pid for basket in added + removed for pid in basket}), dtype=object)
+    code = {pid: i for i, pid in enumerate(vocabulary)}
+    n = len(vocabulary)
+
+    def encode(group):
+        return [np.fromiter((code[pid] for pid in basket), dtype=np.int64, count=len(basket)) for basket in group]
+
+    item_delta = np.zeros(n, dtype=np.int64)
+    pair_updates = {}
+    for group, sign in ((encode(added), 1), (encode(removed), -1)):
+        if not group:
+            continue
+        item_delta += sign * np.bincount(np.concatenate(group), minlength=n)
+        a, b, pair_delta = basket_pairs(group, n)
+        for x, y, count in zip(vocabulary[a], vocabulary[b], pair_delta):
+            pair_updates[(x, y)] = pair_updates.get((x, y), 0) + sign * int(count)
+            pair_updates[(y, x)] = pair_updates.get((y, x), 0) + sign * int(count)
+
+    _apply_counts(ProductOrderCount, ('product_id',), {
+        (vocabulary[i],): int(item_delta[i]) for i in np.flatnonzero(item_delta)
+    })
+    _apply_counts(ProductPairCount, ('product_id', 'other_id'), {
+        key: delta for key, delta in pair_updates.items() if delta
+    })
+    total_baskets = data.get('baskets', 0) + len(added) - len(removed)
+
+    # re-rank every product that appeared in a new, retracted or restored order
+    affected = list(vocabulary)
+    pairs = []
+    for chunk in _chunks(affected):
+        pairs += db.session.execute(
+            db.select(ProductPairCount.product_id, ProductPairCount.other_id, ProductPairCount.count.label('n'))
+            .where(ProductPairCount.product_id.in_(chunk), ProductPairCount.count > 0)
+        ).all()
+    involved = {row.product_id for row in pairs} | {row.other_id for row in pairs}
+    item_counts = {}
+    for chunk in _chunks(involved):
+        item_counts.update(db.session.execute(
+            db.select(ProductOrderCount.product_id, ProductOrderCount.count)
+            .where(ProductOrderCount.product_id.in_(chunk))
+        ).all())
+
+    neighbors = {}
+    if pairs:
+        owner = np.array([row.product_id for row in pairs], dtype=object)
+        other = np.array([row.other_id for row in pairs], dtype=object)
+        counts = np.array([row.n for row in pairs], dtype=np.int64)
+        counts_p = np.array([item_counts[p] for p in owner], dtype=np.int64)
+        counts_q = np.array([item_counts[q] for q in other], dtype=np.int64)
+        neighbors = top_k(owner, other, pair_scores(counts, counts_p, counts_q, total_baskets, method))
+
+    for chunk in _chunks(affected):
+        db.session.execute(
+            db.delete(ProductNeighbor).where(ProductNeighbor.kind == KIND, ProductNeighbor.product_id.in_(chunk))
+        )
+    rows = [
+        {'kind': KIND, 'product_id': str(pid), 'rank': rank, 'neighbor_id': str(nid), 'score': float(score)}
+        for pid, ranked in neighbors.items()
+        for rank, (nid, score) in enumerate(ranked)
+    ]
+    if rows:
+        db.session.execute(ProductNeighbor.__table__.insert(), rows)
+
+    data.update({
+        'cursor': list(last) if last else data.get('cursor'), 'eventId': event_id,
+        'baskets': total_baskets, 'method': method,
+    })
+    state.data = data
+    db.session.commit()
+    print(f"[Cooccurrence] Processed {len(baskets)} new and {len(restored) + len(removed)} re-counted order(s), "
+          f"re-ranked {len(affected)} product(s)")
+    return len(baskets) + len(restored) + len(removed)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    os.environ.setdefault('ORDER_QUEUE_WORKER', '0')
+    os.environ.setdefault('BACKGROUND_JOBS', '0')
+    from app import create_app
+    from jobs import run_job
+
+    parser = argparse.ArgumentParser(description='Refresh frequently-bought-together neighbours')
+    parser.add_argument('--full', action='store_true', help='rebuild from all orders')
+    parser.add_argument('--method', choices=['lift', 'pmi'], default='lift')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        processed = run_job('cooccurrence', refresh, full=args.full, method=args.method)
+        if processed is None:
+            print("Another process is running the co-occurrence job; try again later.")
@@ -0,0 +1,33 @@
+"""
+Atomic counter rows.
+increment_row() applies `col = col + delta` in the database rather than a
+read-modify-write in Python, so concurrent requests never lose updates.
+"""
+
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+
+
+def increment_row(model, key, increments, initial=None):
+    """Add `increments` ({column: delta}) to the row of `model` identified by `key`.
+    The row is inserted (from `initial` plus the deltas) if it doesn't exist yet.
+    Runs inside the caller's transaction; the caller commits.
+    """
+    table = model.__table__
+    where = [table.c[col] == value for col, value in key.items()]
+    values = {col: table.c[col] + delta for col, delta in increments.items()}
+
+    result = db.session.execute(table.update().where(*where).values(**values))
+    if result.rowcount:
+        return
+
+    row = dict(initial or {})
+    row.update(key)
+    for col, delta in increments.items():
+        row[col] = row.get(col, 0) + delta
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(**row))
+    except IntegrityError:
+        # Another transaction inserted the row first; add to it instead
+        db.session.execute(table.update().where(*where).values(**values))
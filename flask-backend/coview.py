@@ -0,0 +1,171 @@
+"""
+Viewers Also Viewed
+Session co-view neighbours built incrementally from the product_views stream.
+Two products are co-viewed when the same user/session views both within
+SESSION_GAP of each other; each session contributes at most one count per
+pair per refresh.
+
+Counts are approximate: every product keeps at most CAPACITY Space-Saving
+counters (product_coview_counters), so memory and storage stay bounded
+however many distinct pairs appear, while frequent neighbours are kept with
+bounded error. The TOP_K neighbours by guaranteed count (count - error) are
+stored in product_neighbors (kind 'co_viewed').
+
+Run a full rebuild with:  python coview.py --full
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from extensions import db
+
+KIND = 'co_viewed'
+TOP_K = 10
+CAPACITY = 50
+SESSION_GAP = timedelta(minutes=30)
+BATCH_SIZE = 20000
+CHUNK_SIZE = 500
+REFRESH_SECONDS = 60
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy-hitters summary: at most `capacity` (count, error) counters.
+    """
+
+    def __init__(self, capacity=CAPACITY, counters=None):
+        self.capacity = capacity
+        self.counters = dict(counters or {})  # item -> [count, error]
+
+    def add(self, item, weight=1):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [weight, 0]
+        else:
+            victim = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[item] = [floor + weight, floor]
+
+    def top(self, k):
+        """[(item, guaranteed count)] best first"""
+        ranked = sorted(self.counters.items(), key=lambda kv: (-(kv[1][0] - kv[1][1]), -kv[1][0], kv[0]))
+        return [(item, count - error) for item, (count, error) in ranked[:k] if count - error > 0]
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def session_pairs(new_views, context):
+    """Distinct co-viewed (a, b) product pairs, a != b, in both directions.
+    `new_views` are (id, history_key, product_id, viewed_at) not yet counted;
+    `context` maps history_key -> the same tuples for all views near them, so a new
+    view pairs with earlier views already counted in a previous run but not vice versa.
+    """
+    pairs = set()
+    for view_id, key, product_id, viewed_at in new_views:
+        for other_id, _, other_product, other_at in context.get(key, ()):
+            if other_id < view_id and other_product != product_id and abs(viewed_at - other_at) <= SESSION_GAP:
+                pairs.add((key, min(product_id, other_product), max(product_id, other_product)))
+    counts = defaultdict(int)
+    for _, a, b in pairs:
+        counts[(a, b)] += 1
+        counts[(b, a)] += 1
+    return counts
+
+
+def refresh(state, full=False):
+    """Fold views recorded since the last run into the co-view counters.
+    `state` is the job's JobState row (see jobs.run_job). Returns the number of views processed.
+    """
+    from models import ProductView, ProductCoviewCounter, ProductNeighbor
+    data = dict(state.data or {})
+    if full:
+        db.session.execute(db.delete(ProductCoviewCounter))
+        db.session.execute(db.delete(ProductNeighbor).where(ProductNeighbor.kind == KIND))
+        data = {}
+
+    new_views = db.session.execute(
+        db.select(ProductView.id, ProductView.history_key, ProductView.product_id, ProductView.viewed_at)
+        .where(ProductView.id > data.get('viewId', 0))
+        .order_by(ProductView.id)
+        .limit(BATCH_SIZE)
+    ).all()
+    if not new_views:
+        db.session.commit()
+        return 0
+
+    # earlier views of the same sessions that new views can pair with
+    earliest = {}
+    for _, key, _, viewed_at in new_views:
+        earliest[key] = min(earliest.get(key, viewed_at), viewed_at)
+    context = defaultdict(list)
+    for chunk in _chunks(earliest):
+        since = min(earliest[key] for key in chunk) - SESSION_GAP
+        for row in db.session.execute(
+            db.select(ProductView.id, ProductView.history_key, ProductView.product_id, ProductView.viewed_at)
+            .where(ProductView.history_key.in_(chunk), ProductView.viewed_at >= since)
+        ):
+            context[row.history_key].append(tuple(row))
+    counts = session_pairs([tuple(v) for v in new_views], context)
+
+    affected = sorted({a for a, _ in counts})
+    summaries = {pid: SpaceSaving() for pid in affected}
+    for chunk in _chunks(affected):
+        for row in db.session.execute(
+            db.select(ProductCoviewCounter).where(ProductCoviewCounter.product_id.in_(chunk))
+        ).scalars():
+            summaries[row.product_id].counters[row.neighbor_id] = [row.count, row.error]
+    # add the largest increments first so heavy pairs are least likely to be evicted
+    for (a, b), count in sorted(counts.items(), key=lambda kv: -kv[1]):
+        summaries[a].add(b, count)
+
+    for chunk in _chunks(affected):
+        db.session.execute(db.delete(ProductCoviewCounter).where(ProductCoviewCounter.product_id.in_(chunk)))
+        db.session.execute(db.delete(ProductNeighbor).where(
+            ProductNeighbor.kind == KIND, ProductNeighbor.product_id.in_(chunk)
+        ))
+    counter_rows = [
+        {'product_id': pid, 'neighbor_id': nid, 'count': count, 'error': error}
+        for pid, summary in summaries.items()
+        for nid, (count, error) in summary.counters.items()
+    ]
+    neighbor_rows = [
+        {'kind': KIND, 'product_id': pid, 'rank': rank, 'neighbor_id': nid, 'score': float(score)}
+        for pid, summary in summaries.items()
+        for rank, (nid, score) in enumerate(summary.top(TOP_K))
+    ]
+    if counter_rows:
+        db.session.execute(ProductCoviewCounter.__table__.insert(), counter_rows)
+    if neighbor_rows:
+        db.session.execute(ProductNeighbor.__table__.insert(), neighbor_rows)
+
+    data['viewId'] = new_views[-1].id
+    state.data = data
+    db.session.commit()
+    print(f"[Coview] Processed {len(new_views)} view(s), updated {len(affected)} product(s)")
+    return len(new_views)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    os.environ.setdefault('ORDER_QUEUE_WORKER', '0')
+    os.environ.setdefault('BACKGROUND_JOBS', '0')
+    from app import create_app
+    from jobs import run_job
+
+    parser = argparse.ArgumentParser(description='Refresh viewers-also-viewed neighbours')
+    parser.add_argument('--full', action='store_true', help='rebuild from all recorded views')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.full:
+            run_job('coview', refresh, full=True)
+        # catch up in batches
+        while run_job('coview', refresh):
+            pass
@@ -0,0 +1,280 @@
+"""
+Customer Analytics
+Per-user aggregates (order count, lifetime spend, first and last order) and
+monthly activity are maintained alongside the sales rollups, so they count
+the same orders: placing an order adds it, cancelling or refunding it
+subtracts it. When an order stops counting, the customer's first/last order
+dates are re-read from their remaining orders (ix_orders_user_id_created_at).
+
+The 'customer_analytics' job scores every customer on recency, frequency
+and monetary value (quintiles, 1-5), assigns RFM segments and builds the
+monthly cohort retention matrix, all vectorised over the aggregates, and
+stores the result in analytics_results for the dashboard to read as-is.
+
+Rebuild the aggregates from the orders table with:  python customers.py --backfill
+"""
+
+from collections import defaultdict
+from datetime import date, datetime
+import numpy as np
+from extensions import db
+from counters import increment_row
+
+RESULT_NAME = 'customers'
+REFRESH_SECONDS = 3600
+COHORT_MONTHS = 12
+TOP_CUSTOMERS = 10
+
+# (segment, rule on recency/frequency scores), first match wins
+SEGMENTS = [
+    ('champions', lambda r, f: (r >= 4) & (f >= 4)),
+    ('loyal', lambda r, f: (r >= 3) & (f >= 4)),
+    ('new', lambda r, f: (r >= 4) & (f <= 1)),
+    ('potential_loyalists', lambda r, f: (r >= 4) & (f <= 3)),
+    ('at_risk', lambda r, f: (r <= 2) & (f >= 3)),
+    ('hibernating', lambda r, f: (r <= 2) & (f <= 2)),
+    ('needs_attention', lambda r, f: np.ones_like(r, dtype=bool)),
+]
+
+
+def _month(when):
+    return when.date().replace(day=1)
+
+
+def record_order(order, sign):
+    """Add (sign=1) or subtract (sign=-1) an order to its customer's aggregates (see rollups.apply_order)"""
+    from models import CustomerStats, CustomerMonthlyActivity
+    if not order.user_id:
+        return  # guest checkout
+    placed_at = order.created_at or datetime.utcnow()
+    total = float(order.total or 0)
+    increment_row(
+        CustomerStats, {'user_id': order.user_id},
+        {'order_count': sign, 'lifetime_spend': sign * total},
+        initial={'first_order_at': placed_at, 'last_order_at': placed_at},
+    )
+    table = CustomerStats.__table__
+    if sign < 0:
+        from models import Order
+        from rollups import VOID_STATUSES
+        first, last = db.session.query(db.func.min(Order.created_at), db.func.max(Order.created_at)).filter(
+            Order.user_id == order.user_id,
+            Order.id != order.id,
+            Order.status.notin_(VOID_STATUSES),
+        ).one()
+        db.session.execute(
+            table.update().where(table.c.user_id == order.user_id)
+            .values(first_order_at=first, last_order_at=last)
+        )
+    else:
+        db.session.execute(
+            table.update().where(table.c.user_id == order.user_id).values(
+                first_order_at=db.case(
+                    (db.or_(table.c.first_order_at.is_(None), table.c.first_order_at > placed_at), placed_at),
+                    else_=table.c.first_order_at,
+                ),
+                last_order_at=db.case(
+                    (db.or_(table.c.last_order_at.is_(None), table.c.last_order_at < placed_at), placed_at),
+                    else_=table.c.last_order_at,
+                ),
+            )
+        )
+    increment_row(
+        CustomerMonthlyActivity, {'user_id': order.user_id, 'month': _month(placed_at)},
+        {'orders': sign, 'spend': sign * total},
+    )
+
+
+def score_quintiles(values):
+    """1-5 score per value by rank (ties share the lower rank)"""
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return np.zeros(0, dtype=np.int64)
+    ranks = np.searchsorted(np.sort(values), values, side='left')
+    return 1 + (ranks * 5) // len(values)
+
+
+def rfm(recency_days, frequency, monetary):
+    """(r, f, m scores, segment names) for parallel arrays; lower recency scores higher"""
+    r = 6 - score_quintiles(recency_days)
+    f = score_quintiles(frequency)
+    m = score_quintiles(monetary)
+    segments = np.empty(len(r), dtype=object)
+    unassigned = np.ones(len(r), dtype=bool)
+    for name, rule in SEGMENTS:
+        hit = unassigned & rule(r, f)
+        segments[hit] = name
+        unassigned &= ~hit
+    return r, f, m, segments
+
+
+def cohort_matrix(cohort_month, active_user, active_month, months=COHORT_MONTHS):
+    """Retention per cohort: {cohorts: [...], sizes: [...], retention: [[share active k months later]]}.
+    `cohort_month` maps user index -> month number of the first order;
+    active_user/active_month list (user index, month number) pairs with orders.
+    """
+    cohorts, cohort_idx = np.unique(cohort_month, return_inverse=True)
+    sizes = np.bincount(cohort_idx, minlength=len(cohorts))
+    offset = active_month - cohort_month[active_user]
+    keep = (offset >= 0) & (offset < months)
+    counts = np.zeros((len(cohorts), months), dtype=np.int64)
+    np.add.at(counts, (cohort_idx[active_user[keep]], offset[keep]), 1)
+    retention = counts / np.maximum(sizes, 1)[:, None]
+    return cohorts, sizes, retention
+
+
+def _month_number(day):
+    return day.year * 12 + day.month - 1
+
+
+def refresh(state):
+    """Score customers and rebuild the cohort matrix. Returns the number of customers scored."""
+    from models import CustomerStats, CustomerMonthlyActivity, AnalyticsResult, User
+    now = datetime.utcnow()
+    rows = db.session.execute(
+        db.select(CustomerStats.user_id, CustomerStats.order_count, CustomerStats.lifetime_spend,
+                  CustomerStats.first_order_at, CustomerStats.last_order_at)
+        .where(CustomerStats.order_count > 0)
+    ).all()
+
+    result = {'customers': len(rows), 'segments': {}, 'cohorts': [], 'topCustomers': []}
+    if rows:
+        user_ids = np.array([row.user_id for row in rows], dtype=np.int64)
+        frequency = np.array([row.order_count for row in rows], dtype=np.float64)
+        monetary = np.array([row.lifetime_spend for row in rows], dtype=np.float64)
+        recency = np.array([(now - row.last_order_at).total_seconds() / 86400 for row in rows])
+        r, f, m, segments = rfm(recency, frequency, monetary)
+
+        table = CustomerStats.__table__
+        db.session.execute(
+            table.update().where(table.c.user_id == db.bindparam('key')).values(
+                r_score=db.bindparam('r'), f_score=db.bindparam('f'),
+                m_score=db.bindparam('m'), segment=db.bindparam('segment'),
+            ),
+            [
+                {'key': int(uid), 'r': int(rs), 'f': int(fs), 'm': int(ms), 'segment': seg}
+                for uid, rs, fs, ms, seg in zip(user_ids, r, f, m, segments)
+            ],
+        )
+        for name, _ in SEGMENTS:
+            mask = segments == name
+            if mask.any():
+                result['segments'][name] = {
+                    'customers': int(mask.sum()),
+                    'avgSpend': round(float(monetary[mask].mean()), 2),
+                    'avgOrders': round(float(frequency[mask].mean()), 2),
+                }
+        result['avgLifetimeValue'] = round(float(monetary.mean()), 2)
+        result['repeatRate'] = round(float((frequency > 1).mean() * 100), 1)
+
+        top = np.argsort(-monetary)[:TOP_CUSTOMERS]
+        names = dict(db.session.query(User.id, User.name).filter(User.id.in_(user_ids[top].tolist())))
+        result['topCustomers'] = [
+            {'userId': int(user_ids[i]), 'name': names.get(int(user_ids[i])),
+             'orders': int(frequency[i]), 'lifetimeSpend': round(float(monetary[i]), 2)}
+            for i in top
+        ]
+
+        # new customers (first order) in the last 30 days vs the 30 before
+        first_age = np.array([(now - row.first_order_at).total_seconds() / 86400 for row in rows])
+        recent, previous = int((first_age < 30).sum()), int(((first_age >= 30) & (first_age < 60)).sum())
+        result['newCustomers'] = recent
+        result['newCustomersChange'] = round((recent - previous) / previous * 100, 1) if previous else 0
+
+        # cohort retention over the last COHORT_MONTHS cohorts
+        index = {int(uid): i for i, uid in enumerate(user_ids)}
+        cohort_month = np.array([_month_number(row.first_order_at) for row in rows], dtype=np.int64)
+        first_cohort = _month_number(now.date()) - (COHORT_MONTHS - 1)
+        since = date(first_cohort // 12, first_cohort % 12 + 1, 1)
+        activity = db.session.execute(
+            db.select(CustomerMonthlyActivity.user_id, CustomerMonthlyActivity.month)
+            .where(CustomerMonthlyActivity.orders > 0, CustomerMonthlyActivity.month >= since)
+        ).all()
+        active = [(index[uid], _month_number(month)) for uid, month in activity if uid in index]
+        in_window = cohort_month >= _month_number(since)
+        if active and in_window.any():
+            active_user = np.array([u for u, _ in active], dtype=np.int64)
+            active_month = np.array([mo for _, mo in active], dtype=np.int64)
+            keep = in_window[active_user]
+            window_users = np.flatnonzero(in_window)
+            remap = np.full(len(rows), -1, dtype=np.int64)
+            remap[window_users] = np.arange(len(window_users))
+            cohorts, sizes, retention = cohort_matrix(
+                cohort_month[window_users], remap[active_user[keep]], active_month[keep]
+            )
+            result['cohorts'] = [
+                {
+                    'cohort': f"{int(c) // 12:04d}-{int(c) % 12 + 1:02d}",
+                    'size': int(size),
+                    'retention': [round(float(x) * 100, 1) for x in ret[:_month_number(now.date()) - int(c) + 1]],
+                }
+                for c, size, ret in zip(cohorts, sizes, retention)
+            ]
+
+    stored = db.session.get(AnalyticsResult, RESULT_NAME)
+    if stored:
+        stored.data, stored.computed_at = result, now
+    else:
+        db.session.add(AnalyticsResult(name=RESULT_NAME, data=result, computed_at=now))
+    db.session.commit()
+    print(f"[Customers] Scored {len(rows)} customer(s)")
+    return len(rows)
+
+
+def backfill(chunk_size=1000):
+    """Rebuild customer_stats and customer_activity_monthly from the orders table"""
+    from models import Order, CustomerStats, CustomerMonthlyActivity
+    from rollups import VOID_STATUSES
+    stats = {}
+    monthly = defaultdict(lambda: {'orders': 0, 'spend': 0.0})
+    query = (
+        db.select(Order.user_id, Order.created_at, Order.total)
+        .where(Order.user_id.isnot(None), Order.status.notin_(VOID_STATUSES))
+        .execution_options(yield_per=chunk_size)
+    )
+    for user_id, created_at, total in db.session.execute(query):
+        created_at = created_at or datetime.utcnow()
+        row = stats.setdefault(user_id, {
+            'order_count': 0, 'lifetime_spend': 0.0, 'first_order_at': created_at, 'last_order_at': created_at,
+        })
+        row['order_count'] += 1
+        row['lifetime_spend'] += float(total or 0)
+        row['first_order_at'] = min(row['first_order_at'], created_at)
+        row['last_order_at'] = max(row['last_order_at'], created_at)
+        month = monthly[(user_id, _month(created_at))]
+        month['orders'] += 1
+        month['spend'] += float(total or 0)
+
+    db.session.execute(db.delete(CustomerStats))
+    db.session.execute(db.delete(CustomerMonthlyActivity))
+    if stats:
+        db.session.execute(CustomerStats.__table__.insert(), [
+            {'user_id': user_id, **values} for user_id, values in stats.items()
+        ])
+    if monthly:
+        db.session.execute(CustomerMonthlyActivity.__table__.insert(), [
+            {'user_id': user_id, 'month': month, **values} for (user_id, month), values in monthly.items()
+        ])
+    db.session.commit()
+    return len(stats)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    os.environ.setdefault('ORDER_QUEUE_WORKER', '0')
+    os.environ.setdefault('BACKGROUND_JOBS', '0')
+    from app import create_app
+    from jobs import run_job
+
+    parser = argparse.ArgumentParser(description='Customer aggregates and RFM / cohort analytics')
+    parser.add_argument('--backfill', action='store_true', help='rebuild the per-customer aggregates from all orders')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.backfill:
+            print("Rebuilding customer aggregates...")
+            print(f"✓ Aggregated {backfill()} customers")
+        if run_job('customer_analytics', refresh) is None:
+            print("Another process is running the customer analytics job; try again later.")
@@ -0,0 +1,186 @@
+"""
+Order Event Hub
+In-process publish/subscribe for order status changes, used by the
+Server-Sent Events endpoints instead of clients polling GET /orders/<id>.
+
+Events are published after commit by order_transitions. Event ids are the
+OrderEvent row ids, so a reconnecting client's Last-Event-ID can be replayed
+from the order_events table. Changes committed by other processes are picked
+up by a single tail query per process while anyone is subscribed.
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from flask import Response, stream_with_context
+from extensions import db
+
+HEARTBEAT_SECONDS = 15
+RETRY_MILLISECONDS = 3000
+TAIL_INTERVAL_SECONDS = 2
+
+
+class Subscription:
+    """A subscriber's filter and pending events"""
+
+    def __init__(self, order_id=None, user_id=None, max_pending=100):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.events = queue.Queue(maxsize=max_pending)
+
+    def matches(self, event):
+        if self.order_id is not None and event['orderId'] != self.order_id:
+            return False
+        if self.user_id is not None and event['userId'] != self.user_id:
+            return False
+        return True
+
+
+class OrderEventHub:
+    """
+    Fans order status events out to subscriptions.
+    """
+
+    def __init__(self, app=None, seen_size=5000):
+        self.app = app
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._seen = OrderedDict()  # recently published event ids (dedupe local vs tailed)
+        self._seen_size = seen_size
+        self._last_tailed_id = None
+        self._tail_thread = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def publish(self, event):
+        """Deliver an event dict (id, orderId, userId, status, fromStatus, at) to matching subscribers"""
+        with self._lock:
+            if event['id'] in self._seen:
+                return
+            self._seen[event['id']] = True
+            while len(self._seen) > self._seen_size:
+                self._seen.popitem(last=False)
+            subscribers = list(self._subscribers)
+
+        for sub in subscribers:
+            if sub.matches(event):
+                try:
+                    sub.events.put_nowait(event)
+                except queue.Full:
+                    pass  # slow client; it can catch up via Last-Event-ID on reconnect
+
+    def subscribe(self, order_id=None, user_id=None):
+        sub = Subscription(order_id=order_id, user_id=user_id)
+        with self._lock:
+            self._subscribers.add(sub)
+            if self.app and self._tail_thread is None:
+                self._tail_thread = threading.Thread(target=self._tail_events, daemon=True)
+                self._tail_thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def _tail_events(self):
+        """Publish order_events committed by other processes (runs while there are subscribers)"""
+        from models import Order, OrderEvent
+        with self.app.app_context():
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        self._tail_thread = None
+                        self._last_tailed_id = None
+                        return
+                try:
+                    if self._last_tailed_id is None:
+                        self._last_tailed_id = db.session.query(db.func.max(OrderEvent.id)).scalar() or 0
+                    rows = (
+                        db.session.query(OrderEvent, Order.user_id)
+                        .outerjoin(Order, Order.id == OrderEvent.order_id)
+                        .filter(OrderEvent.id > self._last_tailed_id)
+                        .order_by(OrderEvent.id)
+                        .limit(500)
+                        .all()
+                    )
+                    for order_event, user_id in rows:
+                        self.publish(event_from_row(order_event, user_id))
+                        self._last_tailed_id = order_event.id
+                except Exception as e:
+                    print(f"[EventHub] Error tailing order events: {e}")
+                finally:
+                    db.session.remove()
+                time.sleep(TAIL_INTERVAL_SECONDS)
+
+
+def event_from_row(order_event, user_id):
+    return {
+        'id': order_event.id,
+        'orderId': order_event.order_id,
+        'userId': user_id,
+        'status': order_event.to_status,
+        'fromStatus': order_event.from_status,
+        'at': order_event.created_at.isoformat() if order_event.created_at else None,
+    }
+
+
+def _format(event, event_type='status'):
+    payload = {k: v for k, v in event.items() if k != 'userId'}
+    lines = []
+    if event.get('id') is not None:
+        lines.append(f"id: {event['id']}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(payload)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream_response(sub, initial_events=()):
+    """Build a text/event-stream Response for a subscription.
+    `initial_events` (a snapshot or Last-Event-ID replay) are sent first.
+    """
+    # Release the DB connection; the stream may stay open for a long time
+    db.session.remove()
+
+    def generate():
+        try:
+            yield f"retry: {RETRY_MILLISECONDS}\n\n"
+            sent = set()
+            for event in initial_events:
+                sent.add(event.get('id'))
+                yield _format(event)
+            while True:
+                try:
+                    event = sub.events.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if event['id'] in sent:
+                    continue  # already sent as part of the replay
+                yield _format(event)
+        finally:
+            order_event_hub.unsubscribe(sub)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+def last_event_id(request):
+    """Last-Event-ID from the reconnect header (or ?lastEventId= for manual reconnects)"""
+    value = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+# Global instance
+order_event_hub = OrderEventHub()
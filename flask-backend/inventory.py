@@ -0,0 +1,55 @@
+"""
+Inventory Events
+Stock changes recorded during a transaction are handed to listeners after
+commit (and dropped on rollback), the same way order_transitions publishes
+status changes. In-memory caches that depend on stock register a listener
+with @on_stock_change.
+"""
+
+from sqlalchemy import event
+from extensions import db
+
+_PENDING_KEY = 'stock_changes'
+_listeners = []
+
+
+def on_stock_change(fn):
+    """Register fn(changes) to run after each commit that changed stock.
+    Each change is {'product_id', 'before', 'after', 'event'}; before/after are None when
+    not known, event is 'created' or 'deleted' for product creation/deletion (else None).
+    """
+    _listeners.append(fn)
+    return fn
+
+
+def stock_changed(product_id, before=None, after=None, event=None):
+    """Record a stock change made in the current transaction"""
+    db.session.info.setdefault(_PENDING_KEY, []).append(
+        {'product_id': str(product_id), 'before': before, 'after': after, 'event': event}
+    )
+
+
+def availability_changed(change):
+    """Whether a change may have moved the product in or out of stock"""
+    before, after = change['before'], change['after']
+    if before is None or after is None:
+        return True
+    return (before > 0) != (after > 0)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop(_PENDING_KEY, None)
+    if not changes:
+        return
+    for listener in _listeners:
+        try:
+            listener(changes)
+        except Exception as e:
+            print(f"[Inventory] Stock change listener failed: {e}")
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    if not session.in_transaction():
+        session.info.pop(_PENDING_KEY, None)
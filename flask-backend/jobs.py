@@ -0,0 +1,126 @@
+"""
+Background Jobs
+Periodic jobs run in a daemon thread of every process; a lease on the job's
+job_state row makes sure only one process runs a given job at a time
+(same idea as the order queue's order_schedule leases).
+Set BACKGROUND_JOBS=0 to not run jobs in a process.
+"""
+
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def acquire_lease(name, seconds=600):
+    """Try to lease job `name` to this process. Returns the JobState row or None."""
+    from models import JobState
+    now = datetime.utcnow()
+    if not db.session.get(JobState, name):
+        try:
+            with db.session.begin_nested():
+                db.session.add(JobState(name=name, data={}))
+        except IntegrityError:
+            pass  # created concurrently
+    result = db.session.execute(
+        db.update(JobState)
+        .where(
+            JobState.name == name,
+            db.or_(
+                JobState.lease_expires_at.is_(None),
+                JobState.lease_expires_at < now,
+                JobState.lease_owner == WORKER_ID,
+            ),
+        )
+        .values(lease_owner=WORKER_ID, lease_expires_at=now + timedelta(seconds=seconds))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    if not result.rowcount:
+        return None
+    return db.session.get(JobState, name, populate_existing=True)
+
+
+def release_lease(state, error=None):
+    """Record the run and release the lease (commits)"""
+    state.lease_owner = None
+    state.lease_expires_at = None
+    state.last_run_at = datetime.utcnow()
+    state.last_error = str(error) if error else None
+    db.session.commit()
+
+
+def run_job(name, fn, lease_seconds=600, **kwargs):
+    """Run fn(state, **kwargs) under the job's lease. Returns fn's result, or None if leased elsewhere."""
+    from models import JobState
+    state = acquire_lease(name, lease_seconds)
+    if state is None:
+        return None
+    try:
+        result = fn(state, **kwargs)
+    except Exception as e:
+        db.session.rollback()
+        release_lease(db.session.get(JobState, name), e)
+        raise
+    release_lease(state)
+    return result
+
+
+class JobRunner:
+    """
+    Runs registered jobs every `interval` seconds in one background thread.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self.jobs = []  # [name, interval, fn, kwargs, next_run]
+        self.running = False
+        self._thread = None
+        self._wake = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+
+    def register(self, name, interval, fn, **kwargs):
+        """Run fn(state, **kwargs) every `interval` seconds (re-registering a name replaces it)"""
+        self.jobs = [job for job in self.jobs if job[0] != name]
+        self.jobs.append([name, interval, fn, kwargs, time.monotonic() + interval])
+
+    def start(self):
+        if self.running or not self.app:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def _run(self):
+        while self.running:
+            now = time.monotonic()
+            for job in self.jobs:
+                name, interval, fn, kwargs, next_run = job
+                if next_run > now:
+                    continue
+                job[4] = now + interval
+                with self.app.app_context():
+                    try:
+                        run_job(name, fn, **kwargs)
+                    except Exception as e:
+                        print(f"[Jobs] {name} failed: {e}")
+                    finally:
+                        db.session.remove()
+            delay = min((job[4] for job in self.jobs), default=now + 60) - time.monotonic()
+            self._wake.wait(max(delay, 1))
+
+
+# Global instance
+job_runner = JobRunner()
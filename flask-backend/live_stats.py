@@ -0,0 +1,202 @@
+"""
+Live Admin Stats
+In-memory counters behind GET /admin/stats: products, orders placed today,
+revenue, and the low-stock products (materialised, not just counted).
+
+Counters are seeded from the database at startup and kept current by the
+writes made in this process: placed/cancelled/refunded orders arrive through
+rollups.apply_order and stock changes through inventory. Both are applied
+after commit. Writes made by other processes are picked up by a reseed every
+RESEED_SECONDS, which runs in the background while the current counters keep
+being served.
+
+Like the rollups, orders and revenue exclude cancelled and refunded orders.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from extensions import db
+from inventory import on_stock_change
+
+LOW_STOCK_THRESHOLD = 10
+RESEED_SECONDS = int(os.environ.get('LIVE_STATS_RESEED_SECONDS', 300))
+
+_PENDING_KEY = 'live_stats_orders'
+
+
+class LiveStats:
+    """
+    Counters for the admin dashboard, read without touching the database.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self._lock = threading.Lock()
+        self.total_products = 0
+        self.revenue = 0.0
+        self.orders_by_day = {}  # date -> orders placed that day (today and yesterday are kept)
+        self.low_stock = {}  # product_id -> {'id', 'name', 'stock'}
+        self._stale_products = set()  # stock changed but the new level isn't known yet
+        self.seeded_at = None
+        self._reseeding = False
+        self._replay = None  # changes applied while seed() reads the database
+
+    def init_app(self, app):
+        self.app = app
+
+    def seed(self):
+        """Recompute every counter from the database (call inside an app context).
+        Changes that arrive while the queries run are recorded and replayed on top
+        of the result instead of being overwritten by it (only a change committed
+        just before a query, whose after-commit hook runs just after, can count twice).
+        """
+        with self._lock:
+            self._replay = []
+        try:
+            counters = self._read_counters()
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+        with self._lock:
+            self.total_products, self.revenue, self.orders_by_day, self.low_stock = counters
+            self._stale_products.clear()
+            replay, self._replay = self._replay, None
+            for apply, args in replay:
+                apply(*args)
+            self.seeded_at = time.monotonic()
+
+    def _read_counters(self):
+        from models import Order, Product
+        from rollups import VOID_STATUSES
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        total_products = db.session.query(db.func.count(Product.id)).scalar() or 0
+        revenue = db.session.query(db.func.coalesce(db.func.sum(Order.total), 0)).filter(
+            Order.status.notin_(VOID_STATUSES)
+        ).scalar()
+        # a range on created_at (not date(created_at) = ...) so the index is used
+        orders_today = db.session.query(db.func.count(Order.id)).filter(
+            Order.created_at >= today,
+            Order.created_at < today + timedelta(days=1),
+            Order.status.notin_(VOID_STATUSES)
+        ).scalar() or 0
+        low_stock = {
+            product_id: {'id': product_id, 'name': name, 'stock': stock}
+            for product_id, name, stock in db.session.query(Product.id, Product.name, Product.stock)
+            .filter(Product.stock < LOW_STOCK_THRESHOLD)
+        }
+        return total_products, float(revenue or 0), {today.date(): orders_today}, low_stock
+
+    def _reseed_in_background(self):
+        try:
+            with self.app.app_context():
+                try:
+                    self.seed()
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            print(f"[LiveStats] Reseed failed: {e}")
+        finally:
+            self._reseeding = False
+
+    def record_order(self, day, total, sign):
+        """An order placed on `day` started (sign=1) or stopped (sign=-1) counting as a sale"""
+        with self._lock:
+            self._apply_order(day, total, sign)
+            if self._replay is not None:
+                self._replay.append((self._apply_order, (day, total, sign)))
+
+    def _apply_order(self, day, total, sign):
+        self.revenue += sign * total
+        self.orders_by_day[day] = self.orders_by_day.get(day, 0) + sign
+        if len(self.orders_by_day) > 2:
+            for old in sorted(self.orders_by_day)[:-2]:
+                del self.orders_by_day[old]
+
+    def record_stock_changes(self, changes):
+        with self._lock:
+            self._apply_stock_changes(changes)
+            if self._replay is not None:
+                self._replay.append((self._apply_stock_changes, (changes,)))
+
+    def _apply_stock_changes(self, changes):
+        for change in changes:
+            product_id, after = change['product_id'], change['after']
+            if change.get('event') == 'created':
+                self.total_products += 1
+            elif change.get('event') == 'deleted':
+                self.total_products -= 1
+                self.low_stock.pop(product_id, None)
+                self._stale_products.discard(product_id)
+                continue
+            if after is not None and after >= LOW_STOCK_THRESHOLD:
+                self.low_stock.pop(product_id, None)
+            elif after is not None and product_id in self.low_stock:
+                self.low_stock[product_id]['stock'] = after
+            else:
+                self._stale_products.add(product_id)  # newly low, or level unknown
+
+    def _refresh_stale(self):
+        from models import Product
+        with self._lock:
+            stale = list(self._stale_products)
+        if not stale:
+            return
+        rows = db.session.query(Product.id, Product.name, Product.stock).filter(Product.id.in_(stale)).all()
+        with self._lock:
+            for product_id in stale:
+                self._stale_products.discard(product_id)
+                self.low_stock.pop(product_id, None)
+            for product_id, name, stock in rows:
+                if stock < LOW_STOCK_THRESHOLD:
+                    self.low_stock[product_id] = {'id': product_id, 'name': name, 'stock': stock}
+
+    def snapshot(self):
+        """Current counters; reseeds in the background when older than RESEED_SECONDS"""
+        if self.seeded_at is None:
+            self.seed()
+        elif time.monotonic() - self.seeded_at > RESEED_SECONDS and self.app and not self._reseeding:
+            self._reseeding = True
+            threading.Thread(target=self._reseed_in_background, daemon=True).start()
+        # products whose new stock level wasn't known at commit (e.g. restocks); usually none
+        self._refresh_stale()
+        today = datetime.utcnow().date()
+        with self._lock:
+            low_stock = sorted(self.low_stock.values(), key=lambda p: (p['stock'], p['name'] or ''))
+            return {
+                'totalProducts': self.total_products,
+                'ordersToday': self.orders_by_day.get(today, 0),
+                'revenue': round(self.revenue, 2),
+                'lowStock': len(low_stock),
+                'lowStockProducts': [dict(p) for p in low_stock],
+            }
+
+
+def record_order(order, sign):
+    """Queue an order's effect on the counters until the transaction commits (see rollups.apply_order)"""
+    day = (order.created_at or datetime.utcnow()).date()
+    db.session.info.setdefault(_PENDING_KEY, []).append((day, float(order.total or 0), sign))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _after_commit(session):
+    for day, total, sign in session.info.pop(_PENDING_KEY, []):
+        live_stats.record_order(day, total, sign)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    if not session.in_transaction():
+        session.info.pop(_PENDING_KEY, None)
+
+
+@on_stock_change
+def _on_stock_change(changes):
+    live_stats.record_stock_changes(changes)
+
+
+# Global instance
+live_stats = LiveStats()
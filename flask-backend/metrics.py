@@ -0,0 +1,81 @@
+"""
+Lightweight in-process metrics (counters and fixed-bucket histograms)
+with JSON snapshots and Prometheus text exposition.
+"""
+
+import bisect
+import threading
+import time
+from collections import deque
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 3600)
+
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus style)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.total += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            cumulative, running = [], 0
+            for upper, n in zip(self.buckets + (float('inf'),), self.counts):
+                running += n
+                cumulative.append((upper, running))
+            return {'buckets': cumulative, 'sum': self.total, 'count': self.count}
+
+
+class RateWindow:
+    """Events per window (default: the last 60 seconds)"""
+
+    def __init__(self, window_seconds=60):
+        self.window = window_seconds
+        self._events = deque()  # (timestamp, n)
+        self._lock = threading.Lock()
+
+    def add(self, n=1):
+        with self._lock:
+            self._events.append((time.monotonic(), n))
+            self._trim()
+
+    def total(self):
+        with self._lock:
+            self._trim()
+            return sum(n for _, n in self._events)
+
+    def _trim(self):
+        cutoff = time.monotonic() - self.window
+        while self._events and self._events[0][0] < cutoff:
+            self._events.popleft()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+def prometheus_lines(name, kind, help_text, samples):
+    """Render one metric family. `samples` is [(labels dict, value or histogram snapshot)]"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        if kind == 'histogram':
+            for upper, count in value['buckets']:
+                le = '+Inf' if upper == float('inf') else repr(upper)
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {value['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {value['count']}")
+        else:
+            lines.append(f"{name}{_labels(labels)} {value}")
+    return lines
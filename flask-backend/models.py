@@ -86,6 +86,14 @@ class CartItem(db.Model):
 
 class Order(db.Model):
     __tablename__ = 'orders'
+    # Composite indexes backing the admin order search (keyset on created_at, id)
+    __table_args__ = (
+        db.Index('ix_orders_created_at_id', 'created_at', 'id'),
+        db.Index('ix_orders_status_created_at', 'status', 'created_at'),
+        db.Index('ix_orders_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_orders_customer_email_created_at', 'customer_email', 'created_at'),
+        db.Index('ix_orders_payment_method_created_at', 'payment_method', 'created_at'),
+    )
     id = db.Column(db.String(64), primary_key=True, default=lambda: str(uuid.uuid4()))
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     # store customer information (useful for guest checkout and record keeping)
@@ -122,3 +130,247 @@ class Order(db.Model):
             'rating': self.rating,
             'createdAt': self.created_at.isoformat() if self.created_at else None,
         }
+
+    def to_summary_dict(self):
+        """Lightweight representation for list views (no items / shipping address)"""
+        return {
+            'id': self.id,
+            'userId': self.user_id,
+            'customerName': self.customer_name,
+            'customerEmail': self.customer_email,
+            'customerPhone': self.customer_phone,
+            'total': self.total,
+            'paymentMethod': self.payment_method,
+            'status': self.status,
+            'refundedAt': self.refunded_at.isoformat() if self.refunded_at else None,
+            'refundAmount': self.refund_amount,
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+        }
+
+
+class OrderEvent(db.Model):
+    """Append-only log of order status changes"""
+    __tablename__ = 'order_events'
+    __table_args__ = (
+        db.Index('ix_order_events_order_id_created_at', 'order_id', 'created_at'),
+        db.Index('ix_order_events_to_status_created_at', 'to_status', 'created_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    # no FK: the log outlives deleted orders
+    order_id = db.Column(db.String(64), nullable=False)
+    from_status = db.Column(db.String(32), nullable=True)
+    to_status = db.Column(db.String(32), nullable=False)
+    source = db.Column(db.String(32), nullable=True)  # checkout, customer, admin, queue
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'orderId': self.order_id,
+            'fromStatus': self.from_status,
+            'toStatus': self.to_status,
+            'source': self.source,
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+        }
+
+
+class ProductRating(db.Model):
+    """One rating per (user, order, product)"""
+    __tablename__ = 'product_ratings'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'order_id', 'product_id', name='uq_product_ratings_user_order_product'),
+        db.Index('ix_product_ratings_product_id_created_at', 'product_id', 'created_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    order_id = db.Column(db.String(64), nullable=False)
+    product_id = db.Column(db.String(64), nullable=False)
+    rating = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ProductRatingStats(db.Model):
+    """Rating aggregates per product, maintained with atomic increments"""
+    __tablename__ = 'product_rating_stats'
+    product_id = db.Column(db.String(64), primary_key=True)
+    rating_sum = db.Column(db.Float, nullable=False, default=0.0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    # histogram of ratings recorded in product_ratings
+    count_1 = db.Column(db.Integer, nullable=False, default=0)
+    count_2 = db.Column(db.Integer, nullable=False, default=0)
+    count_3 = db.Column(db.Integer, nullable=False, default=0)
+    count_4 = db.Column(db.Integer, nullable=False, default=0)
+    count_5 = db.Column(db.Integer, nullable=False, default=0)
+
+    def distribution(self):
+        return {str(i): getattr(self, f'count_{i}') for i in range(1, 6)}
+
+
+class ScheduledTransition(db.Model):
+    """Pending automatic status transition of an order (durable order queue state)"""
+    __tablename__ = 'order_schedule'
+    __table_args__ = (
+        db.Index('ix_order_schedule_due_at', 'due_at'),
+    )
+    order_id = db.Column(db.String(64), primary_key=True)
+    stage = db.Column(db.String(32), nullable=False)  # status the order must still be in
+    due_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # worker lease: the row is being transitioned by lease_owner until lease_expires_at
+    lease_owner = db.Column(db.String(128), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+
+
+class ProductView(db.Model):
+    """Product page view, written in bulk by the browsing event buffer"""
+    __tablename__ = 'product_views'
+    __table_args__ = (
+        db.Index('ix_product_views_history_key_viewed_at', 'history_key', 'viewed_at'),
+        db.Index('ix_product_views_product_id_viewed_at', 'product_id', 'viewed_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    history_key = db.Column(db.String(160), nullable=False)  # user_<id> or session_<id>
+    user_id = db.Column(db.Integer, nullable=True)
+    product_id = db.Column(db.String(64), nullable=False)
+    viewed_at = db.Column(db.DateTime, nullable=False)
+
+
+class JobState(db.Model):
+    """Progress and lease of a background job (see jobs.py)"""
+    __tablename__ = 'job_state'
+    name = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.JSON, nullable=True)  # job-specific cursor / counters
+    lease_owner = db.Column(db.String(128), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    last_run_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+
+class ProductNeighbor(db.Model):
+    """Precomputed top-k related products per product, one list per `kind`
+    (e.g. 'bought_together')"""
+    __tablename__ = 'product_neighbors'
+    kind = db.Column(db.String(32), primary_key=True)
+    product_id = db.Column(db.String(64), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    neighbor_id = db.Column(db.String(64), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+
+class ProductPairCount(db.Model):
+    """Number of orders containing both products (stored in both directions)"""
+    __tablename__ = 'product_pair_counts'
+    product_id = db.Column(db.String(64), primary_key=True)
+    other_id = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ProductOrderCount(db.Model):
+    """Number of orders containing a product"""
+    __tablename__ = 'product_order_counts'
+    product_id = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ProductChange(db.Model):
+    """Products written since the similarity index last processed them"""
+    __tablename__ = 'product_changes'
+    product_id = db.Column(db.String(64), primary_key=True)
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class ProductPopularity(db.Model):
+    """Blended popularity score per product (see popularity.py); sales and views are
+    exponentially decayed counts as of updated_at"""
+    __tablename__ = 'product_popularity'
+    product_id = db.Column(db.String(64), primary_key=True)
+    score = db.Column(db.Float, nullable=False, default=0, index=True)
+    recent_sales = db.Column(db.Float, nullable=False, default=0)
+    recent_views = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+
+class ProductCoviewCounter(db.Model):
+    """Space-Saving counters of products viewed in the same session as a product
+    (at most coview.CAPACITY per product; true count is in [count - error, count])"""
+    __tablename__ = 'product_coview_counters'
+    product_id = db.Column(db.String(64), primary_key=True)
+    neighbor_id = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.Float, nullable=False, default=0)
+    error = db.Column(db.Float, nullable=False, default=0)
+
+
+class DailySales(db.Model):
+    """Orders, revenue and units per day (UTC) of orders that are not cancelled or refunded"""
+    __tablename__ = 'sales_daily'
+    day = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+
+
+class DailyProductSales(db.Model):
+    """Units and revenue per product per day (see DailySales)"""
+    __tablename__ = 'sales_daily_products'
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.String(64), primary_key=True)
+    product_name = db.Column(db.String(255), nullable=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+
+class DailyCategorySales(db.Model):
+    """Units and revenue per category per day (see DailySales)"""
+    __tablename__ = 'sales_daily_categories'
+    day = db.Column(db.Date, primary_key=True)
+    category = db.Column(db.String(128), primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+
+class CustomerStats(db.Model):
+    """Per-user order aggregates (maintained with the sales rollups) and the
+    RFM scores last assigned by the customer analytics job"""
+    __tablename__ = 'customer_stats'
+    user_id = db.Column(db.Integer, primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    lifetime_spend = db.Column(db.Float, nullable=False, default=0)
+    first_order_at = db.Column(db.DateTime, nullable=True, index=True)
+    last_order_at = db.Column(db.DateTime, nullable=True)
+    r_score = db.Column(db.SmallInteger, nullable=True)
+    f_score = db.Column(db.SmallInteger, nullable=True)
+    m_score = db.Column(db.SmallInteger, nullable=True)
+    segment = db.Column(db.String(32), nullable=True, index=True)
+
+
+class CustomerMonthlyActivity(db.Model):
+    """Orders and spend per user per calendar month (first day of the month)"""
+    __tablename__ = 'customer_activity_monthly'
+    user_id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    spend = db.Column(db.Float, nullable=False, default=0)
+
+
+class AnalyticsResult(db.Model):
+    """Precomputed analytics payloads (e.g. 'customers'), read as-is by the dashboard"""
+    __tablename__ = 'analytics_results'
+    name = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.JSON, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+
+class QuantileSketch(db.Model):
+    """A serialised t-digest of one metric/key/day (see sketches.py); several rows per day until compacted"""
+    __tablename__ = 'quantile_sketches'
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(32), nullable=False)
+    key = db.Column(db.String(255), nullable=False, default='')
+    day = db.Column(db.Date, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    data = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_quantile_sketches_metric_day', 'metric', 'day', 'key'),
+    )
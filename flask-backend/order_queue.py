@@ -1,156 +1,370 @@
 """
 Order Processing Queue System
-Uses Python's queue.Queue data structure to manage order status progression.
+Schedules order status progression with a min-heap keyed by due time.
 Status flow: processing -> delivered -> received
+
+The worker sleeps on a condition variable until the earliest deadline (or
+until a new order is added), then moves every order that is due in one
+batched UPDATE. A dict index gives O(1) status lookups.
+
+Pending transitions are persisted in the order_schedule table (written by
+order_transitions in the same transaction as each status change), and the
+heap is rebuilt from it on startup so restarts don't lose work.
+
+Due rows are claimed through a lease (owner + expiry columns, plus
+SELECT ... FOR UPDATE SKIP LOCKED on PostgreSQL), so any number of
+processes can run the worker; the local heap only decides when to wake up.
+Set ORDER_QUEUE_WORKER=0 to not run a worker in a process.
 """
 
-import queue
+import heapq
+import itertools
+import os
+import socket
 import threading
 import time
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
 from extensions import db
-# Lazy import to avoid circular dependency
-# from models import Order
+from metrics import Histogram, RateWindow
+from order_transitions import set_orders_status_bulk
+
+# processing -> delivered after 24 hours (set ORDER_PROCESSING_SECONDS=10 for testing)
+PROCESSING_SECONDS = int(os.environ.get('ORDER_PROCESSING_SECONDS', 86400))
+# delivered -> received is confirmed manually by the customer unless this is set
+DELIVERY_AUTO_RECEIVE_SECONDS = os.environ.get('ORDER_AUTO_RECEIVE_SECONDS')
+
+# how often to look for work scheduled by other processes, and lease length
+POLL_SECONDS = int(os.environ.get('ORDER_QUEUE_POLL_SECONDS', 5))
+LEASE_SECONDS = 60
+CLAIM_BATCH_SIZE = 500
+
+# stage -> (next status, delay in seconds or None for no automatic transition)
+TRANSITIONS = {
+    'processing': ('delivered', PROCESSING_SECONDS),
+    'delivered': ('received', int(DELIVERY_AUTO_RECEIVE_SECONDS) if DELIVERY_AUTO_RECEIVE_SECONDS else None),
+}
+
+
+def _json_histogram(histogram):
+    snapshot = histogram.snapshot()
+    snapshot['buckets'] = [
+        {'le': '+Inf' if upper == float('inf') else upper, 'count': count}
+        for upper, count in snapshot['buckets']
+    ]
+    return snapshot
+
+
+class QueueMetrics:
+    """Counters and histograms describing this process's worker"""
+
+    def __init__(self):
+        self.transitions = {}  # (from, to) -> count
+        self.transition_rate = RateWindow(60)
+        self.commit_latency = {}  # (from, to) -> Histogram of batch transaction seconds
+        self.schedule_lag = {}  # (from, to) -> Histogram of seconds between due_at and transition
+        self.claims = 0
+        self.errors = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def record_batch(self, stage, next_status, moved, seconds, lags):
+        key = (stage, next_status)
+        with self._lock:
+            self.transitions[key] = self.transitions.get(key, 0) + moved
+            latency = self.commit_latency.setdefault(key, Histogram())
+            lag_histogram = self.schedule_lag.setdefault(key, Histogram())
+        self.transition_rate.add(moved)
+        latency.observe(seconds)
+        for lag in lags:
+            lag_histogram.observe(max(lag, 0.0))
+
+    def record_error(self, error):
+        with self._lock:
+            self.errors += 1
+            self.last_error = {'message': str(error), 'at': datetime.utcnow().isoformat()}
 
 
 class OrderProcessingQueue:
     """
-    Manages order processing using a Queue data structure.
+    Manages order processing using a due-time heap.
     Orders progress through: processing -> delivered -> received
     """
-    
+
     def __init__(self, app=None):
-        self.processing_queue = queue.Queue()
-        self.delivery_queue = queue.Queue()
-        self.completed_orders = {}  # order_id -> completion_time
+        self._heap = []  # (due_at, seq, order_id, stage)
+        self._index = {}  # order_id -> {'status', 'queued_at', 'due_at'}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
         self.worker_thread = None
         self.running = False
         self.app = app
-        
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.metrics = QueueMetrics()
+
     def init_app(self, app):
         """Initialize with Flask app context"""
         self.app = app
-        
+
     def start(self):
-        """Start the background worker thread"""
+        """Recover scheduled transitions and start the background worker thread"""
         if self.running:
             return
-        
+
+        if self.app:
+            try:
+                self.recover()
+            except Exception as e:
+                print(f"[OrderQueue] Error recovering scheduled transitions: {e}")
+
         self.running = True
         self.worker_thread = threading.Thread(target=self._process_orders, daemon=True)
         self.worker_thread.start()
         print("[OrderQueue] Order processing queue started")
-        
+
+    def recover(self, batch_size=1000):
+        """
+        Rebuild the heap from the order_schedule table.
+        Orders in a scheduled stage without a row (e.g. from before the table
+        existed) get one computed from their status and created_at.
+        """
+        from models import Order, ScheduledTransition
+        scheduled_stages = [stage for stage, (_, delay) in TRANSITIONS.items() if delay is not None]
+        with self.app.app_context():
+            backfilled = 0
+            while scheduled_stages:
+                missing = (
+                    db.session.query(Order.id, Order.status, Order.created_at)
+                    .outerjoin(ScheduledTransition, ScheduledTransition.order_id == Order.id)
+                    .filter(Order.status.in_(scheduled_stages), ScheduledTransition.order_id.is_(None))
+                    .limit(batch_size)
+                    .all()
+                )
+                if not missing:
+                    break
+                for order_id, status, created_at in missing:
+                    created_at = created_at or datetime.utcnow()
+                    delay = TRANSITIONS[status][1]
+                    if status == 'delivered':
+                        delay += PROCESSING_SECONDS
+                    db.session.add(ScheduledTransition(
+                        order_id=order_id,
+                        stage=status,
+                        due_at=created_at + timedelta(seconds=delay),
+                        created_at=created_at,
+                    ))
+                try:
+                    db.session.commit()
+                    backfilled += len(missing)
+                except IntegrityError:
+                    db.session.rollback()  # another process backfilled the same rows
+
+            rows = db.session.query(ScheduledTransition).all()
+            with self._cond:
+                self._heap = []
+                self._index = {}
+                for row in rows:
+                    self._index[row.order_id] = {'status': row.stage, 'queued_at': row.created_at, 'due_at': row.due_at}
+                    self._heap.append((row.due_at, next(self._seq), row.order_id, row.stage))
+                heapq.heapify(self._heap)
+                self._cond.notify()
+            db.session.remove()
+        print(f"[OrderQueue] Recovered {len(rows)} scheduled transition(s) ({backfilled} backfilled)")
+
     def stop(self):
         """Stop the background worker thread"""
-        self.running = False
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
         if self.worker_thread:
             self.worker_thread.join(timeout=2)
         print("[OrderQueue] Order processing queue stopped")
-        
-    def add_order(self, order_id):
+
+    def add_order(self, order_id, queued_at=None):
         """
-        Add a new order to the processing queue.
-        Order starts with 'processing' status.
+        Add an order to the in-memory processing heap.
+        Normally not needed: set_order_status() persists the schedule and the
+        commit hook calls sync_status().
         """
-        self.processing_queue.put({
-            'order_id': order_id,
-            'queued_at': datetime.utcnow(),
-            'status': 'processing'
-        })
+        queued_at = queued_at or datetime.utcnow()
+        with self._cond:
+            self._schedule(order_id, 'processing', queued_at)
         print(f"[OrderQueue] Order {order_id} added to processing queue")
-        
+
     def get_order_status(self, order_id):
         """
-        Get current status of an order based on which queue it's in.
+        Get current status of an order from the index.
         Returns: 'processing', 'delivered', or 'received'
         """
-        # Check if order is completed
-        if order_id in self.completed_orders:
-            return 'received'
-        
-        # Check delivery queue
-        delivery_items = list(self.delivery_queue.queue)
-        for item in delivery_items:
-            if item['order_id'] == order_id:
-                return 'delivered'
-        
-        # Check processing queue
-        processing_items = list(self.processing_queue.queue)
-        for item in processing_items:
-            if item['order_id'] == order_id:
-                return 'processing'
-        
+        state = self._index.get(order_id)
         # Default to processing if not found
-        return 'processing'
-        
+        return state['status'] if state else 'processing'
+
+    def sync_status(self, order_id, status, at=None):
+        """Mirror a committed status change (and its order_schedule row) into the heap"""
+        with self._cond:
+            state = self._index.get(order_id)
+            if state is not None and state['status'] == status:
+                return
+            if status in TRANSITIONS:
+                self._schedule(order_id, status, at or datetime.utcnow())
+            elif state is not None:
+                # received, cancelled, refunded...: nothing left to schedule
+                del self._index[order_id]
+
+    def stats(self):
+        """Queue depth and lag per stage (from order_schedule) plus this worker's metrics.
+        Must be called inside an app context.
+        """
+        from models import ScheduledTransition as ST
+        now = datetime.utcnow()
+        rows = db.session.execute(
+            db.select(
+                ST.stage,
+                db.func.count(),
+                db.func.min(ST.due_at),
+                db.func.sum(db.case((ST.due_at <= now, 1), else_=0)),
+                db.func.sum(db.case((ST.lease_expires_at > now, 1), else_=0)),
+            ).group_by(ST.stage)
+        ).all()
+        stages = {}
+        for stage, depth, oldest_due, due, leased in rows:
+            stages[stage] = {
+                'depth': depth,
+                'due': int(due or 0),
+                'leased': int(leased or 0),
+                # how far behind the oldest due-but-unprocessed transition is
+                'lagSeconds': max((now - oldest_due).total_seconds(), 0.0) if oldest_due and oldest_due <= now else 0.0,
+                'nextDueAt': oldest_due.isoformat() if oldest_due else None,
+            }
+
+        m = self.metrics
+        return {
+            'workerId': self.worker_id,
+            'running': self.running,
+            'stages': stages,
+            'transitionsPerMinute': m.transition_rate.total(),
+            'transitions': {f'{a}->{b}': n for (a, b), n in m.transitions.items()},
+            'claims': m.claims,
+            'errors': m.errors,
+            'lastError': m.last_error,
+            'commitLatency': {f'{a}->{b}': _json_histogram(h) for (a, b), h in m.commit_latency.items()},
+            'scheduleLag': {f'{a}->{b}': _json_histogram(h) for (a, b), h in m.schedule_lag.items()},
+        }
+
+    def _schedule(self, order_id, stage, since):
+        """Index the order at `stage` and push its next deadline (caller holds the lock)"""
+        _, delay = TRANSITIONS[stage]
+        due_at = since + timedelta(seconds=delay) if delay is not None else None
+        self._index[order_id] = {'status': stage, 'queued_at': since, 'due_at': due_at}
+        if due_at is not None:
+            heapq.heappush(self._heap, (due_at, next(self._seq), order_id, stage))
+            if self._heap[0][2] == order_id:
+                self._cond.notify()
+
+    def _wait_for_work(self):
+        """Sleep until the earliest local deadline (at most POLL_SECONDS), dropping due heap entries"""
+        with self._cond:
+            now = datetime.utcnow()
+            if not self._heap or self._heap[0][0] > now:
+                timeout = POLL_SECONDS
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                self._cond.wait(timeout)
+            now = datetime.utcnow()
+            while self._heap and self._heap[0][0] <= now:
+                heapq.heappop(self._heap)  # the database claim below picks these up
+
     def _process_orders(self):
         """
-        Background worker that processes orders through the queues.
+        Background worker that processes orders through the stages.
         Processing -> (24h) -> Delivered -> (manual confirmation) -> Received
-        Note: For testing, change times to smaller values (e.g., 10 seconds)
         """
         while self.running:
-            try:
-                # Process from processing queue to delivery queue (after 24 hours = 86400 seconds)
-                if not self.processing_queue.empty():
-                    item = self.processing_queue.get(timeout=1)
-                    elapsed = (datetime.utcnow() - item['queued_at']).total_seconds()
-                    
-                    if elapsed >= 86400:  # 24 hours
-                        # Move to delivery queue
-                        item['status'] = 'delivered'
-                        item['delivered_at'] = datetime.utcnow()
-                        self.delivery_queue.put(item)
-                        print(f"[OrderQueue] Order {item['order_id']} moved to delivery")
-                        
-                        # Update database
-                        if self.app:
-                            with self.app.app_context():
-                                from models import Order
-                                order = Order.query.get(item['order_id'])
-                                if order:
-                                    order.status = 'delivered'
-                                    db.session.commit()
-                    else:
-                        # Put back in queue if not ready
-                        self.processing_queue.put(item)
-                
-                # Process from delivery queue to completed (after customer confirms receipt)
-                # Note: Customer must manually confirm receipt, so we use a very long timeout
-                if not self.delivery_queue.empty():
-                    item = self.delivery_queue.get(timeout=1)
-                    elapsed = (datetime.utcnow() - item['delivered_at']).total_seconds()
-                    
-                    # Don't auto-complete - customer must confirm manually
-                    # Keep a very high number to prevent auto-completion
-                    if elapsed >= 999999999:
-                        # Mark as received/completed
-                        item['status'] = 'received'
-                        item['received_at'] = datetime.utcnow()
-                        self.completed_orders[item['order_id']] = datetime.utcnow()
-                        print(f"[OrderQueue] Order {item['order_id']} completed (received)")
-                        
-                        # Update database
-                        if self.app:
-                            with self.app.app_context():
-                                from models import Order
-                                order = Order.query.get(item['order_id'])
-                                if order:
-                                    order.status = 'received'
-                                    db.session.commit()
-                    else:
-                        # Put back in queue if not ready
-                        self.delivery_queue.put(item)
-                
-                # Sleep briefly to avoid busy waiting
-                time.sleep(1)
-                
-            except queue.Empty:
+            self._wait_for_work()
+            if not self.running or not self.app:
                 continue
+            try:
+                with self.app.app_context():
+                    # keep claiming until nothing due is left
+                    while self.running and self._claim_and_transition():
+                        pass
             except Exception as e:
+                # leased rows are retried by any worker once the lease expires
+                self.metrics.record_error(e)
                 print(f"[OrderQueue] Error processing orders: {e}")
-                time.sleep(1)
+
+    def _claim(self):
+        """Lease up to CLAIM_BATCH_SIZE due rows to this worker. Returns [(order_id, stage, due_at)]"""
+        from models import ScheduledTransition as ST
+        now = datetime.utcnow()
+        available = db.and_(
+            ST.due_at <= now,
+            db.or_(ST.lease_expires_at.is_(None), ST.lease_expires_at < now),
+        )
+        expires_at = now + timedelta(seconds=LEASE_SECONDS)
+        if db.engine.dialect.name == 'postgresql':
+            # concurrent workers skip each other's rows instead of blocking
+            rows = db.session.execute(
+                db.select(ST.order_id, ST.stage, ST.due_at).where(available)
+                .order_by(ST.due_at).limit(CLAIM_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+            ).all()
+            claimed = [row.order_id for row in rows]
+            if claimed:
+                db.session.execute(
+                    db.update(ST).where(ST.order_id.in_(claimed))
+                    .values(lease_owner=self.worker_id, lease_expires_at=expires_at)
+                )
+        else:
+            # SQLite serialises writers, so a conditional UPDATE is an atomic claim
+            due_ids = db.select(ST.order_id).where(available).order_by(ST.due_at).limit(CLAIM_BATCH_SIZE)
+            db.session.execute(
+                db.update(ST).where(ST.order_id.in_(due_ids.scalar_subquery()), available)
+                .values(lease_owner=self.worker_id, lease_expires_at=expires_at)
+                .execution_options(synchronize_session=False)
+            )
+            # the expiry stamped by this call identifies its rows (not ones leased by earlier claims)
+            rows = db.session.execute(
+                db.select(ST.order_id, ST.stage, ST.due_at)
+                .where(ST.lease_owner == self.worker_id, ST.lease_expires_at == expires_at)
+            ).all()
+        db.session.commit()
+        self.metrics.claims += len(rows)
+        return [(row.order_id, row.stage, row.due_at) for row in rows]
+
+    def _claim_and_transition(self):
+        """Claim due rows and move them to their next status. Returns the number claimed."""
+        claimed = self._claim()
+        by_stage = {}
+        for order_id, stage, due_at in claimed:
+            by_stage.setdefault(stage, {})[order_id] = due_at
+
+        for stage, due_by_id in by_stage.items():
+            order_ids = list(due_by_id)
+            next_status, _ = TRANSITIONS[stage]
+            started = time.perf_counter()
+            try:
+                moved = set_orders_status_bulk(order_ids, stage, next_status, source='queue')
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            now = datetime.utcnow()
+            self.metrics.record_batch(
+                stage, next_status, len(moved), time.perf_counter() - started,
+                [(now - due_by_id[order_id]).total_seconds() for order_id in moved],
+            )
+            print(f"[OrderQueue] {len(moved)} order(s) moved from {stage} to {next_status}")
+
+            # orders whose status changed elsewhere (e.g. cancelled) are dropped from the index
+            with self._cond:
+                for order_id in set(order_ids) - set(moved):
+                    state = self._index.get(order_id)
+                    if state and state['status'] == stage:
+                        del self._index[order_id]
+        return len(claimed)
 
 
 # Global instance
@@ -0,0 +1,216 @@
+"""
+Order status transitions.
+Every status change goes through set_order_status(), which appends an
+OrderEvent and updates the durable order schedule and the sales rollups in
+the same transaction, and defers side effects (the status cache, the order queue's in-memory
+heap and the SSE event hub) until the change is committed.
+"""
+
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import event, bindparam, inspect
+from extensions import db
+from cache import TTLCache
+from event_hub import order_event_hub
+from inventory import stock_changed
+from rollups import record_status_change, counts_as_sale, VOID_STATUSES
+
+# order_id -> status, only ever written with committed values. Entries expire
+# after STATUS_CACHE_SECONDS because other processes' workers move orders too.
+status_cache = TTLCache(max_size=10000, ttl=float(os.environ.get('STATUS_CACHE_SECONDS', 5)))
+
+_PENDING_KEY = 'order_status_changes'
+
+# every status an order can be in (the frontend's list, shared/schema.ts, plus 'pending')
+ORDER_STATUSES = (
+    'pending', 'pending_payment', 'processing', 'shipped', 'delivered', 'received',
+    'refund_requested', 'completed', 'cancelled', 'refunded',
+)
+# statuses only reachable through their action (which restocks and records the refund)
+STATUS_ACTIONS = {'cancelled': 'cancel', 'refunded': 'refund'}
+CANCELLABLE_STATUSES = ('pending', 'processing')
+REFUNDABLE_STATUSES = ('received', 'refund_requested')
+
+
+def status_change_error(status):
+    """Why an admin can't set `status` directly (None if they can)"""
+    if not status:
+        return 'Status is required'
+    if status in STATUS_ACTIONS:
+        return f"Use action '{STATUS_ACTIONS[status]}' to set status {status}"
+    if status not in ORDER_STATUSES:
+        settable = [s for s in ORDER_STATUSES if s not in STATUS_ACTIONS]
+        return f"status must be one of: {', '.join(settable)}"
+    return None
+
+
+def set_order_status(order, status, source=None):
+    """Set order.status, log an OrderEvent and queue the change for the post-commit hooks.
+    The caller commits (or rolls back) the session as usual.
+    """
+    from models import OrderEvent
+    now = datetime.utcnow()
+    previous = order.status
+    order.status = status
+    order_event = OrderEvent(
+        order_id=order.id,
+        from_status=previous,
+        to_status=status,
+        source=source,
+        created_at=now,
+    )
+    db.session.add(order_event)
+    _reschedule([order.id], status, now)
+    record_status_change(order, previous, status)
+    db.session.info.setdefault(_PENDING_KEY, []).append({
+        'event': order_event,
+        'order_id': order.id,
+        'user_id': order.user_id,
+        'from_status': previous,
+        'status': status,
+        'at': now,
+    })
+
+
+def _reschedule(order_ids, status, since, stage=None, clear_ids=None):
+    """Replace the order_schedule rows of `order_ids` for their new `status`.
+    `clear_ids`/`stage` widen the delete to stale rows of orders that already
+    left `stage` by other means.
+    """
+    from models import ScheduledTransition
+    from order_queue import TRANSITIONS
+    clear_ids = clear_ids or order_ids
+    criteria = [ScheduledTransition.order_id.in_(clear_ids)]
+    if stage is not None:
+        criteria.append(db.or_(ScheduledTransition.order_id.in_(order_ids), ScheduledTransition.stage == stage))
+    db.session.execute(db.delete(ScheduledTransition).where(*criteria))
+
+    _, delay = TRANSITIONS.get(status, (None, None))
+    if delay is not None:
+        due_at = since + timedelta(seconds=delay)
+        db.session.add_all([
+            ScheduledTransition(order_id=order_id, stage=status, due_at=due_at, created_at=since)
+            for order_id in order_ids
+        ])
+
+
+def set_orders_status_bulk(order_ids, from_status, to_status, source=None, chunk_size=500):
+    """Move every order in `order_ids` that is still in `from_status` to `to_status`
+    with one guarded UPDATE per chunk, logging an OrderEvent for each.
+    Orders that already left `from_status` (e.g. cancelled) are left alone.
+    Returns the ids that were transitioned; the caller commits.
+    """
+    from models import Order, OrderEvent
+    now = datetime.utcnow()
+    moved = []
+    order_ids = list(order_ids)
+    for start in range(0, len(order_ids), chunk_size):
+        chunk = order_ids[start:start + chunk_size]
+        rows = db.session.execute(
+            db.select(Order.id, Order.user_id)
+            .where(Order.id.in_(chunk), Order.status == from_status)
+            .with_for_update()
+        ).all()
+        if not rows:
+            # none left to move: still drop the chunk's schedule rows for this stage
+            _reschedule([], to_status, now, stage=from_status, clear_ids=chunk)
+            continue
+        ids = [row.id for row in rows]
+        db.session.execute(
+            db.update(Order)
+            .where(Order.id.in_(ids), Order.status == from_status)
+            .values(status=to_status)
+            .execution_options(synchronize_session=False)
+        )
+        _reschedule(ids, to_status, now, stage=from_status, clear_ids=chunk)
+        if counts_as_sale(from_status) != counts_as_sale(to_status):
+            for order in Order.query.filter(Order.id.in_(ids)):
+                record_status_change(order, from_status, to_status)
+        pending = db.session.info.setdefault(_PENDING_KEY, [])
+        for row in rows:
+            order_event = OrderEvent(
+                order_id=row.id,
+                from_status=from_status,
+                to_status=to_status,
+                source=source,
+                created_at=now,
+            )
+            db.session.add(order_event)
+            pending.append({
+                'event': order_event,
+                'order_id': row.id,
+                'user_id': row.user_id,
+                'from_status': from_status,
+                'status': to_status,
+                'at': now,
+            })
+        moved.extend(ids)
+    return moved
+
+
+def restock_orders(orders):
+    """Return the line items of `orders` to stock.
+    Quantities are summed per product and applied with one UPDATE per product
+    (a single executemany), inside the caller's transaction.
+    Returns {product_id: quantity}.
+    """
+    from models import Product
+    quantities = Counter()
+    for order in orders:
+        for item in order.items or []:
+            product_id = item.get('productId')
+            quantity = item.get('quantity', 0)
+            if product_id and quantity > 0:
+                quantities[product_id] += quantity
+
+    if quantities:
+        products = Product.__table__
+        db.session.execute(
+            products.update()
+            .where(products.c.id == bindparam('product_id'))
+            .values(stock=products.c.stock + bindparam('quantity')),
+            [{'product_id': pid, 'quantity': qty} for pid, qty in quantities.items()],
+        )
+        for pid in quantities:
+            stock_changed(pid)
+    return dict(quantities)
+
+
+def get_cached_status(order_id):
+    """Return the committed status of an order, reading the DB only on a cache miss"""
+    status = status_cache.get(order_id)
+    if status is None:
+        from models import Order
+        row = db.session.query(Order.status).filter(Order.id == order_id).first()
+        if row is None:
+            return None
+        status = row[0]
+        status_cache.set(order_id, status)
+    return status
+
+
+@event.listens_for(db.session, 'after_commit')
+def _after_commit(session):
+    from order_queue import order_queue
+    for change in session.info.pop(_PENDING_KEY, []):
+        status_cache.set(change['order_id'], change['status'])
+        order_queue.sync_status(change['order_id'], change['status'], change['at'])
+        # identity is known after flush without touching the (expired) instance
+        identity = inspect(change['event']).identity
+        if identity:
+            order_event_hub.publish({
+                'id': identity[0],
+                'orderId': change['order_id'],
+                'userId': change['user_id'],
+                'status': change['status'],
+                'fromStatus': change['from_status'],
+                'at': change['at'].isoformat(),
+            })
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    # A rolled back savepoint leaves the outer transaction (and its changes) alive
+    if not session.in_transaction():
+        session.info.pop(_PENDING_KEY, None)
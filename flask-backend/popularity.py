@@ -0,0 +1,286 @@
+"""
+Product Popularity
+A popularity score per product blending rating (shrunk towards the catalogue
+mean for products with few reviews), review count, recent sales and recent
+views. Sales and views are exponentially decayed counts (half-life
+HALF_LIFE_DAYS): each refresh decays the stored counts by the time elapsed
+and adds only the orders and views recorded since the previous run, so no
+history is re-scanned. Counted orders that were cancelled or refunded since
+the last run (per order_events) are subtracted again, with the weight they
+were added with, and added back if they are reinstated.
+
+Scores live in product_popularity.score (indexed). The top TOP_N in-stock
+products are cached in memory, so the recommendation fallback needs no query.
+
+Run a full rebuild with:  python popularity.py --full
+"""
+
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+import numpy as np
+from extensions import db
+from rollups import counts_as_sale, status_changes
+
+HALF_LIFE_DAYS = 14
+FULL_WINDOW_DAYS = 90  # history a full rebuild starts from
+RATING_PRIOR_REVIEWS = 10  # reviews worth of the catalogue mean added to every rating
+WEIGHTS = {'rating': 2.0, 'reviews': 0.5, 'sales': 3.0, 'views': 1.0}
+SETTLE_SECONDS = 5
+REFRESH_SECONDS = 300
+TOP_N = 50
+CACHE_SECONDS = 60
+
+
+def decay_factor(seconds):
+    return 0.5 ** (seconds / (HALF_LIFE_DAYS * 86400))
+
+
+def blend(ratings, review_counts, sales, views):
+    """Popularity scores for parallel arrays of rating, review count, decayed sales and views"""
+    ratings = np.asarray(ratings, dtype=np.float64)
+    review_counts = np.asarray(review_counts, dtype=np.float64)
+    reviewed = review_counts > 0
+    mean = (
+        (ratings * review_counts).sum() / review_counts.sum() if reviewed.any() else 0.0
+    )
+    shrunk = (ratings * review_counts + mean * RATING_PRIOR_REVIEWS) / (review_counts + RATING_PRIOR_REVIEWS)
+    return (
+        WEIGHTS['rating'] * shrunk / 5
+        + WEIGHTS['reviews'] * np.log1p(review_counts)
+        + WEIGHTS['sales'] * np.log1p(np.asarray(sales, dtype=np.float64))
+        + WEIGHTS['views'] * np.log1p(np.asarray(views, dtype=np.float64))
+    )
+
+
+def _units(items):
+    """Units per product id in an order's line items"""
+    units = Counter()
+    for item in items or []:
+        if item.get('productId'):
+            units[str(item['productId'])] += int(item.get('quantity') or 1)
+    return units
+
+
+def _new_sales(cursor, upper, later_changes):
+    """Decayed units sold per product in orders after `cursor` (created_at, id) up to `upper`
+    that count with their status as of the event snapshot (`later_changes` are events after it)
+    """
+    from models import Order
+    query = (
+        db.select(Order.id, Order.created_at, Order.items, Order.status)
+        .where(Order.created_at <= upper)
+        .order_by(Order.created_at, Order.id)
+        .execution_options(yield_per=1000)
+    )
+    if cursor:
+        created_at, order_id = datetime.fromisoformat(cursor[0]), cursor[1]
+        query = query.where(db.or_(
+            Order.created_at > created_at,
+            db.and_(Order.created_at == created_at, Order.id > order_id),
+        ))
+
+    sales, last = Counter(), None
+    for order_id, created_at, items, status in db.session.execute(query):
+        if order_id in later_changes:
+            status = later_changes[order_id][0]
+        if counts_as_sale(status):
+            weight = decay_factor((upper - created_at).total_seconds())
+            for product_id, units in _units(items).items():
+                sales[product_id] += weight * units
+        last = (created_at.isoformat(), order_id)
+    return sales, last
+
+
+def _recounted_sales(changes, start, cursor, upper):
+    """Signed decayed units of already-counted orders (in (`start`, `cursor`]) whose status
+    moved out of (subtracted) or back into (added) the counted statuses
+    """
+    from models import Order
+    flips = {order_id: 1 if counts_as_sale(after) else -1 for order_id, (before, after) in changes.items()
+             if counts_as_sale(before) != counts_as_sale(after)}
+    sales = Counter()
+    ids = list(flips)
+    lower = (datetime.fromisoformat(start[0]), start[1]) if start else None
+    bound = (datetime.fromisoformat(cursor[0]), cursor[1])
+    for i in range(0, len(ids), 500):
+        for order_id, created_at, items in db.session.execute(
+            db.select(Order.id, Order.created_at, Order.items).where(Order.id.in_(ids[i:i + 500]))
+        ):
+            key = (created_at, order_id)
+            if created_at is None or key > bound or (lower and key <= lower):
+                continue
+            weight = flips[order_id] * decay_factor(max((upper - created_at).total_seconds(), 0))
+            for product_id, units in _units(items).items():
+                sales[product_id] += weight * units
+    return sales
+
+
+def _new_views(after_id, since, upper):
+    """Decayed views per product with id > after_id (and viewed after `since`), up to `upper`"""
+    from models import ProductView
+    query = (
+        db.select(ProductView.id, ProductView.product_id, ProductView.viewed_at)
+        .where(ProductView.id > after_id, ProductView.viewed_at <= upper)
+        .order_by(ProductView.id)
+        .execution_options(yield_per=5000)
+    )
+    if since:
+        query = query.where(ProductView.viewed_at >= since)
+    views, last = Counter(), after_id
+    for view_id, product_id, viewed_at in db.session.execute(query):
+        views[product_id] += decay_factor(max((upper - viewed_at).total_seconds(), 0))
+        last = max(last, view_id)
+    return views, last
+
+
+def refresh(state, full=False):
+    """Decay stored counts, fold in new orders and views, and rescore every product.
+    `state` is the job's JobState row (see jobs.run_job). Returns the number of products scored.
+    """
+    from models import Product, ProductPopularity, OrderEvent
+    now = datetime.utcnow()
+    upper = now - timedelta(seconds=SETTLE_SECONDS)
+    data = dict(state.data or {})
+    if data.get('at') and 'eventId' not in data:
+        full = True  # counts from before cancellations and refunds were retracted
+    if full or not data.get('at'):
+        db.session.execute(db.delete(ProductPopularity))
+        data = {}
+        since = upper - timedelta(days=FULL_WINDOW_DAYS)
+        data['from'] = [since.isoformat(), '']
+    else:
+        since = None
+        elapsed = (upper - datetime.fromisoformat(data['at'])).total_seconds()
+        factor = decay_factor(max(elapsed, 0))
+        db.session.execute(db.update(ProductPopularity).values(
+            recent_sales=ProductPopularity.recent_sales * factor,
+            recent_views=ProductPopularity.recent_views * factor,
+        ))
+
+    # statuses are read as of one order_events id, so each order is counted (or retracted) exactly once
+    event_id = db.session.query(db.func.max(OrderEvent.id)).scalar() or 0
+    start_cursor = data.get('cursor') or data['from']
+    sales, order_cursor = _new_sales(start_cursor, upper, status_changes(event_id))
+    if data.get('cursor'):
+        sales.update(_recounted_sales(status_changes(data['eventId'], event_id), data['from'], data['cursor'], upper))
+    views, view_cursor = _new_views(data.get('viewId', 0), since, upper)
+
+    products = db.session.execute(
+        db.select(Product.id, Product.rating, Product.reviewCount).order_by(Product.id)
+    ).all()
+    stored = {
+        row.product_id: row for row in db.session.execute(
+            db.select(ProductPopularity.product_id, ProductPopularity.recent_sales, ProductPopularity.recent_views)
+        )
+    }
+    ids = [p.id for p in products]
+
+    def _rating(value):
+        try:
+            return float(value or 0)
+        except ValueError:
+            return 0.0
+
+    # a retraction can exceed what float rounding left of the count; never go below zero
+    sales_arr = np.maximum([(stored[i].recent_sales if i in stored else 0) + sales.get(i, 0) for i in ids], 0)
+    views_arr = np.array([(stored[i].recent_views if i in stored else 0) + views.get(i, 0) for i in ids])
+    scores = blend([_rating(p.rating) for p in products], [p.reviewCount or 0 for p in products], sales_arr, views_arr)
+
+    rows = [
+        {'product_id': pid, 'score': float(score), 'recent_sales': float(s), 'recent_views': float(v), 'updated_at': now}
+        for pid, score, s, v in zip(ids, scores, sales_arr, views_arr)
+    ]
+    table = ProductPopularity.__table__
+    updates = [{**row, 'key': row['product_id']} for row in rows if row['product_id'] in stored]
+    inserts = [row for row in rows if row['product_id'] not in stored]
+    if updates:
+        db.session.execute(
+            table.update().where(table.c.product_id == db.bindparam('key')).values(
+                score=db.bindparam('score'),
+                recent_sales=db.bindparam('recent_sales'),
+                recent_views=db.bindparam('recent_views'),
+                updated_at=db.bindparam('updated_at'),
+            ),
+            updates,
+        )
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    deleted = set(stored) - set(ids)
+    if deleted:
+        db.session.execute(db.delete(ProductPopularity).where(ProductPopularity.product_id.in_(deleted)))
+
+    data.update({
+        'at': upper.isoformat(),
+        'cursor': list(order_cursor) if order_cursor else start_cursor,
+        'eventId': event_id,
+        'viewId': view_cursor,
+    })
+    state.data = data
+    db.session.commit()
+    top_products.invalidate()
+    print(f"[Popularity] Scored {len(ids)} product(s) from {len(sales)} sold / {len(views)} viewed")
+    return len(ids)
+
+
+class TopProducts:
+    """
+    In-memory list of the most popular in-stock products (as to_dict payloads),
+    reloaded at most every CACHE_SECONDS.
+    """
+
+    def __init__(self, size=TOP_N, max_age=CACHE_SECONDS):
+        self.size = size
+        self.max_age = max_age
+        self._products = []
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _load(self):
+        from models import Product, ProductPopularity
+        products = (
+            Product.query
+            .join(ProductPopularity, ProductPopularity.product_id == Product.id)
+            .filter(Product.stock > 0)
+            .order_by(db.desc(ProductPopularity.score))
+            .limit(self.size)
+            .all()
+        )
+        return [p.to_dict() for p in products]
+
+    def get(self, limit, exclude=()):
+        """Up to `limit` product dicts, most popular first, skipping ids in `exclude`"""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age:
+            with self._lock:
+                if self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age:
+                    self._products = self._load()
+                    self._loaded_at = time.monotonic()
+        exclude = set(exclude)
+        return [p for p in self._products if p['id'] not in exclude][:limit]
+
+
+# Global instance
+top_products = TopProducts()
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    os.environ.setdefault('ORDER_QUEUE_WORKER', '0')
+    os.environ.setdefault('BACKGROUND_JOBS', '0')
+    from app import create_app
+    from jobs import run_job
+
+    parser = argparse.ArgumentParser(description='Refresh product popularity scores')
+    parser.add_argument('--full', action='store_true', help=f'rebuild from the last {FULL_WINDOW_DAYS} days')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        processed = run_job('popularity', refresh, full=args.full)
+        if processed is None:
+            print("Another process is running the popularity job; try again later.")
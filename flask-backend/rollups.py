@@ -0,0 +1,159 @@
+"""
+Sales Rollups
+Daily aggregates of orders, revenue and units sold, overall and per
+product and category, so analytics read a few hundred rows instead of
+every order.
+
+Rollups count orders that are not cancelled or refunded, on the day the
+order was placed (UTC). They are maintained by order_transitions: an order
+is added when it is placed and subtracted when it is cancelled or refunded
+(or deleted), in the same transaction as the status change. The same
+changes update the per-customer aggregates (customers.py) and feed the live
+admin counters (live_stats.py) after commit.
+
+Rebuild from the orders table with:  python rollups.py --backfill
+"""
+
+from collections import defaultdict
+from datetime import datetime
+from extensions import db
+from counters import increment_row
+from live_stats import record_order
+import customers
+
+VOID_STATUSES = ('cancelled', 'refunded')
+OTHER_CATEGORY = 'Other'
+
+
+def counts_as_sale(status):
+    return status is not None and status not in VOID_STATUSES
+
+
+def _line_items(order):
+    """(product_id, product_name, category, units, revenue) per line item"""
+    for item in order.items or []:
+        quantity = int(item.get('quantity', 0) or 0)
+        price = float(item.get('price', 0) or 0)
+        yield (
+            str(item.get('productId') or ''),
+            item.get('productName') or item.get('name', 'Unknown'),
+            item.get('category') or OTHER_CATEGORY,
+            quantity,
+            price * quantity,
+        )
+
+
+def apply_order(order, sign=1):
+    """Add (sign=1) or subtract (sign=-1) an order's totals to the rollups of its day"""
+    from models import DailySales, DailyProductSales, DailyCategorySales
+    day = (order.created_at or datetime.utcnow()).date()
+    items = list(_line_items(order))
+    increment_row(DailySales, {'day': day}, {
+        'orders': sign,
+        'revenue': sign * float(order.total or 0),
+        'units': sign * sum(units for _, _, _, units, _ in items),
+    })
+    for product_id, name, category, units, revenue in items:
+        increment_row(
+            DailyProductSales, {'day': day, 'product_id': product_id},
+            {'units': sign * units, 'revenue': sign * revenue},
+            initial={'product_name': name},
+        )
+        increment_row(
+            DailyCategorySales, {'day': day, 'category': category},
+            {'units': sign * units, 'revenue': sign * revenue},
+        )
+    customers.record_order(order, sign)
+    record_order(order, sign)
+
+
+def record_status_change(order, from_status, to_status):
+    """Keep the rollups in step with an order moving between statuses"""
+    before, after = counts_as_sale(from_status), counts_as_sale(to_status)
+    if after and not before:
+        apply_order(order, 1)
+    elif before and not after:
+        apply_order(order, -1)
+
+
+def status_changes(after_id, upper_id=None):
+    """{order_id: (status before the first event, status after the last)} for order_events in (after_id, upper_id].
+    Lets incremental jobs find counted orders that were cancelled, refunded or reinstated since their last run.
+    """
+    from models import OrderEvent
+    query = db.select(OrderEvent.order_id, OrderEvent.from_status, OrderEvent.to_status).where(OrderEvent.id > after_id)
+    if upper_id is not None:
+        query = query.where(OrderEvent.id <= upper_id)
+    changes = {}
+    for order_id, before, after in db.session.execute(query.order_by(OrderEvent.id)):
+        changes[order_id] = (changes[order_id][0] if order_id in changes else before, after)
+    return changes
+
+
+def backfill(chunk_size=1000):
+    """Rebuild every rollup table from the orders table (one pass over the orders)"""
+    from models import Order, DailySales, DailyProductSales, DailyCategorySales
+    overall = defaultdict(lambda: {'orders': 0, 'revenue': 0.0, 'units': 0})
+    products = defaultdict(lambda: {'product_name': None, 'units': 0, 'revenue': 0.0})
+    categories = defaultdict(lambda: {'units': 0, 'revenue': 0.0})
+
+    query = (
+        db.select(Order.id, Order.created_at, Order.total, Order.items)
+        .where(Order.status.notin_(VOID_STATUSES))
+        .execution_options(yield_per=chunk_size)
+    )
+    count = 0
+    for order in db.session.execute(query):
+        count += 1
+        day = (order.created_at or datetime.utcnow()).date()
+        items = list(_line_items(order))
+        overall[day]['orders'] += 1
+        overall[day]['revenue'] += float(order.total or 0)
+        for product_id, name, category, units, revenue in items:
+            overall[day]['units'] += units
+            row = products[(day, product_id)]
+            row['product_name'] = name
+            row['units'] += units
+            row['revenue'] += revenue
+            row = categories[(day, category)]
+            row['units'] += units
+            row['revenue'] += revenue
+
+    db.session.execute(db.delete(DailySales))
+    db.session.execute(db.delete(DailyProductSales))
+    db.session.execute(db.delete(DailyCategorySales))
+    if overall:
+        db.session.execute(DailySales.__table__.insert(), [
+            {'day': day, **values} for day, values in overall.items()
+        ])
+    if products:
+        db.session.execute(DailyProductSales.__table__.insert(), [
+            {'day': day, 'product_id': product_id, **values} for (day, product_id), values in products.items()
+        ])
+    if categories:
+        db.session.execute(DailyCategorySales.__table__.insert(), [
+            {'day': day, 'category': category, **values} for (day, category), values in categories.items()
+        ])
+    db.session.commit()
+    return count
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    os.environ.setdefault('ORDER_QUEUE_WORKER', '0')
+    os.environ.setdefault('BACKGROUND_JOBS', '0')
+    from app import create_app
+
+    parser = argparse.ArgumentParser(description='Daily sales rollups')
+    parser.add_argument('--backfill', action='store_true', help='rebuild the rollups from all orders')
+    args = parser.parse_args()
+
+    if not args.backfill:
+        parser.print_help()
+    else:
+        app = create_app()
+        with app.app_context():
+            print("Rebuilding daily sales rollups...")
+            count = backfill()
+            print(f"✓ Rolled up {count} orders")
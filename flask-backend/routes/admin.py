@@ -1,35 +1,324 @@
-from flask import Blueprint, jsonify, request
+import base64
+import csv
+import io
+import json
+from datetime import datetime
+from flask import Blueprint, jsonify, request, Response, stream_with_context
+from sqlalchemy.orm import defer
 from models import User, Order, Product
 from extensions import db
-from utils import token_required, get_current_user_id
+from utils import token_required, admin_required, get_current_user_id
+from order_queue import order_queue
+from metrics import prometheus_lines
+from live_stats import live_stats
+from routes.orders import receipt_payload
+from order_transitions import (
+    set_order_status, restock_orders, status_change_error, CANCELLABLE_STATUSES, REFUNDABLE_STATUSES,
+)
+from rollups import VOID_STATUSES
 
 admin_bp = Blueprint('admin', __name__)
 
+ORDER_PAGE_SIZE = 50
+ORDER_PAGE_SIZE_MAX = 200
+BULK_ORDER_LIMIT = 5000
+BULK_CHUNK_SIZE = 500  # keep IN (...) lists under SQLite's bound-parameter limit
+EXPORT_FETCH_SIZE = 500  # rows per server-side cursor fetch (and per streamed chunk)
+EXPORT_CSV_COLUMNS = [
+    'order_id', 'order_date', 'status', 'customer_name', 'customer_email', 'customer_phone',
+    'payment_method', 'order_total', 'refunded_at', 'refund_amount',
+    'product_id', 'product_name', 'category', 'unit_price', 'quantity', 'line_total',
+]
+
+
+def _parse_datetime(value):
+    """Parse an ISO date/datetime query parameter (None if absent)"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+
+
+def order_filters(args):
+    """Build SQLAlchemy criteria for the admin order filters.
+    Raises ValueError on malformed parameters.
+    """
+    criteria = []
+    if args.get('status'):
+        statuses = [s.strip() for s in args['status'].split(',') if s.strip()]
+        if not statuses:
+            raise ValueError('status filter has no statuses')
+        criteria.append(Order.status.in_(statuses) if len(statuses) > 1 else Order.status == statuses[0])
+    if args.get('userId'):
+        criteria.append(Order.user_id == int(args['userId']))
+    if args.get('email'):
+        criteria.append(Order.customer_email == args['email'].strip())
+    if args.get('paymentMethod'):
+        criteria.append(Order.payment_method == args['paymentMethod'])
+    date_from = _parse_datetime(args.get('from'))
+    if date_from:
+        criteria.append(Order.created_at >= date_from)
+    date_to = _parse_datetime(args.get('to'))
+    if date_to:
+        criteria.append(Order.created_at < date_to)
+    return criteria
+
+
+def _encode_cursor(order):
+    raw = f"{order.created_at.isoformat()}|{order.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor):
+    created_at, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+    return datetime.fromisoformat(created_at), order_id
+
 
 @admin_bp.route('/admin/stats', methods=['GET'])
+@admin_required
 def stats():
-    try:
-        total_products = Product.query.count()
-    except Exception:
-        total_products = 0
+    """Dashboard counters, served from memory (see live_stats.py)"""
+    return jsonify(live_stats.snapshot())
 
+
+@admin_bp.route('/admin/orders', methods=['GET'])
+@admin_required
+def search_orders():
+    """Paginated order search for the admin order table.
+    Filters: status (comma separated), from/to (ISO dates), userId, email, paymentMethod.
+    Pagination is keyset based: pass the returned `nextCursor` as `cursor` to get the next page.
+    """
     try:
-        # count orders where created_at is today (best-effort)
-        orders_today = Order.query.filter(db.func.date(Order.created_at) == db.func.date(db.func.current_timestamp())).count()
-    except Exception:
-        orders_today = 0
+        # keyset paging needs a created_at to position every row; it's only missing on rows
+        # written outside the ORM (the column defaults to the insert time)
+        criteria = order_filters(request.args) + [Order.created_at.isnot(None)]
+        limit = min(int(request.args.get('limit', ORDER_PAGE_SIZE)), ORDER_PAGE_SIZE_MAX)
+        cursor = request.args.get('cursor')
+        if cursor:
+            cursor_created_at, cursor_id = _decode_cursor(cursor)
+            criteria.append(db.or_(
+                Order.created_at < cursor_created_at,
+                db.and_(Order.created_at == cursor_created_at, Order.id < cursor_id),
+            ))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid filter or cursor'}), 400
+
+    if limit <= 0:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    # items and shipping_address are large JSON blobs that the list view never shows
+    orders = (
+        Order.query
+        .options(defer(Order.items), defer(Order.shipping_address))
+        .filter(*criteria)
+        .order_by(Order.created_at.desc(), Order.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+
+    has_more = len(orders) > limit
+    orders = orders[:limit]
+    return jsonify({
+        'orders': [o.to_summary_dict() for o in orders],
+        'nextCursor': _encode_cursor(orders[-1]) if has_more else None,
+    })
+
+
+@admin_bp.route('/admin/orders/bulk', methods=['POST'])
+@admin_required
+def bulk_update_orders():
+    """Apply one action to many orders in a single transaction.
+    Body: {action: 'status' | 'cancel' | 'refund', orderIds: [...],
+           status: <new status, for action=status>, reason: <optional refund reason>}
+    Orders that are missing or not eligible are reported in `skipped`.
+    """
+    data = request.get_json() or {}
+    action = data.get('action')
+    order_ids = list(dict.fromkeys(data.get('orderIds') or []))
+    new_status = data.get('status')
+
+    if action not in ('status', 'cancel', 'refund'):
+        return jsonify({'error': 'action must be one of: status, cancel, refund'}), 400
+    if not order_ids:
+        return jsonify({'error': 'orderIds is required'}), 400
+    if len(order_ids) > BULK_ORDER_LIMIT:
+        return jsonify({'error': f'At most {BULK_ORDER_LIMIT} orders per request'}), 400
+    if action == 'status' and status_change_error(new_status):
+        return jsonify({'error': status_change_error(new_status)}), 400
+
+    orders = {}
+    for start in range(0, len(order_ids), BULK_CHUNK_SIZE):
+        chunk = order_ids[start:start + BULK_CHUNK_SIZE]
+        for order in Order.query.filter(Order.id.in_(chunk)).all():
+            orders[order.id] = order
+
+    updated, skipped, to_restock = [], [], []
+    now = datetime.utcnow()
+    for order_id in order_ids:
+        order = orders.get(order_id)
+        if not order:
+            skipped.append({'id': order_id, 'reason': 'not found'})
+            continue
+
+        if action == 'status':
+            if order.status in VOID_STATUSES:
+                # reinstating would re-count the sale without taking the stock back
+                skipped.append({'id': order_id, 'reason': f'cannot change status of a {order.status} order'})
+                continue
+            set_order_status(order, new_status, source='admin')
+        elif action == 'cancel':
+            if order.status not in CANCELLABLE_STATUSES:
+                skipped.append({'id': order_id, 'reason': f'cannot cancel order with status: {order.status}'})
+                continue
+            set_order_status(order, 'cancelled', source='admin')
+            to_restock.append(order)
+        else:
+            if order.status not in REFUNDABLE_STATUSES or order.refunded_at:
+                skipped.append({'id': order_id, 'reason': f'cannot refund order with status: {order.status}'})
+                continue
+            order.refunded_at = now
+            order.refund_amount = order.total
+            if data.get('reason'):
+                order.refund_reason = data['reason']
+            set_order_status(order, 'refunded', source='admin')
+            to_restock.append(order)
+        updated.append(order_id)
 
     try:
-        revenue = float(db.session.query(db.func.coalesce(db.func.sum(Order.total), 0)).scalar() or 0)
-    except Exception:
-        revenue = 0
+        restocked = restock_orders(to_restock)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': 'Bulk update failed', 'details': str(e)}), 500
+
+    return jsonify({'action': action, 'updated': updated, 'skipped': skipped, 'restocked': restocked})
+
+
+def _csv_safe(value):
+    """Neutralise spreadsheet formulas in customer-supplied text"""
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@'):
+        return "'" + value
+    return value
+
 
+def _export_csv_rows(order):
+    """One CSV row per line item (order columns repeated); orders without items get one row"""
+    base = [
+        order.id,
+        order.created_at.isoformat() if order.created_at else '',
+        order.status,
+        _csv_safe(order.customer_name),
+        _csv_safe(order.customer_email),
+        _csv_safe(order.customer_phone),
+        order.payment_method,
+        order.total,
+        order.refunded_at.isoformat() if order.refunded_at else '',
+        order.refund_amount if order.refund_amount is not None else '',
+    ]
+    items = order.items or []
+    if not items:
+        yield base + [''] * 6
+    for item in items:
+        quantity = item.get('quantity', 0) or 0
+        price = item.get('price', 0) or 0
+        try:
+            line_total = round(float(price) * int(quantity), 2)
+        except (TypeError, ValueError):
+            line_total = ''
+        yield base + [
+            item.get('productId', ''),
+            _csv_safe(item.get('productName') or item.get('name', '')),
+            item.get('category', ''),
+            price,
+            quantity,
+            line_total,
+        ]
+
+
+@admin_bp.route('/admin/orders/export', methods=['GET'])
+@admin_required
+def export_orders():
+    """Stream orders with their line items as CSV (one row per item) or NDJSON (one receipt per line).
+    Query: format=csv|ndjson, plus the /admin/orders filters (from, to, status, userId, email, paymentMethod).
+    Rows come from a server-side cursor in created_at order and are written out in chunks,
+    so the result set is never held in memory.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
     try:
-        low_stock = Product.query.filter(Product.stock < 10).count()
-    except Exception:
-        low_stock = 0
+        criteria = order_filters(request.args)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid filter'}), 400
+
+    # Plain rows (not ORM objects), so nothing accumulates in the identity map
+    query = (
+        db.select(
+            Order.id, Order.created_at, Order.status, Order.customer_name, Order.customer_email,
+            Order.customer_phone, Order.shipping_address, Order.items, Order.total,
+            Order.payment_method, Order.refunded_at, Order.refund_amount,
+        )
+        .where(*criteria)
+        .order_by(Order.created_at, Order.id)
+        .execution_options(yield_per=EXPORT_FETCH_SIZE)
+    )
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(EXPORT_CSV_COLUMNS)
+        for partition in db.session.execute(query).partitions():
+            for order in partition:
+                if export_format == 'csv':
+                    writer.writerows(_export_csv_rows(order))
+                else:
+                    buffer.write(json.dumps(receipt_payload(order), default=str) + '\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    stamp = '-'.join(filter(None, [request.args.get('from', '')[:10], request.args.get('to', '')[:10]])) or 'all'
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename=orders-{stamp}.{export_format}',
+            'X-Accel-Buffering': 'no',
+        },
+    )
+
+
+@admin_bp.route('/admin/order-queue', methods=['GET'])
+@admin_required
+def order_queue_stats():
+    """Order queue depth/lag per stage and this process's worker metrics"""
+    return jsonify(order_queue.stats())
+
 
-    return jsonify({'totalProducts': total_products, 'ordersToday': orders_today, 'revenue': revenue, 'lowStock': low_stock})
+@admin_bp.route('/admin/order-queue/metrics', methods=['GET'])
+@admin_required
+def order_queue_metrics():
+    """Order queue metrics in Prometheus text exposition format"""
+    stats = order_queue.stats()
+    m = order_queue.metrics
+    worker = {'worker': order_queue.worker_id}
+    lines = []
+    lines += prometheus_lines('order_queue_depth', 'gauge', 'Scheduled transitions per stage',
+                              [({'stage': stage}, s['depth']) for stage, s in stats['stages'].items()])
+    lines += prometheus_lines('order_queue_due', 'gauge', 'Due but unprocessed transitions per stage',
+                              [({'stage': stage}, s['due']) for stage, s in stats['stages'].items()])
+    lines += prometheus_lines('order_queue_lag_seconds', 'gauge', 'Age of the oldest due transition per stage',
+                              [({'stage': stage}, s['lagSeconds']) for stage, s in stats['stages'].items()])
+    lines += prometheus_lines('order_queue_transitions_total', 'counter', 'Transitions performed by this worker',
+                              [({**worker, 'from': a, 'to': b}, n) for (a, b), n in m.transitions.items()])
+    lines += prometheus_lines('order_queue_errors_total', 'counter', 'Worker errors', [(worker, m.errors)])
+    lines += prometheus_lines('order_queue_commit_seconds', 'histogram', 'Transition batch transaction latency',
+                              [({**worker, 'from': a, 'to': b}, h.snapshot()) for (a, b), h in m.commit_latency.items()])
+    lines += prometheus_lines('order_queue_schedule_lag_seconds', 'histogram', 'Delay between due time and transition',
+                              [({**worker, 'from': a, 'to': b}, h.snapshot()) for (a, b), h in m.schedule_lag.items()])
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
 
 @admin_bp.route('/admin/users', methods=['GET'])
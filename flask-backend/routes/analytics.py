@@ -1,143 +1,340 @@
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request, current_app
 from sqlalchemy import func, extract
-from datetime import datetime, timedelta
-from models import Order, Product, User
+from datetime import date, datetime, timedelta
+from models import Product, User, DailySales, DailyProductSales, DailyCategorySales, AnalyticsResult
 from extensions import db
+from utils import admin_required
+from cache import SnapshotCache
+import columnar
+import customers
+import sketches
+import os
 
 analytics_bp = Blueprint('analytics', __name__)
 
+GRANULARITIES = ('day', 'week', 'month')
+MAX_BUCKETS = 1000
+DEFAULT_BUCKETS = {'day': 30, 'week': 12, 'month': 12}
+
+# Dashboard payloads are served stale-while-revalidate from these snapshots
+ANALYTICS_SNAPSHOT_SECONDS = int(os.environ.get('ANALYTICS_SNAPSHOT_SECONDS', 60))
+analytics_snapshots = SnapshotCache(max_age=ANALYTICS_SNAPSHOT_SECONDS)
+
+
+def _truncate(column, granularity):
+    """SQL expression truncating a date column to the start of its day, week (Monday) or month"""
+    dialect = db.session.get_bind().dialect.name
+    if granularity == 'day':
+        return column
+    if dialect == 'postgresql':
+        return func.date_trunc(granularity, column)
+    if dialect in ('mysql', 'mariadb'):
+        if granularity == 'week':
+            return func.subdate(column, func.weekday(column))
+        return func.date_format(column, '%Y-%m-01')
+    # SQLite
+    if granularity == 'week':
+        weekday = (db.cast(func.strftime('%w', column), db.Integer) + 6) % 7
+        return func.date(column, func.printf('-%d days', weekday))
+    return func.strftime('%Y-%m-01', column)
+
+
+def _bucket_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _next_bucket(day, granularity):
+    if granularity == 'week':
+        return day + timedelta(days=7)
+    if granularity == 'month':
+        return (day + timedelta(days=32)).replace(day=1)
+    return day + timedelta(days=1)
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def revenue_series(start, end, granularity):
+    """Revenue, orders and units per bucket for days in [start, end], with empty buckets as zeros.
+    One GROUP BY over the daily rollups.
+    """
+    bucket = _truncate(DailySales.day, granularity).label('bucket')
+    rows = db.session.query(
+        bucket,
+        func.sum(DailySales.revenue),
+        func.sum(DailySales.orders),
+        func.sum(DailySales.units)
+    ).filter(
+        DailySales.day >= start,
+        DailySales.day <= end
+    ).group_by(bucket).all()
+    totals = {_as_date(b): (revenue, orders, units) for b, revenue, orders, units in rows}
+    
+    series = []
+    period = _bucket_start(start, granularity)
+    while period <= end:
+        revenue, orders, units = totals.get(period, (0, 0, 0))
+        series.append({
+            'period': period.isoformat(),
+            'revenue': float(revenue or 0),
+            'orders': int(orders or 0),
+            'units': int(units or 0)
+        })
+        period = _next_bucket(period, granularity)
+    return series
+
+
+def _compute_analytics():
+    """Dashboard analytics payload"""
+    # Everything below reads the daily rollups (see rollups.py), not the orders
+    total_revenue, total_orders = db.session.query(
+        func.coalesce(func.sum(DailySales.revenue), 0),
+        func.coalesce(func.sum(DailySales.orders), 0)
+    ).one()
+    
+    # Get total customers (users count)
+    total_customers = User.query.count()
+    
+    # Get total products count
+    total_products = Product.query.count()
+    
+    # New-customer trend, precomputed by the customer analytics job (customers.py)
+    customer_result = db.session.get(AnalyticsResult, customers.RESULT_NAME)
+    customers_change = customer_result.data.get('newCustomersChange', 0) if customer_result else 0
+    
+    # Calculate trends (compare last 30 days vs previous 30 days)
+    today = datetime.utcnow().date()
+    thirty_days_ago = today - timedelta(days=30)
+    sixty_days_ago = today - timedelta(days=60)
+    
+    # Trend windows from the last 60 daily rows
+    days = DailySales.query.filter(DailySales.day >= sixty_days_ago).all()
+    
+    recent_revenue = sum(d.revenue for d in days if d.day >= thirty_days_ago)
+    previous_revenue = sum(d.revenue for d in days if sixty_days_ago <= d.day < thirty_days_ago)
+    revenue_change = ((recent_revenue - previous_revenue) / previous_revenue * 100) if previous_revenue > 0 else 0
+    
+    recent_orders = sum(d.orders for d in days if d.day >= thirty_days_ago)
+    previous_orders = sum(d.orders for d in days if sixty_days_ago <= d.day < thirty_days_ago)
+    orders_change = ((recent_orders - previous_orders) / previous_orders * 100) if previous_orders > 0 else 0
+    
+    # Last 6 calendar months of revenue data
+    first_month = today.replace(day=1)
+    for _ in range(5):
+        first_month = (first_month - timedelta(days=1)).replace(day=1)
+    revenue_data = [
+        {
+            'month': date.fromisoformat(bucket['period']).strftime('%b'),
+            'revenue': bucket['revenue'],
+            'orders': bucket['orders']
+        }
+        for bucket in revenue_series(first_month, today, 'month')
+    ]
+    
+    # Top products by units sold
+    product_rows = db.session.query(
+        DailyProductSales.product_id,
+        func.max(DailyProductSales.product_name),
+        func.sum(DailyProductSales.units).label('sales'),
+        func.sum(DailyProductSales.revenue)
+    ).group_by(DailyProductSales.product_id).having(
+        func.sum(DailyProductSales.units) > 0
+    ).order_by(db.desc('sales')).limit(5).all()
+    top_products = [
+        {'name': name or 'Unknown', 'sales': int(sales or 0), 'revenue': float(revenue or 0)}
+        for _, name, sales, revenue in product_rows
+    ]
+    
+    # Sales per category
+    category_rows = db.session.query(
+        DailyCategorySales.category,
+        func.sum(DailyCategorySales.units),
+        func.sum(DailyCategorySales.revenue)
+    ).group_by(DailyCategorySales.category).having(
+        func.sum(DailyCategorySales.units) > 0
+    ).all()
+    category_data = [
+        {'category': category.capitalize(), 'sales': int(sales or 0), 'revenue': float(revenue or 0)}
+        for category, sales, revenue in category_rows
+    ]
+    
+    return {
+        'revenue': {
+            'total': float(total_revenue),
+            'change': round(revenue_change, 1),
+            'trend': 'up' if revenue_change >= 0 else 'down'
+        },
+        'orders': {
+            'total': int(total_orders),
+            'change': round(orders_change, 1),
+            'trend': 'up' if orders_change >= 0 else 'down'
+        },
+        'customers': {
+            'total': total_customers,
+            'change': customers_change,
+            'trend': 'up' if customers_change >= 0 else 'down'
+        },
+        'products': {
+            'total': total_products,
+            'change': 0,  # Can be calculated if needed
+            'trend': 'up'
+        },
+        'revenueData': revenue_data,
+        'topProducts': top_products,
+        'categoryData': category_data
+    }
+
+
+def snapshot(key, compute):
+    """(payload, age in seconds) of a dashboard snapshot. Once older than
+    ANALYTICS_SNAPSHOT_SECONDS it is still served while one background thread recomputes it.
+    """
+    app = current_app._get_current_object()
+    
+    def run():
+        with app.app_context():
+            try:
+                return compute()
+            finally:
+                db.session.remove()
+    
+    return analytics_snapshots.get(key, run)
+
 
 @analytics_bp.route('/admin/analytics', methods=['GET'])
 def get_analytics():
-    """Get analytics data for admin dashboard"""
+    """Get analytics data for admin dashboard (served from a snapshot, see snapshot())"""
     try:
-        # Get total revenue from all orders
-        total_revenue = db.session.query(func.sum(Order.total)).scalar() or 0
-        
-        # Get total orders count
-        total_orders = Order.query.count()
-        
-        # Get total customers (users count)
-        total_customers = User.query.count()
-        
-        # Get total products count
-        total_products = Product.query.count()
-        
-        # Calculate trends (compare last 30 days vs previous 30 days)
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        sixty_days_ago = datetime.utcnow() - timedelta(days=60)
-        
-        # Revenue trend
-        recent_revenue = db.session.query(func.sum(Order.total)).filter(
-            Order.created_at >= thirty_days_ago
-        ).scalar() or 0
-        previous_revenue = db.session.query(func.sum(Order.total)).filter(
-            Order.created_at >= sixty_days_ago,
-            Order.created_at < thirty_days_ago
-        ).scalar() or 0
-        revenue_change = ((recent_revenue - previous_revenue) / previous_revenue * 100) if previous_revenue > 0 else 0
-        
-        # Orders trend
-        recent_orders = Order.query.filter(Order.created_at >= thirty_days_ago).count()
-        previous_orders = Order.query.filter(
-            Order.created_at >= sixty_days_ago,
-            Order.created_at < thirty_days_ago
-        ).count()
-        orders_change = ((recent_orders - previous_orders) / previous_orders * 100) if previous_orders > 0 else 0
-        
-        # Get last 6 months of revenue data
-        revenue_data = []
-        for i in range(5, -1, -1):
-            month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0) - timedelta(days=30*i)
-            month_end = month_start + timedelta(days=30)
-            
-            month_revenue = db.session.query(func.sum(Order.total)).filter(
-                Order.created_at >= month_start,
-                Order.created_at < month_end
-            ).scalar() or 0
-            
-            month_orders = Order.query.filter(
-                Order.created_at >= month_start,
-                Order.created_at < month_end
-            ).count()
-            
-            revenue_data.append({
-                'month': month_start.strftime('%b'),
-                'revenue': float(month_revenue),
-                'orders': month_orders
-            })
-        
-        # Get top products (from order items)
-        # Aggregate all items from all orders
-        all_orders = Order.query.all()
-        product_sales = {}
-        
-        for order in all_orders:
-            if order.items:
-                for item in order.items:
-                    product_name = item.get('productName') or item.get('name', 'Unknown')
-                    price = float(item.get('price', 0))
-                    quantity = int(item.get('quantity', 0))
-                    
-                    if product_name not in product_sales:
-                        product_sales[product_name] = {'sales': 0, 'revenue': 0}
-                    
-                    product_sales[product_name]['sales'] += quantity
-                    product_sales[product_name]['revenue'] += price * quantity
-        
-        # Sort by sales and get top 5
-        top_products = [
-            {'name': name, 'sales': data['sales'], 'revenue': data['revenue']}
-            for name, data in sorted(product_sales.items(), key=lambda x: x[1]['sales'], reverse=True)[:5]
-        ]
-        
-        # Get category data (from order items)
-        category_sales = {}
-        
-        for order in all_orders:
-            if order.items:
-                for item in order.items:
-                    category = item.get('category', 'Other')
-                    price = float(item.get('price', 0))
-                    quantity = int(item.get('quantity', 0))
-                    
-                    if category not in category_sales:
-                        category_sales[category] = {'sales': 0, 'revenue': 0}
-                    
-                    category_sales[category]['sales'] += quantity
-                    category_sales[category]['revenue'] += price * quantity
-        
-        # Format category data
-        category_data = [
-            {'category': category.capitalize(), 'sales': data['sales'], 'revenue': data['revenue']}
-            for category, data in category_sales.items()
-        ]
-        
+        data, age = snapshot('analytics', _compute_analytics)
+        return jsonify({**data, 'snapshotAge': round(age, 1)})
+    except Exception as e:
+        return jsonify({'error': 'Failed to fetch analytics', 'details': str(e)}), 500
+
+
+@analytics_bp.route('/admin/analytics/timeseries', methods=['GET'])
+@admin_required
+def get_timeseries():
+    """Revenue, orders and units per day, week or month over a date range.
+    Query: granularity=day|week|month (default day), from/to=YYYY-MM-DD (inclusive, default recent buckets).
+    """
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        return jsonify({'error': f"granularity must be one of {', '.join(GRANULARITIES)}"}), 400
+    try:
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else datetime.utcnow().date()
+        if request.args.get('from'):
+            start = date.fromisoformat(request.args['from'])
+        else:
+            start = end
+            for _ in range(DEFAULT_BUCKETS[granularity] - 1):
+                start = _bucket_start(start, granularity) - timedelta(days=1)
+            start = _bucket_start(start, granularity)
+    except ValueError:
+        return jsonify({'error': 'from/to must be dates (YYYY-MM-DD)'}), 400
+    if start > end:
+        return jsonify({'error': 'from must not be after to'}), 400
+    
+    buckets = {'day': (end - start).days + 1, 'week': (end - start).days // 7 + 2,
+               'month': (end.year - start.year) * 12 + end.month - start.month + 1}[granularity]
+    if buckets > MAX_BUCKETS:
+        return jsonify({'error': f'Range too large (at most {MAX_BUCKETS} {granularity} buckets)'}), 400
+    
+    try:
+        series = revenue_series(start, end, granularity)
         return jsonify({
-            'revenue': {
-                'total': float(total_revenue),
-                'change': round(revenue_change, 1),
-                'trend': 'up' if revenue_change >= 0 else 'down'
-            },
-            'orders': {
-                'total': total_orders,
-                'change': round(orders_change, 1),
-                'trend': 'up' if orders_change >= 0 else 'down'
-            },
-            'customers': {
-                'total': total_customers,
-                'change': 0,  # Can be calculated if needed
-                'trend': 'up'
-            },
-            'products': {
-                'total': total_products,
-                'change': 0,  # Can be calculated if needed
-                'trend': 'up'
-            },
-            'revenueData': revenue_data,
-            'topProducts': top_products,
-            'categoryData': category_data
+            'granularity': granularity,
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'series': series
         })
-        
     except Exception as e:
-        return jsonify({'error': 'Failed to fetch analytics', 'details': str(e)}), 500
+        return jsonify({'error': 'Failed to fetch time series', 'details': str(e)}), 500
+
+
+@analytics_bp.route('/admin/analytics/query', methods=['POST'])
+@admin_required
+def query_analytics():
+    """Ad-hoc group-by / filter / top-k query over the columnar order store (see columnar.run_query).
+    Body: {groupBy, filters: {from, to, status, category, productId}, orderBy, limit}
+    """
+    spec = request.get_json() or {}
+    try:
+        return jsonify(columnar.run_query(spec))
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': 'Invalid query', 'details': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': 'Failed to run query', 'details': str(e)}), 500
+
+
+@analytics_bp.route('/admin/analytics/customers', methods=['GET'])
+@admin_required
+def get_customer_analytics():
+    """RFM segments, cohort retention and top customers, as stored by the customer analytics job"""
+    try:
+        result = db.session.get(AnalyticsResult, customers.RESULT_NAME)
+        if not result:
+            return jsonify({'error': 'Customer analytics have not been computed yet'}), 404
+        return jsonify({**result.data, 'computedAt': result.computed_at.isoformat()})
+    except Exception as e:
+        return jsonify({'error': 'Failed to fetch customer analytics', 'details': str(e)}), 500
+
+
+@analytics_bp.route('/admin/analytics/quantiles', methods=['GET'])
+@admin_required
+def get_quantiles():
+    """p50/p95/p99 (or ?q=0.5,0.9,...) of order totals or request latency (ms) over a date range,
+    merged from the daily sketches (see sketches.py).
+    Query: metric=order_total|latency, from/to=YYYY-MM-DD (inclusive, default today),
+    endpoint="GET /api/products" (latency only; without it each endpoint is listed too).
+    """
+    metric = request.args.get('metric', 'order_total')
+    if metric not in sketches.METRICS:
+        return jsonify({'error': f"metric must be one of {', '.join(sketches.METRICS)}"}), 400
+    try:
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else datetime.utcnow().date()
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') else end
+        qs = [float(q) for q in request.args.get('q', '0.5,0.95,0.99').split(',')]
+    except ValueError:
+        return jsonify({'error': 'from/to must be dates (YYYY-MM-DD) and q numbers'}), 400
+    if start > end:
+        return jsonify({'error': 'from must not be after to'}), 400
+    if not qs or any(q < 0 or q > 1 for q in qs):
+        return jsonify({'error': 'q must be between 0 and 1'}), 400
+    
+    def summary(digest):
+        values = digest.quantiles(qs)
+        return {
+            'count': int(digest.count),
+            'min': digest.min,
+            'max': digest.max,
+            'quantiles': {f"p{q * 100:g}": None if v is None else round(v, 2) for q, v in zip(qs, values)},
+        }
+    
+    try:
+        endpoint = request.args.get('endpoint')
+        payload = {'metric': metric, 'from': start.isoformat(), 'to': end.isoformat()}
+        if metric == 'latency' and not endpoint:
+            per_endpoint = sketches.merged(metric, start, end, by_key=True)
+            overall = sketches.TDigest()
+            for digest in per_endpoint.values():
+                overall.merge(digest)
+            payload.update(summary(overall))
+            payload['endpoints'] = sorted(
+                ({'endpoint': key, **summary(digest)} for key, digest in per_endpoint.items()),
+                key=lambda row: -row['count']
+            )
+        else:
+            key = endpoint if metric == 'latency' else ''
+            payload.update(summary(sketches.merged(metric, start, end, key=key)))
+        return jsonify(payload)
+    except Exception as e:
+        return jsonify({'error': 'Failed to fetch quantiles', 'details': str(e)}), 500
@@ -3,20 +3,6 @@ from extensions import db
 from models import User
 from utils import hash_password, verify_password, generate_token, token_required
 
-def admin_required(f):
-    from functools import wraps
-    from flask import request, jsonify
-
-    @wraps(f)
-    @token_required
-    def decorated(*args, **kwargs):
-        # token_required decorator has already set request.user_id
-        user = User.query.get(request.user_id)
-        if not user or not getattr(user, 'is_admin', False):
-            return jsonify({'error': 'forbidden'}), 403
-        return f(*args, **kwargs)
-    return decorated
-
 auth_bp = Blueprint('auth', __name__)
 
 
@@ -1,9 +1,19 @@
 from flask import Blueprint, request, jsonify
-from utils import token_required, get_current_user_id
-from models import Order, CartItem, User, Product
+from utils import token_required, admin_required, get_current_user_id
+from models import Order, OrderEvent, ScheduledTransition, CartItem, User, Product, ProductRating, ProductRatingStats
 from extensions import db
-from order_queue import order_queue
+from counters import increment_row
+from inventory import stock_changed
+from rollups import apply_order, counts_as_sale, VOID_STATUSES
+from sketches import sketch_recorder
+from sqlalchemy.exc import IntegrityError
+from event_hub import order_event_hub, event_from_row, stream_response, last_event_id
+from order_transitions import (
+    set_order_status, get_cached_status, status_cache, restock_orders, status_change_error,
+    CANCELLABLE_STATUSES, REFUNDABLE_STATUSES,
+)
 from datetime import datetime
+import uuid
 
 orders_bp = Blueprint('orders', __name__)
 
@@ -19,22 +29,55 @@ def get_order(order_id):
     order = Order.query.get(order_id)
     if not order:
         return jsonify({'error': 'not found'}), 404
-    
-    # Update order status from queue if available
-    try:
-        queue_status = order_queue.get_order_status(order_id)
-        if queue_status and queue_status != order.status:
-            order.status = queue_status
-            db.session.commit()
-    except Exception:
-        pass  # Use DB status if queue check fails
-    
+    # Read-only: status transitions are persisted by the queue and the routes below
     return jsonify(order.to_dict())
 
 
+@orders_bp.route('/orders/<order_id>/status', methods=['GET'])
+def get_order_status(order_id):
+    """Lightweight status lookup for polling clients (served from the status cache)"""
+    status = get_cached_status(order_id)
+    if status is None:
+        return jsonify({'error': 'Order not found'}), 404
+    return jsonify({'id': order_id, 'status': status})
+
+
+@orders_bp.route('/orders/<order_id>/timeline', methods=['GET'])
+def get_order_timeline(order_id):
+    """Status history of an order, oldest first"""
+    events = OrderEvent.query.filter_by(order_id=order_id).order_by(OrderEvent.created_at, OrderEvent.id).all()
+    if not events and not Order.query.get(order_id):
+        return jsonify({'error': 'Order not found'}), 404
+    return jsonify([e.to_dict() for e in events])
+
+
+@orders_bp.route('/orders/<order_id>/events', methods=['GET'])
+def stream_order_events(order_id):
+    """Server-Sent Events stream of an order's status changes.
+    Starts with the current status; on reconnect (Last-Event-ID) replays what was missed.
+    """
+    order = Order.query.get(order_id)
+    if not order:
+        return jsonify({'error': 'Order not found'}), 404
+    
+    sub = order_event_hub.subscribe(order_id=order_id)
+    events = OrderEvent.query.filter(OrderEvent.order_id == order_id)
+    after_id = last_event_id(request)
+    if after_id is not None:
+        missed = events.filter(OrderEvent.id > after_id).order_by(OrderEvent.id).all()
+        initial = [event_from_row(e, order.user_id) for e in missed]
+    else:
+        latest = events.order_by(OrderEvent.id.desc()).first()
+        initial = [event_from_row(latest, order.user_id)] if latest else [
+            {'id': None, 'orderId': order.id, 'userId': order.user_id, 'status': order.status, 'fromStatus': None, 'at': None}
+        ]
+    return stream_response(sub, initial)
+
+
 @orders_bp.route('/orders/<order_id>/status', methods=['PUT'])
+@admin_required
 def update_order_status(order_id):
-    """Update order status"""
+    """Update order status (admin)"""
     order = Order.query.get(order_id)
     if not order:
         return jsonify({'error': 'Order not found'}), 404
@@ -42,11 +85,14 @@ def update_order_status(order_id):
     data = request.get_json() or {}
     new_status = data.get('status')
     
-    if not new_status:
-        return jsonify({'error': 'Status is required'}), 400
+    error = status_change_error(new_status)
+    if error:
+        return jsonify({'error': error}), 400
+    if order.status in VOID_STATUSES:
+        return jsonify({'error': f'Cannot change status of a {order.status} order'}), 400
     
     try:
-        order.status = new_status
+        set_order_status(order, new_status, source='admin')
         db.session.commit()
         return jsonify(order.to_dict())
     except Exception as e:
@@ -73,7 +119,7 @@ def confirm_receipt(order_id):
         return jsonify({'error': 'Can only confirm receipt for delivered orders'}), 400
     
     try:
-        order.status = 'received'
+        set_order_status(order, 'received', source='customer')
         db.session.commit()
         return jsonify(order.to_dict())
     except Exception as e:
@@ -89,8 +135,12 @@ def delete_order(order_id):
         return jsonify({'error': 'Order not found'}), 404
     
     try:
+        if counts_as_sale(order.status):
+            apply_order(order, -1)
         db.session.delete(order)
+        ScheduledTransition.query.filter_by(order_id=order_id).delete()
         db.session.commit()
+        status_cache.pop(order_id)
         return jsonify({'message': 'Order deleted successfully', 'id': order_id})
     except Exception as e:
         db.session.rollback()
@@ -135,9 +185,11 @@ def checkout():
                 }), 400
             
             # Reduce stock
+            stock_changed(product.id, product.stock, product.stock - quantity)
             product.stock -= quantity
         
         order = Order(
+            id=str(uuid.uuid4()),
             user_id=user_id,
             customer_name=data.get('customerName'),
             customer_email=data.get('customerEmail'),
@@ -146,9 +198,9 @@ def checkout():
             items=items,
             total=float(total_value or 0),
             payment_method=payment_method,
-            status='processing'  # Initial status
         )
         db.session.add(order)
+        set_order_status(order, 'processing', source='checkout')  # Initial status
 
         # clear cart: prefer user cart if user is authenticated, else use x-session-id
         if user_id:
@@ -159,9 +211,8 @@ def checkout():
                 CartItem.query.filter_by(session_id=session_id).delete()
 
         db.session.commit()
-        
-        # Add order to processing queue
-        order_queue.add_order(order.id)
+        # (set_order_status scheduled the order in the processing queue)
+        sketch_recorder.record('order_total', '', order.total, order.created_at)
         
         # Log online payment orders for manual processing
         if payment_method == 'online':
@@ -189,8 +240,8 @@ def refund_order(order_id):
     if not order:
         return jsonify({'error': 'Order not found'}), 404
     
-    # Only allow refunding received orders
-    if order.status != 'received':
+    # Only allow refunding received orders (including pending refund requests)
+    if order.status not in REFUNDABLE_STATUSES:
         return jsonify({'error': 'Can only refund orders that have been received'}), 400
     
     # Check if already refunded
@@ -220,20 +271,13 @@ def refund_order(order_id):
     
     try:
         # Restore stock for refunded order
-        for item in order.items:
-            product_id = item.get('productId')
-            quantity = item.get('quantity', 0)
-            
-            if product_id and quantity > 0:
-                product = Product.query.get(product_id)
-                if product:
-                    product.stock += quantity
+        restock_orders([order])
         
         order.refunded_at = datetime.utcnow()
         order.refund_amount = refund_amount
         order.refund_reason = refund_reason
         order.rating = rating
-        order.status = 'refunded'
+        set_order_status(order, 'refunded', source='admin')
         db.session.commit()
         
         return jsonify({
@@ -245,15 +289,9 @@ def refund_order(order_id):
         return jsonify({'error': 'Failed to process refund', 'details': str(e)}), 500
 
 
-@orders_bp.route('/orders/<order_id>/receipt', methods=['GET'])
-def get_receipt(order_id):
-    """Get receipt data for an order"""
-    order = Order.query.get(order_id)
-    if not order:
-        return jsonify({'error': 'Order not found'}), 404
-    
-    # Build receipt data
-    receipt = {
+def receipt_payload(order):
+    """Receipt data for an order (an Order or a row with the same column names)"""
+    return {
         'orderId': order.id,
         'orderDate': order.created_at.isoformat() if order.created_at else None,
         'customer': {
@@ -270,6 +308,16 @@ def get_receipt(order_id):
         'refundedAt': order.refunded_at.isoformat() if order.refunded_at else None,
         'refundAmount': order.refund_amount,
     }
+
+
+@orders_bp.route('/orders/<order_id>/receipt', methods=['GET'])
+def get_receipt(order_id):
+    """Get receipt data for an order"""
+    order = Order.query.get(order_id)
+    if not order:
+        return jsonify({'error': 'Order not found'}), 404
+    
+    receipt = receipt_payload(order)
     
     return jsonify(receipt)
 
@@ -289,21 +337,14 @@ def cancel_order(order_id):
         return jsonify({'error': 'Unauthorized - This order does not belong to you'}), 403
     
     # Only allow canceling pending or processing orders
-    if order.status not in ['pending', 'processing']:
+    if order.status not in CANCELLABLE_STATUSES:
         return jsonify({'error': f'Cannot cancel order with status: {order.status}. Only pending or processing orders can be cancelled.'}), 400
     
     try:
         # Restore stock for cancelled order
-        for item in order.items:
-            product_id = item.get('productId')
-            quantity = item.get('quantity', 0)
-            
-            if product_id and quantity > 0:
-                product = Product.query.get(product_id)
-                if product:
-                    product.stock += quantity
+        restock_orders([order])
         
-        order.status = 'cancelled'
+        set_order_status(order, 'cancelled', source='customer')
         db.session.commit()
         return jsonify({
             'message': 'Order cancelled successfully',
@@ -346,7 +387,7 @@ def request_refund(order_id):
         return jsonify({'error': 'Please provide a reason for the refund request'}), 400
     
     try:
-        order.status = 'refund_requested'
+        set_order_status(order, 'refund_requested', source='customer')
         order.refund_reason = refund_reason
         db.session.commit()
         
@@ -402,21 +443,38 @@ def rate_product(order_id):
     if not product_in_order:
         return jsonify({'error': 'Product not found in this order'}), 400
     
+    if ProductRating.query.filter_by(user_id=user_id, order_id=order_id, product_id=product_id).first():
+        return jsonify({'error': 'You have already rated this product for this order'}), 409
+    
     try:
-        # Update product rating using weighted average
-        current_rating = float(product.rating or 0)
-        current_count = product.reviewCount or 0
-        new_count = current_count + 1
-        new_rating = ((current_rating * current_count) + rating) / new_count
+        db.session.add(ProductRating(user_id=user_id, order_id=order_id, product_id=product_id, rating=rating))
+        db.session.flush()
         
-        product.rating = str(round(new_rating, 1))
-        product.reviewCount = new_count
+        # Atomic increments; the first rating carries over the product's existing aggregate
+        increment_row(
+            ProductRatingStats,
+            {'product_id': product_id},
+            {'rating_sum': rating, 'rating_count': 1, f'count_{rating}': 1},
+            initial={
+                'rating_sum': float(product.rating or 0) * (product.reviewCount or 0),
+                'rating_count': product.reviewCount or 0,
+            },
+        )
+        stats = db.session.execute(
+            db.select(ProductRatingStats.rating_sum, ProductRatingStats.rating_count)
+            .where(ProductRatingStats.product_id == product_id)
+        ).one()
+        product.rating = str(round(stats.rating_sum / stats.rating_count, 1))
+        product.reviewCount = stats.rating_count
         db.session.commit()
         
         return jsonify({
             'message': 'Rating submitted successfully',
             'product': product.to_dict()
         })
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'You have already rated this product for this order'}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Failed to submit rating', 'details': str(e)}), 500
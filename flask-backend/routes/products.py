@@ -1,7 +1,9 @@
 from flask import Blueprint, jsonify, request, current_app
-from models import Product
+from models import Product, ProductRatingStats
 from extensions import db
 from sqlalchemy import cast, Float
+from similarity import mark_changed, TEXT_FIELDS
+from inventory import stock_changed
 import json
 
 products_bp = Blueprint('products', __name__)
@@ -128,7 +130,10 @@ def get_product(id):
     product = Product.query.get(id)
     if not product:
         return jsonify({'error': 'not found'}), 404
-    return jsonify(product.to_dict())
+    data = product.to_dict()
+    stats = ProductRatingStats.query.get(id)
+    data['ratingDistribution'] = stats.distribution() if stats else {str(i): 0 for i in range(1, 6)}
+    return jsonify(data)
 
 
 @products_bp.route('/categories', methods=['GET'])
@@ -175,6 +180,8 @@ def create_product():
             isActive=data.get('isActive', True)
         )
         db.session.add(product)
+        mark_changed(product.id)
+        stock_changed(product.id, 0, product.stock, event='created')
         db.session.commit()
         return jsonify(product.to_dict()), 201
     except Exception as e:
@@ -205,6 +212,7 @@ def update_product(id):
         if 'sku' in data:
             product.sku = data['sku']
         if 'stock' in data:
+            stock_changed(product.id, product.stock, int(data['stock']))
             product.stock = int(data['stock'])
         if 'imageUrl' in data:
             product.imageUrl = data['imageUrl']
@@ -216,6 +224,8 @@ def update_product(id):
             product.reviewCount = int(data['reviewCount'])
         if 'isActive' in data:
             product.isActive = data['isActive']
+        if any(field in data for field in TEXT_FIELDS):
+            mark_changed(product.id)
         
         db.session.commit()
         return jsonify(product.to_dict())
@@ -232,6 +242,8 @@ def delete_product(id):
     
     try:
         db.session.delete(product)
+        mark_changed(product.id)
+        stock_changed(product.id, product.stock, 0, event='deleted')
         db.session.commit()
         return '', 204
     except Exception as e:
@@ -1,10 +1,14 @@
 from flask import Blueprint, request, jsonify
-from utils import token_required, get_current_user_id
-from models import User, Order
+from utils import token_required, get_current_user_id, generate_token, verify_scoped_token
+from models import User, Order, OrderEvent
 from extensions import db
+from event_hub import order_event_hub, event_from_row, stream_response, last_event_id
 
 profile_bp = Blueprint('profile', __name__)
 
+EVENTS_TOKEN_SCOPE = 'order_events'
+EVENTS_TOKEN_SECONDS = 300
+
 
 @profile_bp.route('/profile', methods=['GET'])
 @token_required
@@ -115,3 +119,43 @@ def get_user_orders():
         print(f"[ERROR] get_user_orders failed: {e}")
         traceback.print_exc()
         return jsonify({'error': 'Failed to fetch orders', 'details': str(e)}), 500
+
+
+@profile_bp.route('/user/orders/events/token', methods=['POST'])
+@token_required
+def issue_order_events_token():
+    """Short-lived token for /user/orders/events?token=... (EventSource can't send an Authorization header)"""
+    user_id = get_current_user_id()
+    if not user_id:
+        return jsonify({'error': 'Unauthorized'}), 401
+    token = generate_token(user_id, scope=EVENTS_TOKEN_SCOPE, expires_in=EVENTS_TOKEN_SECONDS)
+    return jsonify({'token': token, 'expiresIn': EVENTS_TOKEN_SECONDS})
+
+
+@profile_bp.route('/user/orders/events', methods=['GET'])
+def stream_user_order_events():
+    """Server-Sent Events stream of status changes for all of the current user's orders.
+    Authenticated by an Authorization header or by ?token= from POST /user/orders/events/token
+    (only checked when connecting; an open stream is not cut off when the token expires).
+    """
+    if request.args.get('token'):
+        user_id = verify_scoped_token(request.args['token'], EVENTS_TOKEN_SCOPE)
+    else:
+        user_id = get_current_user_id()
+    if not user_id:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    sub = order_event_hub.subscribe(user_id=user_id)
+    initial = []
+    after_id = last_event_id(request)
+    if after_id is not None:
+        missed = (
+            db.session.query(OrderEvent)
+            .join(Order, Order.id == OrderEvent.order_id)
+            .filter(Order.user_id == user_id, OrderEvent.id > after_id)
+            .order_by(OrderEvent.id)
+            .limit(500)
+            .all()
+        )
+        initial = [event_from_row(e, user_id) for e in missed]
+    return stream_response(sub, initial)
@@ -1,16 +1,87 @@
 from flask import Blueprint, request, jsonify
 from extensions import db
-from models import Product
+from models import Product, ProductView, ProductNeighbor
 from utils import get_current_user_id
+from browsing_history import history_store, PER_KEY
+from view_events import view_event_buffer
+from cache import LRUCache, TTLCache
+from inventory import on_stock_change, availability_changed
+import cooccurrence
+import similarity
+import coview
+from popularity import top_products
 from datetime import datetime, timedelta
+import calendar
 import json
+import os
 
 recommendations_bp = Blueprint('recommendations', __name__)
 
 
-# In-memory storage for browsing history (in production, use Redis or database)
-# Format: {user_id or session_id: [(product_id, timestamp), ...]}
-browsing_history = {}
+MAX_BATCH_EVENTS = 100
+
+# history keys already warmed from product_views in this process
+_warmed_keys = LRUCache(max_size=50000)
+
+# (productId, recent history, limit) -> recommendation payloads, tagged with the product ids they contain
+RECOMMENDATIONS_CACHE_SECONDS = int(os.environ.get('RECOMMENDATIONS_CACHE_SECONDS', 30))
+_recommendation_cache = TTLCache(max_size=10000, ttl=RECOMMENDATIONS_CACHE_SECONDS)
+
+
+@on_stock_change
+def _invalidate_on_stock_change(changes):
+    """Drop cached recommendations showing a product whose stock changed"""
+    for change in changes:
+        _recommendation_cache.invalidate_tag(change['product_id'])
+    if any(availability_changed(change) for change in changes):
+        top_products.invalidate()
+
+
+def _history_key():
+    """Browsing history key: the user if authenticated, else the x-session-id"""
+    user_id = get_current_user_id()
+    return f"user_{user_id}" if user_id else f"session_{request.headers.get('x-session-id', 'default')}"
+
+
+def _recent_history(key, limit):
+    """Recent views for a key, reloaded from product_views if this process has none (e.g. after a restart)"""
+    history = history_store.recent(key, limit)
+    if not history and key not in _warmed_keys:
+        _warmed_keys.set(key, True)
+        rows = (
+            db.session.query(ProductView.product_id, ProductView.viewed_at)
+            .filter(ProductView.history_key == key)
+            .order_by(ProductView.viewed_at.desc())
+            .limit(PER_KEY * 2)
+            .all()
+        )
+        for product_id, viewed_at in reversed(rows):
+            history_store.record(key, product_id, calendar.timegm(viewed_at.timetuple()))
+        history = history_store.recent(key, limit)
+    return history
+
+
+def _parse_viewed_at(value, now):
+    """Accept epoch milliseconds or an ISO string; never in the future"""
+    if value is None:
+        return now
+    if isinstance(value, (int, float)):
+        viewed_at = datetime.utcfromtimestamp(value / 1000.0)
+    else:
+        viewed_at = datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=None)
+    return min(viewed_at, now)
+
+
+def _track_views(views):
+    """Record [(product_id, viewed_at)] in the history store and the write-behind buffer"""
+    key = _history_key()
+    user_id = get_current_user_id()
+    for product_id, viewed_at in sorted(views, key=lambda v: v[1]):
+        history_store.record(key, product_id, calendar.timegm(viewed_at.timetuple()))
+    view_event_buffer.add([
+        {'history_key': key, 'user_id': user_id, 'product_id': str(product_id), 'viewed_at': viewed_at}
+        for product_id, viewed_at in views
+    ])
 
 
 @recommendations_bp.route('/browsing-history', methods=['POST'])
@@ -22,37 +93,46 @@ def add_to_browsing_history():
     if not product_id:
         return jsonify({'error': 'productId required'}), 400
     
-    # Get user or session identifier
-    user_id = get_current_user_id()
-    key = f"user_{user_id}" if user_id else f"session_{request.headers.get('x-session-id', 'default')}"
-    
-    # Initialize history if not exists
-    if key not in browsing_history:
-        browsing_history[key] = []
+    _track_views([(product_id, datetime.utcnow())])
     
-    # Add to history (most recent first)
-    timestamp = datetime.utcnow().isoformat()
-    browsing_history[key] = [(product_id, timestamp)] + [
-        (pid, ts) for pid, ts in browsing_history[key] if pid != product_id
-    ]
+    return jsonify({'ok': True})
+
+
+@recommendations_bp.route('/browsing-history/batch', methods=['POST'])
+def add_browsing_history_batch():
+    """Track many product views in one call (suitable for navigator.sendBeacon).
+    Body: {events: [{productId, viewedAt?: epoch ms or ISO string}, ...]}
+    """
+    # sendBeacon posts text/plain, so don't insist on a JSON content type
+    data = request.get_json(force=True, silent=True) or {}
+    events = data.get('events')
+    if not isinstance(events, list) or not events:
+        return jsonify({'error': 'events required'}), 400
+    if len(events) > MAX_BATCH_EVENTS:
+        return jsonify({'error': f'At most {MAX_BATCH_EVENTS} events per batch'}), 400
     
-    # Keep only last 50 items
-    browsing_history[key] = browsing_history[key][:50]
+    now = datetime.utcnow()
+    views = []
+    try:
+        for event in events:
+            product_id = event.get('productId')
+            if product_id:
+                views.append((product_id, _parse_viewed_at(event.get('viewedAt'), now)))
+    except (AttributeError, TypeError, ValueError, OverflowError, OSError):
+        return jsonify({'error': 'Invalid event'}), 400
     
-    return jsonify({'ok': True})
+    _track_views(views)
+    return jsonify({'ok': True, 'accepted': len(views)})
 
 
 @recommendations_bp.route('/browsing-history', methods=['GET'])
 def get_browsing_history():
     """Get user's browsing history with product details"""
-    user_id = get_current_user_id()
-    key = f"user_{user_id}" if user_id else f"session_{request.headers.get('x-session-id', 'default')}"
-    
-    history = browsing_history.get(key, [])
     limit = int(request.args.get('limit', 10))
+    history = _recent_history(_history_key(), limit)
     
     # Get product details for history items
-    product_ids = [pid for pid, _ in history[:limit]]
+    product_ids = [pid for pid, _ in history]
     products = Product.query.filter(Product.id.in_(product_ids)).all() if product_ids else []
     
     # Create dict for quick lookup
@@ -60,90 +140,153 @@ def get_browsing_history():
     
     # Return products in order of browsing history
     result = []
-    for pid, timestamp in history[:limit]:
+    for pid, timestamp in history:
         if pid in products_dict:
             product = products_dict[pid]
-            product['viewedAt'] = timestamp
+            product['viewedAt'] = datetime.utcfromtimestamp(timestamp).isoformat()
             result.append(product)
     
     return jsonify(result)
 
 
+def _resolve_recommendations(current_product_id, history_ids, limit):
+    """Recommendation payloads, in priority order:
+    1. content neighbours of the current product,
+    2. session co-view neighbours of the browsing history (more recent views weigh more),
+    3. same-category products, only for products whose neighbours aren't computed yet,
+    4. the globally most popular products (in memory).
+    Strategies 1 and 2 are resolved together in one query joining the precomputed
+    neighbour lists to their products.
+    """
+    excluded = set(history_ids)
+    if current_product_id:
+        excluded.add(current_product_id)
+    
+    conditions = []
+    if current_product_id:
+        conditions.append(db.and_(
+            ProductNeighbor.kind == similarity.KIND,
+            ProductNeighbor.product_id == current_product_id
+        ))
+    if history_ids:
+        conditions.append(db.and_(
+            ProductNeighbor.kind == coview.KIND,
+            ProductNeighbor.product_id.in_(history_ids)
+        ))
+    
+    similar, co_viewed, scores = [], {}, {}
+    if conditions:
+        weight = {pid: 1.0 / (i + 1) for i, pid in enumerate(history_ids)}
+        rows = (
+            db.session.query(ProductNeighbor.kind, ProductNeighbor.product_id,
+                             ProductNeighbor.rank, ProductNeighbor.score, Product)
+            .join(Product, Product.id == ProductNeighbor.neighbor_id)
+            .filter(db.or_(*conditions), Product.stock > 0)
+            .all()
+        )
+        for kind, seed_id, rank, score, product in rows:
+            if kind == similarity.KIND:
+                if product.id != current_product_id:
+                    similar.append((rank, product))
+            elif product.id not in excluded:
+                scores[product.id] = scores.get(product.id, 0) + weight[seed_id] * score
+                co_viewed[product.id] = product
+    
+    candidates = [p for _, p in sorted(similar, key=lambda rp: rp[0])]
+    candidates += sorted(co_viewed.values(), key=lambda p: -scores[p.id])
+    
+    # Cold start: category of the current product / history until neighbours exist
+    seeds = []
+    if current_product_id and not similar:
+        seeds.append(current_product_id)
+    if history_ids and not co_viewed:
+        seeds.extend(history_ids)
+    if seeds and len(candidates) < limit:
+        categories = {
+            category for (category,) in
+            db.session.query(Product.category).filter(Product.id.in_(seeds), Product.category.isnot(None))
+        }
+        if categories:
+            candidates += Product.query.filter(
+                Product.category.in_(categories),
+                Product.id.notin_(excluded),
+                Product.stock > 0
+            ).limit(limit).all()
+    
+    result, seen = [], set()
+    for product in candidates:
+        if product.id not in seen:
+            seen.add(product.id)
+            result.append(product.to_dict())
+    result = result[:limit]
+    
+    # Popular products (precomputed popularity, served from memory)
+    if len(result) < limit:
+        recommended_ids = seen | excluded
+        popular = top_products.get(limit - len(result), exclude=recommended_ids)
+        if not popular:
+            # scores not computed yet: highest rated with stock
+            popular = [p.to_dict() for p in Product.query.filter(
+                Product.id.notin_(recommended_ids) if recommended_ids else True,
+                Product.stock > 0
+            ).order_by(
+                db.desc(db.cast(Product.rating, db.Float))
+            ).limit(limit - len(result)).all()]
+        result.extend(popular)
+    
+    return result
+
+
 @recommendations_bp.route('/recommendations', methods=['GET'])
 def get_recommendations():
-    """Get product recommendations based on browsing history and current context"""
-    user_id = get_current_user_id()
-    key = f"user_{user_id}" if user_id else f"session_{request.headers.get('x-session-id', 'default')}"
+    """Get product recommendations based on browsing history and current context.
+    Results are cached per (productId, recent history, limit) for a short time.
+    """
+    key = _history_key()
     
     # Get current product context (if viewing a product)
     current_product_id = request.args.get('productId')
     limit = int(request.args.get('limit', 6))
+    history_ids = [pid for pid, _ in _recent_history(key, 10)]
     
-    recommendations = []
-    
-    # Strategy 1: If viewing a product, recommend similar products (same category)
-    if current_product_id:
-        current_product = Product.query.get(current_product_id)
-        if current_product and current_product.category:
-            similar = Product.query.filter(
-                Product.category == current_product.category,
-                Product.id != current_product_id,
-                Product.stock > 0
-            ).limit(limit).all()
-            recommendations.extend(similar)
-    
-    # Strategy 2: Recommend from categories in browsing history
-    if len(recommendations) < limit:
-        history = browsing_history.get(key, [])
-        if history:
-            # Get categories from browsing history
-            recent_product_ids = [pid for pid, _ in history[:10]]
-            recent_products = Product.query.filter(Product.id.in_(recent_product_ids)).all()
-            categories = list(set([p.category for p in recent_products if p.category]))
-            
-            if categories:
-                # Get products from these categories (excluding already recommended)
-                recommended_ids = [r.id for r in recommendations]
-                more_products = Product.query.filter(
-                    Product.category.in_(categories),
-                    Product.id.notin_(recommended_ids + recent_product_ids) if recommended_ids else Product.id.notin_(recent_product_ids),
-                    Product.stock > 0
-                ).limit(limit - len(recommendations)).all()
-                recommendations.extend(more_products)
-    
-    # Strategy 3: Popular products (highest rated with stock)
-    if len(recommendations) < limit:
-        recommended_ids = [r.id for r in recommendations]
-        popular = Product.query.filter(
-            Product.id.notin_(recommended_ids) if recommended_ids else True,
-            Product.stock > 0
-        ).order_by(
-            db.desc(Product.rating)
-        ).limit(limit - len(recommendations)).all()
-        recommendations.extend(popular)
-    
-    # Convert to dict and shuffle slightly to avoid monotony
-    result = [p.to_dict() for p in recommendations[:limit]]
+    cache_key = (current_product_id, tuple(history_ids), limit)
+    result = _recommendation_cache.get(cache_key)
+    if result is None:
+        result = _resolve_recommendations(current_product_id, history_ids, limit)
+        _recommendation_cache.set(cache_key, result, tags=[p['id'] for p in result])
     
     return jsonify(result)
 
 
 @recommendations_bp.route('/frequently-bought-together', methods=['GET'])
 def get_frequently_bought_together():
-    """Get products frequently bought together (simplified version)"""
+    """Get products frequently bought together, from the precomputed order co-occurrence neighbours"""
     product_id = request.args.get('productId')
     
     if not product_id:
         return jsonify({'error': 'productId required'}), 400
     
-    # Get the current product to find similar category
+    frequently_bought = (
+        Product.query
+        .join(ProductNeighbor, ProductNeighbor.neighbor_id == Product.id)
+        .filter(
+            ProductNeighbor.kind == cooccurrence.KIND,
+            ProductNeighbor.product_id == product_id,
+            Product.stock > 0
+        )
+        .order_by(ProductNeighbor.rank)
+        .limit(4)
+        .all()
+    )
+    if frequently_bought:
+        return jsonify([p.to_dict() for p in frequently_bought])
+    
+    # Cold start (no orders containing this product yet): fall back to complementary categories
     current_product = Product.query.get(product_id)
     
     if not current_product:
         return jsonify([])
     
-    # For now, return products from the same category and complementary categories
-    # In production, this would analyze actual order data
     complementary_categories = {
         'phones': ['accessories', 'cases'],
         'laptops': ['accessories', 'bags'],
@@ -153,7 +296,6 @@ def get_frequently_bought_together():
     
     target_categories = complementary_categories.get(current_product.category, [current_product.category])
     
-    # Get products from complementary categories
     frequently_bought = Product.query.filter(
         Product.category.in_(target_categories),
         Product.id != product_id,
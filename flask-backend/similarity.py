@@ -0,0 +1,311 @@
+"""
+Similar Products
+Content-based neighbours: each product's name, brand, description and
+specifications are turned into an L2-normalised TF-IDF vector and the top-k
+products by cosine similarity are stored in product_neighbors (kind
+'similar'), so "similar products" is a single indexed lookup.
+
+Product writes mark the product in product_changes; each refresh re-ranks
+the changed products plus any product whose list they enter or leave.
+IDF weights drift as the catalogue changes, so the whole index is rebuilt
+every FULL_REBUILD_SECONDS.
+
+Vectors are sparse (see SparseIndex). The vocabulary and IDF of the last
+full rebuild are kept in the job state and the index in memory, so an
+incremental run only vectorises the changed products; a process without
+the index (e.g. after a restart) vectorises the catalogue once with the
+stored vocabulary.
+
+Run a full rebuild with:  python similarity.py --full
+"""
+
+import json
+import math
+import re
+from collections import Counter
+from datetime import datetime, timedelta
+import numpy as np
+from extensions import db
+
+KIND = 'similar'
+TOP_K = 10
+MAX_FEATURES = 4096
+BATCH_SIZE = 512
+BATCH_CELLS = 4 * 1024 * 1024  # dense similarity block per batch (rows x products)
+REFRESH_SECONDS = 60
+FULL_REBUILD_SECONDS = 86400
+FIELD_WEIGHTS = {'name': 3, 'brand': 2, 'description': 1, 'specifications': 1}
+TEXT_FIELDS = tuple(FIELD_WEIGHTS)
+
+_index = None  # SparseIndex of the current build, kept between runs in this process
+
+_TOKEN = re.compile(r'[a-z0-9]+(?:\.[0-9]+)?')
+STOP_WORDS = frozenset(
+    'a an and are as at be by for from in is it of on or the this to with'.split()
+)
+
+
+def tokenize(text):
+    return [t for t in _TOKEN.findall((text or '').lower()) if t not in STOP_WORDS]
+
+
+def product_terms(product):
+    """Weighted term counts for a product row (name, brand, description, specifications)"""
+    terms = Counter()
+    try:
+        specs = json.loads(product.specifications) if product.specifications else {}
+    except ValueError:
+        specs = {}
+    spec_text = ' '.join(f"{k} {v}" for k, v in specs.items()) if isinstance(specs, dict) else str(specs)
+    fields = {
+        'name': product.name,
+        'brand': product.brand,
+        'description': product.description,
+        'specifications': spec_text,
+    }
+    for field, text in fields.items():
+        for token in tokenize(text):
+            terms[token] += FIELD_WEIGHTS[field]
+    return terms
+
+
+def tfidf_vocabulary(documents, max_features=MAX_FEATURES):
+    """(vocabulary, smoothed idf) of the `max_features` most frequent terms over a list of term Counters"""
+    df = Counter()
+    for terms in documents:
+        df.update(terms.keys())
+    vocabulary = [t for t, _ in sorted(df.items(), key=lambda item: (-item[1], item[0]))[:max_features]]
+    n = len(documents)
+    return vocabulary, [math.log((1 + n) / (1 + df[t])) + 1 for t in vocabulary]
+
+
+class SparseIndex:
+    """
+    L2-normalised TF-IDF rows (sublinear tf) for a fixed vocabulary, stored
+    sparse: one (columns, values) pair per product, packed into CSR arrays and
+    an inverted (CSC) copy for scoring. Products can be replaced or removed
+    without touching the other rows; removed rows stay as empty vectors until
+    the next full rebuild.
+    """
+
+    def __init__(self, vocabulary, idf, built=None):
+        self.column = {t: i for i, t in enumerate(vocabulary)}
+        self.idf = np.asarray(idf, dtype=np.float32)
+        self.built = built
+        self.ids = []
+        self.row_of = {}
+        self._vectors = []
+        self._packed = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def vectorize(self, terms):
+        entries = sorted((self.column[t], 1 + math.log(count)) for t, count in terms.items() if t in self.column)
+        if not entries:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        cols = np.array([col for col, _ in entries], dtype=np.int32)
+        values = np.array([tf for _, tf in entries], dtype=np.float32) * self.idf[cols]
+        return cols, values / np.linalg.norm(values)
+
+    def set(self, product_id, terms):
+        row = self.row_of.get(product_id)
+        if row is None:
+            row = self.row_of[product_id] = len(self.ids)
+            self.ids.append(product_id)
+            self._vectors.append(None)
+        self._vectors[row] = self.vectorize(terms)
+        self._packed = None
+
+    def remove(self, product_id):
+        row = self.row_of.pop(product_id, None)
+        if row is not None:
+            self.ids[row] = None
+            self._vectors[row] = (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+            self._packed = None
+
+    def _pack(self):
+        if self._packed is None:
+            lengths = np.array([len(cols) for cols, _ in self._vectors], dtype=np.int64)
+            indices = np.concatenate([cols for cols, _ in self._vectors] or [np.empty(0, dtype=np.int32)])
+            values = np.concatenate([vals for _, vals in self._vectors] or [np.empty(0, dtype=np.float32)])
+            indptr = np.r_[0, np.cumsum(lengths)]
+            rows = np.repeat(np.arange(len(self._vectors)), lengths)
+            by_column = np.argsort(indices, kind='stable')
+            col_ptr = np.r_[0, np.cumsum(np.bincount(indices, minlength=len(self.column)))]
+            self._packed = (indptr, indices, values, col_ptr, rows[by_column], values[by_column])
+        return self._packed
+
+    def similarities(self, rows):
+        """Yield (batch of rows, dense batch x products cosine similarities); the
+        dense block is kept around BATCH_CELLS values
+        """
+        indptr, indices, values, col_ptr, col_rows, col_values = self._pack()
+        n = len(self.ids)
+        rows = np.asarray(rows, dtype=np.int64)
+        batch_size = max(1, min(BATCH_SIZE, BATCH_CELLS // max(n, 1)))
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            sims = np.zeros((len(batch), n), dtype=np.float64)
+            for i, row in enumerate(batch):
+                cols, vals = indices[indptr[row]:indptr[row + 1]], values[indptr[row]:indptr[row + 1]]
+                lengths = col_ptr[cols + 1] - col_ptr[cols]
+                # positions of every posting of the row's columns, without a Python loop per column
+                postings = np.repeat(col_ptr[cols] - np.r_[0, np.cumsum(lengths)[:-1]], lengths) + np.arange(lengths.sum())
+                sims[i] = np.bincount(col_rows[postings], weights=col_values[postings] * np.repeat(vals, lengths), minlength=n)
+            yield batch, sims
+
+
+def top_k_similar(index, rows, k=TOP_K):
+    """Yield (row, neighbour rows, scores) best first for each of `rows`, excluding the row itself"""
+    k = min(k, len(index) - 1)
+    if k <= 0:
+        return
+    for batch, sims in index.similarities(rows):
+        sims[np.arange(len(batch)), batch] = -np.inf
+        part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        part_scores = np.take_along_axis(sims, part, axis=1)
+        order = np.argsort(-part_scores, axis=1)
+        neighbours = np.take_along_axis(part, order, axis=1)
+        scores = np.take_along_axis(part_scores, order, axis=1)
+        for i, row in enumerate(batch):
+            keep = scores[i] > 0
+            yield row, neighbours[i][keep], scores[i][keep]
+
+
+def _chunks(values, size=BATCH_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def mark_changed(product_id):
+    """Queue a product for re-indexing (call in the same transaction as the product write)"""
+    from models import ProductChange
+    change = db.session.get(ProductChange, product_id)
+    if change:
+        change.changed_at = datetime.utcnow()
+    else:
+        db.session.add(ProductChange(product_id=product_id))
+
+
+def _store(neighbors, product_ids):
+    """Replace the 'similar' lists of product_ids with {product_id: [(neighbor_id, score)]}"""
+    from models import ProductNeighbor
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), BATCH_SIZE):
+        db.session.execute(db.delete(ProductNeighbor).where(
+            ProductNeighbor.kind == KIND,
+            ProductNeighbor.product_id.in_(product_ids[start:start + BATCH_SIZE]),
+        ))
+    rows = [
+        {'kind': KIND, 'product_id': pid, 'rank': rank, 'neighbor_id': nid, 'score': float(score)}
+        for pid, ranked in neighbors.items()
+        for rank, (nid, score) in enumerate(ranked)
+    ]
+    if rows:
+        db.session.execute(ProductNeighbor.__table__.insert(), rows)
+
+
+def refresh(state, full=False):
+    """Re-rank products changed since the last run (or all of them).
+    `state` is the job's JobState row (see jobs.run_job). Returns the number of products re-ranked.
+    """
+    from models import Product, ProductChange, ProductNeighbor
+    started = datetime.utcnow()
+    data = dict(state.data or {})
+    built = data.get('built')
+    if (not built or 'vocabulary' not in data
+            or started - datetime.fromisoformat(built) > timedelta(seconds=FULL_REBUILD_SECONDS)):
+        full = True
+
+    changed = set(db.session.execute(
+        db.select(ProductChange.product_id).where(ProductChange.changed_at <= started)
+    ).scalars())
+    if not full and not changed:
+        return 0
+
+    columns = (Product.id, Product.name, Product.brand, Product.description, Product.specifications)
+    global _index
+    if full:
+        products = Product.query.with_entities(*columns).order_by(Product.id).all()
+        documents = [product_terms(p) for p in products]
+        vocabulary, idf = tfidf_vocabulary(documents)
+        _index = SparseIndex(vocabulary, idf, built=started.isoformat())
+        for product, terms in zip(products, documents):
+            _index.set(product.id, terms)
+        data.update({'built': _index.built, 'vocabulary': vocabulary, 'idf': idf})
+        db.session.execute(db.delete(ProductNeighbor).where(ProductNeighbor.kind == KIND))
+        affected = set(range(len(_index)))
+    else:
+        if _index is None or _index.built != built:
+            # this process has no index for the current build yet: vectorise everything once
+            _index = SparseIndex(data['vocabulary'], data['idf'], built=built)
+            for product in Product.query.with_entities(*columns).order_by(Product.id):
+                _index.set(product.id, product_terms(product))
+        found = set()
+        for chunk in _chunks(sorted(changed)):
+            for product in Product.query.with_entities(*columns).filter(Product.id.in_(chunk)):
+                _index.set(product.id, product_terms(product))
+                found.add(product.id)
+        for pid in changed - found:
+            _index.remove(pid)
+        # products that no longer exist
+        _store({}, changed - found)
+
+        # changed products, lists that contain a changed product, and lists a changed product now enters
+        affected = {_index.row_of[pid] for pid in found}
+        for chunk in _chunks(sorted(changed)):
+            affected |= {_index.row_of[pid] for pid in db.session.execute(
+                db.select(ProductNeighbor.product_id).distinct()
+                .where(ProductNeighbor.kind == KIND, ProductNeighbor.neighbor_id.in_(chunk))
+            ).scalars() if pid in _index.row_of}
+        best = np.zeros(len(_index), dtype=np.float64)
+        for _, sims in _index.similarities(sorted(_index.row_of[pid] for pid in found)):
+            np.maximum(best, sims.max(axis=0), out=best)
+        candidates = {_index.ids[row] for row in np.flatnonzero(best > 0).tolist()
+                      if row not in affected and _index.ids[row] is not None}
+        # a product's list changes if a changed product beats its current last entry (or it isn't full)
+        for chunk in _chunks(sorted(candidates)):
+            full_lists = dict(
+                (pid, lowest) for pid, lowest, size in db.session.execute(
+                    db.select(ProductNeighbor.product_id, db.func.min(ProductNeighbor.score), db.func.count())
+                    .where(ProductNeighbor.kind == KIND, ProductNeighbor.product_id.in_(chunk))
+                    .group_by(ProductNeighbor.product_id)
+                ) if size >= TOP_K
+            )
+            affected |= {_index.row_of[pid] for pid in chunk
+                         if pid not in full_lists or best[_index.row_of[pid]] > full_lists[pid]}
+
+    ids = _index.ids
+    neighbors = {
+        ids[row]: [(ids[n], score) for n, score in zip(neighbours, scores)]
+        for row, neighbours, scores in top_k_similar(_index, sorted(affected))
+    }
+    _store(neighbors, [ids[row] for row in affected])
+
+    db.session.execute(db.delete(ProductChange).where(ProductChange.changed_at <= started))
+    data.update({'products': len(_index.row_of), 'features': len(_index.column)})
+    state.data = data
+    db.session.commit()
+    print(f"[Similarity] Re-ranked {len(affected)} of {len(_index.row_of)} product(s){' (full rebuild)' if full else ''}")
+    return len(affected)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    os.environ.setdefault('ORDER_QUEUE_WORKER', '0')
+    os.environ.setdefault('BACKGROUND_JOBS', '0')
+    from app import create_app
+    from jobs import run_job
+
+    parser = argparse.ArgumentParser(description='Refresh content-based similar products')
+    parser.add_argument('--full', action='store_true', help='rebuild the whole index')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        processed = run_job('similarity', refresh, full=args.full)
+        if processed is None:
+            print("Another process is running the similarity job; try again later.")
@@ -0,0 +1,264 @@
+"""
+Quantile Sketches
+Mergeable t-digests of order totals (per day) and request latency (per
+endpoint and day), so p50/p95/p99 over any date range come from merging a
+handful of small daily sketches instead of sorting raw values.
+
+Values are recorded into in-memory digests; a background thread appends
+them to quantile_sketches every FLUSH_SECONDS (one row per metric, key and
+day per flush, so processes never overwrite each other's rows). The
+'sketch_compaction' job merges each day's rows back into one.
+
+Order totals are recorded when an order is placed (cancellations don't
+remove them); latency is the time until a view returns its response.
+"""
+
+import atexit
+import os
+import threading
+from datetime import datetime
+import numpy as np
+from extensions import db
+
+COMPRESSION = 200  # ~120 centroids; p99 within ~1% on skewed data
+BUFFER_SIZE = 500  # values buffered before a digest compresses them into centroids
+FLUSH_SECONDS = float(os.environ.get('SKETCH_FLUSH_SECONDS', 30))
+COMPACT_SECONDS = 600
+METRICS = ('order_total', 'latency')
+
+
+class TDigest:
+    """
+    Merging t-digest: weighted centroids, small near the tails (k1 scale
+    function), so extreme quantiles stay accurate. Two digests merge by
+    pooling their centroids and compressing again.
+    """
+
+    def __init__(self, compression=COMPRESSION, means=(), weights=(), min_value=None, max_value=None):
+        self.compression = compression
+        self.means = np.asarray(means, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.min = min_value
+        self.max = max_value
+        self._buffer = []
+
+    @property
+    def count(self):
+        return float(self.weights.sum()) + len(self._buffer)
+
+    def add(self, value):
+        value = float(value)
+        self._buffer.append(value)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) >= BUFFER_SIZE:
+            self._compress()
+
+    def merge(self, other):
+        other._compress()
+        if not len(other.means):
+            return self
+        self._compress(other.means, other.weights)
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def _compress(self, extra_means=(), extra_weights=()):
+        if not self._buffer and not len(extra_means):
+            return
+        means = np.concatenate([self.means, self._buffer, extra_means])
+        weights = np.concatenate([self.weights, np.ones(len(self._buffer)), extra_weights])
+        self._buffer = []
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+
+        # greedy merge: a centroid may span at most one unit of k(q) = compression/(2 pi) * asin(2q - 1)
+        total = weights.sum()
+        scale = self.compression / (2 * np.pi)
+        merged_means, merged_weights = [], []
+        q0, limit = 0.0, None
+        mean, weight = means[0], weights[0]
+        for m, w in zip(means[1:].tolist(), weights[1:].tolist()):
+            if limit is None:
+                limit = (np.sin((scale * np.arcsin(2 * q0 - 1) + 1) / scale) + 1) / 2
+            if q0 + (weight + w) / total <= limit:
+                mean += (m - mean) * w / (weight + w)
+                weight += w
+            else:
+                merged_means.append(mean)
+                merged_weights.append(weight)
+                q0 += weight / total
+                limit = None
+                mean, weight = m, w
+        merged_means.append(mean)
+        merged_weights.append(weight)
+        self.means = np.array(merged_means)
+        self.weights = np.array(merged_weights)
+
+    def quantiles(self, qs):
+        """Estimated values at quantiles `qs` (0..1); None for an empty digest"""
+        self._compress()
+        if not len(self.means):
+            return [None for _ in qs]
+        total = self.weights.sum()
+        positions = np.r_[0, np.cumsum(self.weights) - self.weights / 2, total]
+        values = np.r_[self.min, self.means, self.max]
+        return [float(v) for v in np.interp(np.asarray(qs, dtype=np.float64) * total, positions, values)]
+
+    def to_dict(self):
+        self._compress()
+        return {
+            'compression': self.compression,
+            'means': self.means.tolist(),
+            'weights': self.weights.tolist(),
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('compression', COMPRESSION), data.get('means', ()), data.get('weights', ()),
+                   data.get('min'), data.get('max'))
+
+
+class SketchRecorder:
+    """
+    In-memory digests per (metric, key, day), flushed to quantile_sketches
+    from a background thread.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.running = False
+        self.errors = 0
+
+    def init_app(self, app):
+        self.app = app
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self.running = False
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def record(self, metric, key, value, when=None):
+        day = (when or datetime.utcnow()).date()
+        with self._lock:
+            digest = self._digests.get((metric, key, day))
+            if digest is None:
+                digest = self._digests[(metric, key, day)] = TDigest()
+            digest.add(value)
+
+    def unflushed(self, metric, start, end, key=None):
+        """Copies of the digests not yet flushed: [(key, digest)]"""
+        with self._lock:
+            return [
+                (k, TDigest.from_dict(digest.to_dict()))
+                for (m, k, day), digest in self._digests.items()
+                if m == metric and start <= day <= end and (key is None or k == key)
+            ]
+
+    def _run(self):
+        while not self._stop.wait(FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        """Append every digest recorded since the last flush"""
+        if not self.app:
+            return 0
+        with self._lock:
+            batch, self._digests = self._digests, {}
+        if not batch:
+            return 0
+
+        from models import QuantileSketch
+        now = datetime.utcnow()
+        rows = [
+            {'metric': metric, 'key': key, 'day': day, 'count': int(digest.count),
+             'data': digest.to_dict(), 'created_at': now}
+            for (metric, key, day), digest in batch.items()
+        ]
+        with self.app.app_context():
+            try:
+                db.session.execute(db.insert(QuantileSketch), rows)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.errors += 1
+                print(f"[Sketches] Error flushing {len(rows)} sketches: {e}")
+                # merge them back for the next attempt
+                with self._lock:
+                    for ident, digest in batch.items():
+                        current = self._digests.get(ident)
+                        self._digests[ident] = digest.merge(current) if current else digest
+                return 0
+            finally:
+                db.session.remove()
+        return len(rows)
+
+
+def merged(metric, start, end, key=None, by_key=False):
+    """Merge the stored (and this process's unflushed) digests of `metric`
+    for days start..end. Returns one TDigest, or {key: TDigest} with by_key.
+    """
+    from models import QuantileSketch
+    query = db.select(QuantileSketch.key, QuantileSketch.data).where(
+        QuantileSketch.metric == metric, QuantileSketch.day >= start, QuantileSketch.day <= end
+    )
+    if key is not None:
+        query = query.where(QuantileSketch.key == key)
+    digests = {}
+    parts = [(k, TDigest.from_dict(data)) for k, data in db.session.execute(query)]
+    for k, digest in parts + sketch_recorder.unflushed(metric, start, end, key):
+        k = k if by_key else None
+        digests[k] = digests[k].merge(digest) if k in digests else digest
+    if by_key:
+        return digests
+    return digests.get(None, TDigest())
+
+
+def compact(state):
+    """Merge each (metric, key, day) that has several rows into a single row. Returns rows removed."""
+    from models import QuantileSketch
+    groups = db.session.execute(
+        db.select(QuantileSketch.metric, QuantileSketch.key, QuantileSketch.day)
+        .group_by(QuantileSketch.metric, QuantileSketch.key, QuantileSketch.day)
+        .having(db.func.count() > 1)
+    ).all()
+    removed = 0
+    for metric, key, day in groups:
+        rows = db.session.execute(
+            db.select(QuantileSketch.id, QuantileSketch.data).where(
+                QuantileSketch.metric == metric, QuantileSketch.key == key, QuantileSketch.day == day
+            )
+        ).all()
+        digest = TDigest()
+        for _, data in rows:
+            digest.merge(TDigest.from_dict(data))
+        # only the rows read above are replaced; flushes that land meanwhile are left for the next run
+        db.session.execute(db.delete(QuantileSketch).where(QuantileSketch.id.in_([row.id for row in rows])))
+        db.session.add(QuantileSketch(metric=metric, key=key, day=day, count=int(digest.count),
+                                      data=digest.to_dict(), created_at=datetime.utcnow()))
+        removed += len(rows) - 1
+    db.session.commit()
+    if removed:
+        print(f"[Sketches] Compacted {len(groups)} sketch group(s), {removed} row(s) removed")
+    return removed
+
+
+# Global instance
+sketch_recorder = SketchRecorder()
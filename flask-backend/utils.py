@@ -12,17 +12,30 @@ def verify_password(hash: str, password: str) -> bool:
     return check_password_hash(hash, password)
 
 
-def generate_token(user_id: int) -> str:
+def generate_token(user_id: int, scope: str = None, expires_in: int = None) -> str:
+    """Session token (7 days), or with `scope` a short-lived token only accepted by
+    verify_scoped_token (e.g. for EventSource URLs, which can't send headers)."""
     import datetime
     payload = {
         'sub': user_id,
         'iat': datetime.datetime.utcnow(),
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(days=7),
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in or 7 * 86400),
     }
+    if scope:
+        payload['scope'] = scope
     token = jwt.encode(payload, current_app.config['SECRET_KEY'], algorithm='HS256')
     return token
 
 
+def verify_scoped_token(token: str, scope: str):
+    """User id of a valid token issued for `scope` by generate_token, else None"""
+    try:
+        data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+    except Exception:
+        return None
+    return data.get('sub') if data.get('scope') == scope else None
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -36,6 +49,8 @@ def token_required(f):
             return jsonify({'error': 'token missing'}), 401
         try:
             data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+            if data.get('scope'):
+                raise jwt.InvalidTokenError('scoped token')
             request.user_id = data.get('sub')
         except Exception as e:
             return jsonify({'error': 'token invalid', 'details': str(e)}), 401
@@ -53,6 +68,19 @@ def get_current_user_id():
             return None
         token = auth.split(' ')[1]
         data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
-        return data.get('sub')
+        return None if data.get('scope') else data.get('sub')
     except Exception:
         return None
+
+
+def admin_required(f):
+    @wraps(f)
+    @token_required
+    def decorated(*args, **kwargs):
+        from models import User
+        # token_required decorator has already set request.user_id
+        user = User.query.get(request.user_id)
+        if not user or not getattr(user, 'is_admin', False):
+            return jsonify({'error': 'forbidden'}), 403
+        return f(*args, **kwargs)
+    return decorated
@@ -0,0 +1,158 @@
+"""
+Browsing Event Buffer
+Write-behind persistence of product views: requests append events to an
+in-memory buffer and a background thread bulk-inserts them into the
+product_views table when FLUSH_SIZE events are waiting or every
+FLUSH_SECONDS, whichever comes first.
+
+Events that can't be stored (missing or over-long product id, no
+timestamp) are rejected when they're added. A chunk that fails to insert is
+retried with exponential backoff and dropped after MAX_ATTEMPTS, so one bad
+row can't hold up the rest of the buffer.
+"""
+
+import atexit
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from extensions import db
+
+FLUSH_SIZE = 500
+FLUSH_SECONDS = float(os.environ.get('VIEW_EVENTS_FLUSH_SECONDS', 5))
+MAX_BUFFERED = 100000  # oldest events are dropped beyond this (e.g. while the DB is down)
+MAX_ATTEMPTS = 5  # a chunk that fails this many times in a row is dropped
+MAX_BACKOFF_SECONDS = 300
+HISTORY_KEY_LENGTH = 160  # product_views.history_key
+PRODUCT_ID_LENGTH = 64  # product_views.product_id
+
+
+def _clean(event):
+    """The event as a product_views row, or None if it can't be stored"""
+    product_id = str(event.get('product_id') or '')
+    viewed_at = event.get('viewed_at')
+    if not product_id or len(product_id) > PRODUCT_ID_LENGTH or not isinstance(viewed_at, datetime):
+        return None
+    user_id = event.get('user_id')
+    return {
+        'history_key': str(event.get('history_key') or '')[:HISTORY_KEY_LENGTH],
+        'user_id': user_id if isinstance(user_id, int) else None,
+        'product_id': product_id,
+        'viewed_at': viewed_at,
+    }
+
+
+class ViewEventBuffer:
+    """
+    Buffers view events and flushes them in bulk from a background thread.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self._events = deque(maxlen=MAX_BUFFERED)
+        self._retry = []  # the chunk that failed last, retried before anything else
+        self._attempts = 0  # consecutive failures of that chunk
+        self._cond = threading.Condition()
+        self._thread = None
+        self.running = False
+        self.flushed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def init_app(self, app):
+        self.app = app
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def add(self, events):
+        """Queue view events: dicts with history_key, user_id, product_id, viewed_at (datetime)"""
+        rows = [row for row in map(_clean, events) if row]
+        with self._cond:
+            self.rejected += len(events) - len(rows)
+            self._events.extend(rows)
+            if len(self._events) >= FLUSH_SIZE:
+                self._cond.notify()
+
+    def pending(self):
+        return len(self._events) + len(self._retry)
+
+    def _backoff(self):
+        return min(FLUSH_SECONDS * 2 ** (self._attempts - 1), MAX_BACKOFF_SECONDS)
+
+    def _run(self):
+        while self.running:
+            with self._cond:
+                if self._attempts:
+                    # after a failure wait out the backoff even if the buffer fills up
+                    deadline = time.monotonic() + self._backoff()
+                    while self.running and time.monotonic() < deadline:
+                        self._cond.wait(deadline - time.monotonic())
+                elif len(self._events) < FLUSH_SIZE:
+                    self._cond.wait(FLUSH_SECONDS)
+            self.flush()
+
+    def flush(self):
+        """Bulk insert everything buffered so far, FLUSH_SIZE rows per transaction"""
+        if not self.app:
+            return 0
+        with self._cond:
+            retry, self._retry = self._retry, []
+            batch = list(self._events)
+            self._events.clear()
+        chunks = ([retry] if retry else []) + [batch[i:i + FLUSH_SIZE] for i in range(0, len(batch), FLUSH_SIZE)]
+        if not chunks:
+            return 0
+
+        from models import ProductView
+        inserted = 0
+        with self.app.app_context():
+            try:
+                for n, chunk in enumerate(chunks):
+                    try:
+                        db.session.execute(db.insert(ProductView), chunk)
+                        db.session.commit()
+                    except Exception as e:
+                        db.session.rollback()
+                        self.errors += 1
+                        self._attempts = self._attempts + 1 if n == 0 and retry else 1
+                        rest = [row for later in chunks[n + 1:] for row in later]
+                        if self._attempts >= MAX_ATTEMPTS:
+                            self.dropped += len(chunk)
+                            self._attempts = 0
+                            print(f"[ViewEvents] Dropping {len(chunk)} view events after {MAX_ATTEMPTS} failed attempts: {e}")
+                        else:
+                            print(f"[ViewEvents] Error flushing {len(chunk)} view events "
+                                  f"(attempt {self._attempts}, retrying in {self._backoff():.0f}s): {e}")
+                        # keep the rest in front for the next attempt; if that overflows
+                        # the buffer, the oldest are dropped (extendleft would drop the newest)
+                        with self._cond:
+                            if self._attempts:
+                                self._retry = chunk
+                            self._events = deque(rest + list(self._events), maxlen=MAX_BUFFERED)
+                        break
+                    self._attempts = 0
+                    self.flushed += len(chunk)
+                    inserted += len(chunk)
+            finally:
+                db.session.remove()
+        return inserted
+
+
+# Global instance
+view_event_buffer = ViewEventBuffer()